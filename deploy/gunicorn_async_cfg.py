@@ -0,0 +1,8 @@
+# Serve tawhiri.asgi:application (pip install tawhiri[async]): one event loop
+# handles every connection, and runs the predictions in a pool of
+# ASYNC_PROCESSES processes (see tawhiri.asgi)
+
+bind = "unix:/run/tawhiri/v1.sock"
+pidfile = "/run/tawhiri/v1.pid"
+workers = 1
+worker_class = "uvicorn.workers.UvicornWorker"
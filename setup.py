@@ -33,6 +33,10 @@ def get_version():
 entry_points = {
         "console_scripts": [
             "tawhiri-webapp = tawhiri.manager:main",
+            "tawhiri-convert = tawhiri.convert:main",
+            "tawhiri-elevation = tawhiri.elevation:main",
+            "tawhiri-ingest = tawhiri.ingest:main",
+            "tawhiri-residency = tawhiri.residency:main",
         ],
 }
 
@@ -60,6 +64,10 @@ setup(
         "strict-rfc3339",
         "gunicorn"
     ],
+    extras_require={
+        # for tawhiri.asgi
+        "async": ["uvicorn"]
+    },
     classifiers=[
         'Development Status :: 4 - Beta',
         'Intended Audience :: Science/Research',
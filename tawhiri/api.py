@@ -19,14 +19,28 @@
 Provide the HTTP API for Tawhiri.
 """
 
-from flask import Flask, jsonify, request, g
+from flask import Flask, Response, jsonify, request, g
 from datetime import datetime
+from array import array
+import contextlib
+import functools
+import itertools
+import json
+import multiprocessing
+import queue
+import struct
+import sys
+import threading
 import time
 import strict_rfc3339
 
 from tawhiri import solver, models
-from tawhiri.dataset import Dataset as WindDataset
+from tawhiri.dataset import Dataset as WindDataset, DatasetRegistry
 from tawhiri.warnings import WarningCounts
+from tawhiri.workcounts import WorkCounts
+from tawhiri.elevation import Elevation, MaximumElevation
+from tawhiri.cache import ResultCache
+from tawhiri.metrics import Metrics, Timings
 from ruaumoko import Dataset as ElevationDataset
 
 app = Flask(__name__)
@@ -35,16 +49,116 @@ API_VERSION = 1
 LATEST_DATASET_KEYWORD = "latest"
 PROFILE_STANDARD = "standard_profile"
 PROFILE_FLOAT = "float_profile"
+INTEGRATOR_RK4 = "rk4"
+INTEGRATOR_DOPRI5 = "dopri5"
+FORMAT_JSON = "json"
+FORMAT_COLUMNAR = "columnar"
+FORMAT_BINARY = "binary"
+BINARY_MAGIC = b"TWHR"
 
 
 # Util functions ##############################################################
 def ruaumoko_ds():
-    if not hasattr("ruaumoko_ds", "once"):
+    if not hasattr(ruaumoko_ds, "once"):
         ds_loc = app.config.get('ELEVATION_DATASET', ElevationDataset.default_location)
         ruaumoko_ds.once = ElevationDataset(ds_loc)
 
     return ruaumoko_ds.once
 
+def elevation_ds():
+    """
+    The elevation dataset for the elevation terminator: :func:`ruaumoko_ds`,
+    with the maximum elevations in ``ELEVATION_MAXIMUM`` if configured (see
+    :mod:`tawhiri.elevation`).
+    """
+    if not hasattr(elevation_ds, "once"):
+        maximum = None
+        if app.config.get('ELEVATION_MAXIMUM'):
+            maximum = MaximumElevation.load(app.config['ELEVATION_MAXIMUM'])
+        elevation_ds.once = Elevation(ruaumoko_ds(), maximum)
+
+    return elevation_ds.once
+
+_wind_registry_lock = threading.Lock()
+
+def wind_registry():
+    with _wind_registry_lock:
+        if not hasattr(wind_registry, "once"):
+            wind_registry.once = DatasetRegistry(
+                app.config.get('WIND_DATASET_DIR',
+                               WindDataset.DEFAULT_DIRECTORY),
+                size=app.config.get('WIND_DATASET_CACHE_SIZE', 2),
+                residency=app.config.get('WIND_DATASET_RESIDENCY'))
+
+    return wind_registry.once
+
+_result_cache_lock = threading.Lock()
+
+def result_cache():
+    """
+    The cache of responses (see :class:`tawhiri.cache.ResultCache`), of up
+    to ``RESULT_CACHE_SIZE`` bytes (default 64MiB; 0 disables the cache),
+    shared with the other processes of the web server through the directory
+    ``RESULT_CACHE_DIR``, if configured, of up to ``RESULT_CACHE_DISK_SIZE``
+    bytes (default 1GiB).
+    """
+    with _result_cache_lock:
+        if not hasattr(result_cache, "once"):
+            size = app.config.get('RESULT_CACHE_SIZE', 64 * 2**20)
+            if size:
+                result_cache.once = ResultCache(
+                        size, app.config.get('RESULT_CACHE_DIR'),
+                        app.config.get('RESULT_CACHE_DISK_SIZE', 2**30))
+            else:
+                result_cache.once = None
+
+    return result_cache.once
+
+_metrics_lock = threading.Lock()
+
+def metrics():
+    """
+    The timings and counts of the predictions that this process has run
+    (see :class:`tawhiri.metrics.Metrics`), added up with those of the other
+    processes of the web server through the directory ``METRICS_DIR``, if
+    configured.
+    """
+    with _metrics_lock:
+        if not hasattr(metrics, "once"):
+            metrics.once = Metrics(app.config.get('METRICS_DIR'))
+
+    return metrics.once
+
+_batch_pool_lock = threading.Lock()
+
+def batch_pool():
+    """
+    The pool of ``BATCH_PROCESSES`` worker processes (or, if that is 0 or
+    None, one per CPU) that run the predictions of batches (see
+    :func:`batch`), or None if ``BATCH_PROCESSES`` is 1 (the default), to
+    run them in this process.
+
+    Each worker opens the wind and elevation datasets once, and keeps them
+    open for every prediction that it runs. The workers are started afresh
+    (not forked), since the web server process may be running other
+    requests in threads.
+    """
+    with _batch_pool_lock:
+        if not hasattr(batch_pool, "once"):
+            processes = app.config.get('BATCH_PROCESSES', 1)
+            if processes == 1:
+                batch_pool.once = None
+            else:
+                context = multiprocessing.get_context("spawn")
+                batch_pool.once = context.Pool(
+                        processes or None, _start_batch_worker,
+                        (dict(app.config),))
+
+    return batch_pool.once
+
+def _start_batch_worker(config):
+    app.config.update(config)
+
 def _rfc3339_to_timestamp(dt):
     """
     Convert from a RFC3339 timestamp to a UNIX timestamp.
@@ -102,6 +216,13 @@ class NotYetImplementedException(APIException):
     status_code = 501
 
 
+class ServiceUnavailableException(APIException):
+    """
+    Raised when there are too many predictions waiting to be run.
+    """
+    status_code = 503
+
+
 # Request #####################################################################
 def parse_request(data):
     """
@@ -156,13 +277,66 @@ def parse_request(data):
     else:
         raise RequestException("Unknown profile '%s'." % req['profile'])
 
+    # Integrator
+    req['integrator'] = \
+        _extract_parameter(data, "integrator", str, INTEGRATOR_RK4,
+                           validator=lambda x: x in (INTEGRATOR_RK4,
+                                                     INTEGRATOR_DOPRI5))
+    if req['integrator'] == INTEGRATOR_DOPRI5:
+        req['integrator_tolerance'] = \
+            _extract_parameter(data, "integrator_tolerance", float, 1.0,
+                               validator=lambda x: x > 0)
+    if "termination_distance" in data:
+        req['termination_distance'] = \
+            _extract_parameter(data, "termination_distance", float,
+                               validator=lambda x: x > 0)
+    if "output_interval" in data:
+        req['output_interval'] = \
+            _extract_parameter(data, "output_interval", float,
+                               validator=lambda x: x > 0)
+
     # Dataset
     req['dataset'] = _extract_parameter(data, "dataset", _rfc3339_to_timestamp,
                                         LATEST_DATASET_KEYWORD)
 
+    # Response format
+    req['format'] = \
+        _extract_parameter(data, "format", str, FORMAT_JSON,
+                           validator=lambda x: x in (FORMAT_JSON,
+                                                     FORMAT_COLUMNAR,
+                                                     FORMAT_BINARY))
+
     return req
 
 
+def parse_batch(data):
+    """
+    Parse a batch of requests (see :func:`batch`). Returns a list of
+    (index, request) pairs, and a list of the responses to the requests
+    that could not be parsed.
+    """
+    if not isinstance(data, list):
+        raise RequestException("Expected a JSON list of requests.")
+    if len(data) > app.config.get('BATCH_MAX_SIZE', 1000):
+        raise RequestException("Too many requests in batch.")
+
+    errors = []
+    reqs = []
+    for index, item in enumerate(data):
+        try:
+            if not isinstance(item, dict):
+                raise RequestException("Expected a JSON object.")
+            req = parse_request(item)
+            if req['format'] == FORMAT_BINARY:
+                raise RequestException("Batches cannot use the binary "
+                                       "format.")
+            reqs.append((index, req))
+        except APIException as e:
+            errors.append({"index": index, "error": _format_error(e)})
+
+    return reqs, errors
+
+
 def _extract_parameter(data, parameter, cast, default=None, ignore=False,
                        validator=None):
     """
@@ -201,66 +375,312 @@ def run_prediction(req):
 
     warningcounts = WarningCounts()
 
-    # Find wind data location
-    ds_dir = app.config.get('WIND_DATASET_DIR', WindDataset.DEFAULT_DIRECTORY)
+    registry = wind_registry()
+    tawhiri_ds = _acquire_dataset(registry, req)
+    try:
+        return _run_prediction(req, resp, tawhiri_ds, warningcounts)
+    finally:
+        registry.release(tawhiri_ds)
+
 
-    # Dataset
+def run_cached_prediction(req, timings=None):
+    """
+    Run the prediction, unless its response is in the result cache (see
+    :func:`result_cache`). Returns the response (without metadata) as
+    JSON (:class:`bytes`).
+
+    The time taken by each phase, and the work done, are added to
+    `timings` (a :class:`tawhiri.metrics.Timings`), and recorded in
+    :func:`metrics`.
+    """
+    if timings is None:
+        timings = Timings()
+
+    with _measure(timings) as workcounts:
+        cache = result_cache()
+        registry = wind_registry()
+        with timings.phase("dataset"):
+            tawhiri_ds = _acquire_dataset(registry, req)
+        try:
+            if cache is not None:
+                key = cache.key(req, tawhiri_ds.ds_time)
+                body = cache.get(key)
+                if body is not None:
+                    timings.count("cached_predictions")
+                    return body
+
+            resp = {
+                "request": dict(req),
+                "prediction": [],
+            }
+            resp = _run_prediction(resp['request'], resp, tawhiri_ds,
+                                   WarningCounts(), timings, workcounts)
+            with timings.phase("serialize"):
+                body = _encode_response(resp)
+            if cache is not None:
+                cache.put(key, body)
+            return body
+        finally:
+            registry.release(tawhiri_ds)
+
+
+def _run_query_prediction(query):
+    """
+    Parse the request `query` (see :func:`parse_request`), which may look
+    up the launch altitude, and run it with :func:`run_cached_prediction`.
+    Returns the request and the response.
+    """
+    req = parse_request(query)
+    return req, run_cached_prediction(req)
+
+
+def run_streamed_prediction(req):
+    """
+    Run the prediction (unless its response is in the result cache),
+    yielding the parts of the response as soon as each is ready: the
+    request, each stage, and then the warnings (each a dict). The dataset is
+    acquired when the first part is asked for. As for
+    :func:`run_cached_prediction`, its timings are recorded in
+    :func:`metrics`.
+    """
+    timings = Timings()
+    with _measure(timings) as workcounts:
+        yield from _stream_prediction(req, timings, workcounts)
+
+
+def _stream_prediction(req, timings, workcounts=None):
+    """
+    The parts of the response (see :func:`run_streamed_prediction`), with
+    the time taken by each phase added to `timings`, and the work done
+    counted in `workcounts`.
+    """
+    cache = result_cache()
+    registry = wind_registry()
+    with timings.phase("dataset"):
+        tawhiri_ds = _acquire_dataset(registry, req)
+    try:
+        if cache is not None:
+            key = cache.key(req, tawhiri_ds.ds_time)
+            body = cache.get(key)
+            if body is not None:
+                timings.count("cached_predictions")
+                resp = json.loads(body.decode("utf-8"))
+                yield {"request": resp['request']}
+                for stage in resp['prediction']:
+                    yield stage
+                yield {"warnings": resp['warnings']}
+                return
+
+        resp = {
+            "request": dict(req),
+            "prediction": [],
+        }
+        _format_request(resp['request'], tawhiri_ds)
+        yield {"request": resp['request']}
+
+        warningcounts = WarningCounts()
+        labels, stages, integrator = _prediction_chain(req, tawhiri_ds,
+                                                       warningcounts,
+                                                       workcounts)
+        legs = solver.solve_iter(req['launch_datetime'],
+                                 req['launch_latitude'],
+                                 req['launch_longitude'],
+                                 req['launch_altitude'],
+                                 stages, integrator)
+        for label in labels:
+            try:
+                with timings.phase(label):
+                    leg = next(legs)
+            except Exception as e:
+                raise PredictionException("Prediction did not complete: "
+                                          "'%s'." % str(e))
+            with timings.phase("serialize"):
+                stage, = _format_stages(req, [label], [leg])
+            resp['prediction'].append(stage)
+            yield stage
+
+        resp['warnings'] = warningcounts.to_dict()
+        yield {"warnings": resp['warnings']}
+
+        if cache is not None:
+            cache.put(key, _encode_response(resp))
+    finally:
+        registry.release(tawhiri_ds)
+
+
+@contextlib.contextmanager
+def _measure(timings):
+    """
+    Count a prediction in `timings`, along with the work done while running
+    it, which is counted in the :class:`tawhiri.workcounts.WorkCounts` that
+    this yields, and then record them in :func:`metrics`.
+    """
+    workcounts = WorkCounts()
+    timings.count("predictions")
+    try:
+        yield workcounts
+    except Exception:
+        timings.count("failed_predictions")
+        raise
+    finally:
+        timings.count("solver_steps", workcounts.solver_steps)
+        timings.count("wind_lookups", workcounts.wind_lookups)
+        timings.count("wind_cell_changes", workcounts.wind_cell_changes)
+        timings.count("elevation_lookups", workcounts.elevation_lookups)
+        if workcounts.elevation_lookups:
+            timings.add("elevation", workcounts.elevation_seconds)
+        metrics().record(timings)
+
+
+def _acquire_dataset(registry, req):
+    """
+    Acquire the wind dataset for `req` from `registry`.
+    """
     try:
         if req['dataset'] == LATEST_DATASET_KEYWORD:
-            tawhiri_ds = WindDataset.open_latest(persistent=True, directory=ds_dir)
+            # (the latest dataset that has the hours the prediction needs,
+            # which may still be being written)
+            return registry.acquire(times=_prediction_times(req))
         else:
-            tawhiri_ds = WindDataset(datetime.fromtimestamp(req['dataset']), directory=ds_dir)
+            return registry.acquire(datetime.fromtimestamp(req['dataset']))
     except IOError:
         raise InvalidDatasetException("No matching dataset found.")
     except ValueError as e:
         raise InvalidDatasetException(*e.args)
 
+
+def _prediction_times(req):
+    """
+    The times that a prediction will need wind data for: a (first, last)
+    pair of :class:`datetime`. (This overestimates the length of the
+    descent, by assuming that it is at the sea level descent rate
+    throughout.)
+    """
+    start = req['launch_datetime']
+    if req['profile'] == PROFILE_FLOAT:
+        end = req['stop_datetime']
+    else:
+        end = start + \
+            (req['burst_altitude'] - req['launch_altitude']) / \
+            req['ascent_rate'] + \
+            req['burst_altitude'] / req['descent_rate']
+
+    return datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(end)
+
+
+def _run_prediction(req, resp, tawhiri_ds, warningcounts, timings=None,
+                    workcounts=None):
+    """
+    Run the prediction, using `tawhiri_ds` (see :func:`run_prediction`),
+    timing each stage in `timings`, and counting the work done in
+    `workcounts`, if given.
+    """
+    if timings is None:
+        timings = Timings()
+
+    labels, stages, integrator = _prediction_chain(req, tawhiri_ds,
+                                                   warningcounts, workcounts)
+    integrator = _timed_integrator(integrator, labels, timings)
+
+    # Run solver
+    try:
+        result = solver.solve(req['launch_datetime'], req['launch_latitude'],
+                              req['launch_longitude'], req['launch_altitude'],
+                              stages, integrator)
+    except Exception as e:
+        raise PredictionException("Prediction did not complete: '%s'." %
+                                  str(e))
+
+    with timings.phase("serialize"):
+        resp['prediction'] = _format_stages(req, labels, result)
+    _format_request(resp['request'], tawhiri_ds)
+
+    resp["warnings"] = warningcounts.to_dict()
+
+    return resp
+
+
+def _timed_integrator(integrator, labels, timings):
+    """
+    Wrap `integrator`, timing each stage (of `labels`) that it integrates
+    in `timings`.
+    """
+    labels = iter(labels)
+
+    def timed(*args, **kwargs):
+        with timings.phase(next(labels)):
+            return integrator(*args, **kwargs)
+
+    return timed
+
+
+def _format_request(request, tawhiri_ds):
+    """
+    Format the request for inclusion in the response, in place.
+    """
     # Note that hours and minutes are set to 00 as Tawhiri uses hourly datasets
-    resp['request']['dataset'] = \
-            tawhiri_ds.ds_time.strftime("%Y-%m-%dT%H:00:00Z")
+    request['dataset'] = tawhiri_ds.ds_time.strftime("%Y-%m-%dT%H:00:00Z")
+
+    # Convert request UNIX timestamps to RFC3339 timestamps
+    for key in request:
+        if "datetime" in key:
+            request[key] = _timestamp_to_rfc3339(request[key])
+
 
+def _prediction_chain(req, tawhiri_ds, warningcounts, workcounts=None):
+    """
+    The labels of the stages of the prediction, its chain (see
+    :func:`tawhiri.solver.solve`), using `tawhiri_ds`, and its integrator.
+    The work done is counted in `workcounts`, if given.
+    """
     # Stages
     if req['profile'] == PROFILE_STANDARD:
         stages = models.standard_profile(req['ascent_rate'],
                                          req['burst_altitude'],
                                          req['descent_rate'],
                                          tawhiri_ds,
-                                         ruaumoko_ds(),
-                                         warningcounts)
+                                         elevation_ds(),
+                                         warningcounts,
+                                         workcounts)
+        labels = ["ascent", "descent"]
     elif req['profile'] == PROFILE_FLOAT:
         stages = models.float_profile(req['ascent_rate'],
                                       req['float_altitude'],
                                       req['stop_datetime'],
                                       tawhiri_ds,
-                                      warningcounts)
+                                      warningcounts,
+                                      workcounts)
+        labels = ["ascent", "float"]
     else:
         raise InternalException("No implementation for known profile.")
 
-    # Run solver
-    try:
-        result = solver.solve(req['launch_datetime'], req['launch_latitude'],
-                              req['launch_longitude'], req['launch_altitude'],
-                              stages)
-    except Exception as e:
-        raise PredictionException("Prediction did not complete: '%s'." %
-                                  str(e))
-
-    # Format trajectory
-    if req['profile'] == PROFILE_STANDARD:
-        resp['prediction'] = _parse_stages(["ascent", "descent"], result)
-    elif req['profile'] == PROFILE_FLOAT:
-        resp['prediction'] = _parse_stages(["ascent", "float"], result)
+    if req['integrator'] == INTEGRATOR_DOPRI5:
+        integrator = functools.partial(solver.dopri5,
+                                       atol=req['integrator_tolerance'])
     else:
-        raise InternalException("No implementation for known profile.")
+        integrator = solver.rk4
+    if 'termination_distance' in req:
+        integrator = functools.partial(
+                integrator, termination_distance=req['termination_distance'])
+    if 'output_interval' in req:
+        integrator = functools.partial(
+                integrator, output_interval=req['output_interval'])
+    if workcounts is not None:
+        integrator = functools.partial(integrator, workcounts=workcounts)
 
-    # Convert request UNIX timestamps to RFC3339 timestamps
-    for key in resp['request']:
-        if "datetime" in key:
-            resp['request'][key] = _timestamp_to_rfc3339(resp['request'][key])
+    return labels, stages, integrator
 
-    resp["warnings"] = warningcounts.to_dict()
 
-    return resp
+def _format_stages(req, labels, result):
+    """
+    Format the trajectory of each stage, in the format of `req`.
+    """
+    if req.get('format') == FORMAT_COLUMNAR:
+        return _parse_stages_columnar(labels, result)
+    elif req.get('format') == FORMAT_BINARY:
+        return _parse_stages_binary(labels, result)
+    else:
+        return _parse_stages(labels, result)
 
 
 def _parse_stages(labels, data):
@@ -283,6 +703,84 @@ def _parse_stages(labels, data):
     return prediction
 
 
+def _run_batch_prediction(item):
+    """
+    Run one prediction of a batch: `item` is an (index, request) pair.
+    Returns the response, with its index, or an error.
+    """
+    index, req = item
+    start_time = time.time()
+    try:
+        body = run_cached_prediction(req)
+    except Exception as e:
+        body = json.dumps({"error": _format_exception(e)}).encode("utf-8")
+    return _add_fields(body, index=index,
+                       metadata=_format_metadata(start_time, time.time()))
+
+
+def _parse_stages_columnar(labels, data):
+    """
+    Parse the predictor output for a set of stages, into an array of each
+    variable for each stage.
+    """
+    assert len(labels) == len(data)
+
+    prediction = []
+    for label, leg in zip(labels, data):
+        dts, lats, lons, alts = zip(*leg)
+        prediction.append({
+            'stage': label,
+            'timestamp': dts,
+            'latitude': lats,
+            'longitude': lons,
+            'altitude': alts,
+        })
+    return prediction
+
+
+def _parse_stages_binary(labels, data):
+    """
+    Parse the predictor output for a set of stages, into packed arrays of
+    each variable for each stage (see :func:`_encode_response`).
+    """
+    assert len(labels) == len(data)
+
+    prediction = []
+    for label, leg in zip(labels, data):
+        arrays = array('d')
+        for column in zip(*leg):
+            arrays.extend(column)
+        if sys.byteorder != 'little':
+            arrays.byteswap()
+        prediction.append({
+            'stage': label,
+            'points': len(leg),
+            'data': arrays.tobytes(),
+        })
+    return prediction
+
+
+def _encode_response(resp):
+    """
+    Encode the response `resp` (without metadata): as JSON, or, if it has
+    binary stages (see :func:`_parse_stages_binary`), as ``BINARY_MAGIC``,
+    the length of a JSON header (a little-endian uint32), the header (the
+    response, without the arrays, padded so that the arrays are 8 byte
+    aligned), and the arrays.
+    """
+    if resp['request'].get('format') != FORMAT_BINARY:
+        return json.dumps(resp).encode("utf-8")
+
+    data = b"".join(stage.pop('data') for stage in resp['prediction'])
+    return _pack_binary(resp, data)
+
+
+def _pack_binary(header, data):
+    header = json.dumps(header).encode("utf-8")
+    header += b" " * (-(len(BINARY_MAGIC) + 4 + len(header)) % 8)
+    return BINARY_MAGIC + struct.pack("<I", len(header)) + header + data
+
+
 # Flask App ###################################################################
 @app.route('/api/v{0}/'.format(API_VERSION), methods=['GET'])
 def main():
@@ -290,10 +788,134 @@ def main():
     Single API endpoint which accepts GET requests.
     """
     g.request_start_time = time.time()
-    response = run_prediction(parse_request(request.args))
+    timings = Timings()
+    with timings.phase("parse"):
+        req = parse_request(request.args)
+    include_timings = \
+        _extract_parameter(request.args, "timings", str, "false",
+                           validator=lambda x: x in ("true", "false"))
+    body = run_cached_prediction(req, timings)
     g.request_complete_time = time.time()
-    response['metadata'] = _format_request_metadata()
-    return jsonify(response)
+    metadata = _format_request_metadata()
+    if include_timings == "true":
+        metadata['timings'] = timings.to_dict()
+    body = _add_fields(body, metadata=metadata)
+    if req['format'] == FORMAT_BINARY:
+        return Response(body, mimetype="application/octet-stream")
+    return Response(body, mimetype="application/json")
+
+
+@app.route('/api/v{0}/batch'.format(API_VERSION), methods=['POST'])
+def batch():
+    """
+    Batch endpoint, which accepts a JSON list of requests (each an object
+    with the parameters of :func:`main`) and streams back a response for
+    each, as a line of JSON, in the order that they complete.
+
+    Each response has the ``index`` of its request in the list, and either
+    the prediction or its own ``error``.
+    """
+    g.request_start_time = time.time()
+    reqs, errors = parse_batch(request.get_json(silent=True))
+    pool = batch_pool()
+
+    def generate():
+        for resp in errors:
+            yield json.dumps(resp).encode("utf-8") + b"\n"
+        if pool is None:
+            results = map(_run_batch_prediction, reqs)
+        else:
+            processes = app.config.get('BATCH_PROCESSES') or \
+                        multiprocessing.cpu_count()
+            results = _run_batch(pool, 2 * processes, reqs)
+        for body in results:
+            yield body + b"\n"
+
+    return Response(generate(), mimetype="application/x-ndjson")
+
+
+def _run_batch(pool, window, reqs):
+    """
+    Run the predictions `reqs` of a batch in `pool`, yielding each response
+    as it completes.
+
+    Only `window` predictions are given to the pool at a time, so that if
+    the generator is closed (e.g., when the client goes away), the rest of
+    the batch is not run, and the pool is free for other batches.
+    """
+    done = queue.Queue()
+    pending = iter(reqs)
+    running = 0
+    while True:
+        for item in itertools.islice(pending, window - running):
+            pool.apply_async(_run_batch_prediction, (item,),
+                             callback=done.put, error_callback=done.put)
+            running += 1
+        if not running:
+            return
+
+        body = done.get()
+        running -= 1
+        if isinstance(body, Exception):
+            raise body
+        yield body
+
+
+@app.route('/api/v{0}/stream'.format(API_VERSION), methods=['GET'])
+def stream():
+    """
+    Streaming endpoint, which accepts the same requests as :func:`main`, but
+    sends each part of the response (see :func:`run_streamed_prediction`)
+    as a line of JSON as soon as it is ready, and then the metadata.
+
+    Errors found before the first line are returned as by :func:`main`;
+    later errors are sent as a line with an ``error``.
+    """
+    g.request_start_time = time.time()
+    req = parse_request(request.args)
+    if req['format'] == FORMAT_BINARY:
+        raise RequestException("Streamed predictions cannot use the binary "
+                               "format.")
+
+    parts = run_streamed_prediction(req)
+    # (finding the dataset, and the first part, before the response starts)
+    first = next(parts)
+    start_time = g.request_start_time
+
+    def generate():
+        yield json.dumps(first).encode("utf-8") + b"\n"
+        try:
+            for part in parts:
+                yield json.dumps(part).encode("utf-8") + b"\n"
+        except Exception as e:
+            yield json.dumps({"error": _format_exception(e)}).encode("utf-8") \
+                + b"\n"
+        metadata = _format_metadata(start_time, time.time())
+        yield json.dumps({"metadata": metadata}).encode("utf-8") + b"\n"
+
+    response = Response(generate(), mimetype="application/x-ndjson")
+    response.call_on_close(parts.close)
+    return response
+
+
+@app.route('/api/v{0}/cache'.format(API_VERSION), methods=['GET'])
+def cache_stats():
+    """
+    Statistics of the result cache of this process (see
+    :meth:`tawhiri.cache.ResultCache.stats`).
+    """
+    cache = result_cache()
+    return jsonify(cache.stats() if cache is not None else {})
+
+
+@app.route('/api/v{0}/metrics'.format(API_VERSION), methods=['GET'])
+def metrics_endpoint():
+    """
+    Timings and counts of predictions, for Prometheus (see
+    :meth:`tawhiri.metrics.Metrics.format`).
+    """
+    return Response(metrics().format(),
+                    mimetype="text/plain; version=0.0.4")
 
 
 @app.errorhandler(APIException)
@@ -302,20 +924,60 @@ def handle_exception(error):
     Return correct error message and HTTP status code for API exceptions.
     """
     response = {}
-    response['error'] = {
-        "type": type(error).__name__,
-        "description": str(error)
-    }
+    response['error'] = _format_error(error)
     g.request_complete_time = time.time()
     response['metadata'] = _format_request_metadata()
     return jsonify(response), error.status_code
 
 
+def _add_fields(body, **fields):
+    """
+    Add `fields` to the JSON object `body` (:class:`bytes`), without
+    decoding it (or to the header of a binary response).
+    """
+    if body.startswith(BINARY_MAGIC):
+        start = len(BINARY_MAGIC) + 4
+        length, = struct.unpack("<I", body[len(BINARY_MAGIC):start])
+        header = json.loads(body[start:start + length].decode("utf-8"))
+        header.update(fields)
+        return _pack_binary(header, body[start + length:])
+
+    extra = json.dumps(fields).encode("utf-8")
+    if body == b"{}":
+        return extra
+    return body[:-1] + b", " + extra[1:]
+
+
+def _format_error(error):
+    """
+    Format an API exception for inclusion in the response.
+    """
+    return {
+        "type": type(error).__name__,
+        "description": str(error)
+    }
+
+
+def _format_exception(e):
+    """
+    Format any exception raised while running a prediction, like an API
+    exception.
+    """
+    if not isinstance(e, APIException):
+        e = InternalException("Internal exception experienced whilst running "
+                              "the prediction: '%s'." % str(e))
+    return _format_error(e)
+
+
 def _format_request_metadata():
     """
     Format the request metadata for inclusion in the response.
     """
+    return _format_metadata(g.request_start_time, g.request_complete_time)
+
+
+def _format_metadata(start_time, complete_time):
     return {
-        "start_datetime": _timestamp_to_rfc3339(g.request_start_time),
-        "complete_datetime": _timestamp_to_rfc3339(g.request_complete_time),
+        "start_datetime": _timestamp_to_rfc3339(start_time),
+        "complete_datetime": _timestamp_to_rfc3339(complete_time),
     }
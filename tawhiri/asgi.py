@@ -0,0 +1,310 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serve the API from an event loop
+
+Each worker of the Flask app (:data:`tawhiri.api.app`) is busy for the
+whole of each prediction that it runs. :data:`application` is an ASGI
+application which instead handles connections on an asyncio event loop,
+and runs the predictions of the main and batch endpoints in a pool of
+``ASYNC_PROCESSES`` worker processes (default: one per CPU).
+
+Predictions wait for a free worker in a queue for each priority:
+standard predictions first, then floats, and then the predictions of
+batches. ``ASYNC_RESERVED_PROCESSES`` (default 1) of the workers only run
+standard predictions, so that these are never stuck behind long floats.
+If the queue for a request is full (``ASYNC_QUEUE_SIZE`` predictions,
+default 100, or ``ASYNC_BATCH_QUEUE_SIZE``, default 1000, for batches),
+it is refused with status 503 and a ``Retry-After`` of
+``ASYNC_RETRY_AFTER`` seconds (default 10). If a client disconnects, its
+predictions that are still waiting are not run.
+
+Serve it with an ASGI server, e.g.::
+
+    gunicorn -k uvicorn.workers.UvicornWorker tawhiri.asgi:application
+
+Only the main, batch and metrics endpoints are served. Since the
+predictions are run by the worker processes, the metrics are only those
+of the predictions if ``METRICS_DIR`` is set (see
+:func:`tawhiri.api.metrics`).
+"""
+
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import json
+import multiprocessing
+import time
+from urllib.parse import parse_qsl
+
+from tawhiri import api
+
+
+PRIORITY_STANDARD = 0
+PRIORITY_FLOAT = 1
+PRIORITY_BATCH = 2
+
+
+class Scheduler(object):
+    """
+    Run jobs in `executor` (which has `workers` workers), highest priority
+    (lowest number) first, with at most `queue_sizes[priority]` jobs waiting
+    in each priority. Only jobs of :data:`PRIORITY_STANDARD` may use the last
+    `reserved` workers.
+
+    Must be used from the thread running the event loop.
+    """
+
+    def __init__(self, executor, workers, queue_sizes, reserved=0):
+        self.executor = executor
+        self.workers = workers
+        self.queue_sizes = queue_sizes
+        self.reserved = min(reserved, workers - 1)
+
+        self._queues = [collections.deque() for _ in queue_sizes]
+        self._running = 0
+
+    def admit(self, priority, n=1):
+        """Is there room in the queue of `priority` for `n` more jobs?"""
+        waiting = sum(not future.cancelled()
+                      for future, _, _ in self._queues[priority])
+        return waiting + n <= self.queue_sizes[priority]
+
+    def submit(self, priority, fn, *args):
+        """
+        Queue ``fn(*args)``: returns an :class:`asyncio.Future` for its
+        result, or raises :class:`tawhiri.api.ServiceUnavailableException`
+        if the queue is full. (Cancel the future to remove it from the
+        queue.)
+        """
+        if not self.admit(priority):
+            raise api.ServiceUnavailableException(
+                    "Too many predictions are waiting to be run.")
+        future = asyncio.get_running_loop().create_future()
+        self._queues[priority].append((future, fn, args))
+        self._dispatch()
+        return future
+
+    def _dispatch(self):
+        for priority, queue in enumerate(self._queues):
+            limit = self.workers
+            if priority != PRIORITY_STANDARD:
+                limit -= self.reserved
+
+            while queue and self._running < limit:
+                future, fn, args = queue.popleft()
+                if future.cancelled():
+                    continue
+                self._running += 1
+                job = asyncio.wrap_future(self.executor.submit(fn, *args))
+                job.add_done_callback(functools.partial(self._done, future))
+
+    def _done(self, future, job):
+        self._running -= 1
+        if job.cancelled():
+            # (the executor has been shut down)
+            future.cancel()
+        elif not future.cancelled():
+            if job.exception() is not None:
+                future.set_exception(job.exception())
+            else:
+                future.set_result(job.result())
+        self._dispatch()
+
+
+class Application(object):
+    """
+    The ASGI application, configured by `config` (by default,
+    :data:`tawhiri.api.app`'s), and running predictions in `executor` (by
+    default, a pool of ``ASYNC_PROCESSES`` processes, started afresh rather
+    than forked, when first needed).
+    """
+
+    def __init__(self, config=None, executor=None):
+        self.config = config if config is not None else api.app.config
+        self.executor = executor
+        self._scheduler = None
+
+    @property
+    def scheduler(self):
+        if self._scheduler is None:
+            workers = self.config.get('ASYNC_PROCESSES') or \
+                      multiprocessing.cpu_count()
+            if self.executor is None:
+                # (started afresh, like api.batch_pool's, rather than forked
+                # from the event loop's process and its threads)
+                self.executor = concurrent.futures.ProcessPoolExecutor(
+                        workers,
+                        mp_context=multiprocessing.get_context("spawn"),
+                        initializer=api._start_batch_worker,
+                        initargs=(dict(self.config),))
+            queue_size = self.config.get('ASYNC_QUEUE_SIZE', 100)
+            batch_queue_size = self.config.get('ASYNC_BATCH_QUEUE_SIZE', 1000)
+            self._scheduler = Scheduler(
+                    self.executor, workers,
+                    (queue_size, queue_size, batch_queue_size),
+                    self.config.get('ASYNC_RESERVED_PROCESSES', 1))
+        return self._scheduler
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+            return
+        if scope['type'] != 'http':
+            return
+
+        start_time = time.time()
+        root = '/api/v{0}/'.format(api.API_VERSION)
+        try:
+            if scope['path'] == root and scope['method'] == 'GET':
+                await self._main(scope, receive, send, start_time)
+            elif scope['path'] == root + 'batch' and \
+                    scope['method'] == 'POST':
+                await self._batch(receive, send, start_time)
+            elif scope['path'] == root + 'metrics' and \
+                    scope['method'] == 'GET':
+                await _respond(send, 200, b'text/plain; version=0.0.4',
+                               api.metrics().format().encode('utf-8'))
+            else:
+                await self._error(send, api.RequestException(
+                    "Unknown endpoint."), start_time, status=404)
+        except api.APIException as e:
+            await self._error(send, e, start_time)
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                self.scheduler
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                if self.executor is not None:
+                    self.executor.shutdown(wait=False)
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _main(self, scope, receive, send, start_time):
+        query = {}
+        for key, value in parse_qsl(scope['query_string'].decode('latin-1'),
+                                    keep_blank_values=True):
+            query.setdefault(key, value)
+
+        # (the request is parsed by the worker, since that may look up the
+        # launch altitude; an unknown profile fails there)
+        if query.get('profile') == api.PROFILE_FLOAT:
+            priority = PRIORITY_FLOAT
+        else:
+            priority = PRIORITY_STANDARD
+
+        future = self.scheduler.submit(priority, api._run_query_prediction,
+                                       query)
+        disconnected = asyncio.ensure_future(_disconnected(receive))
+        try:
+            await asyncio.wait((future, disconnected),
+                               return_when=asyncio.FIRST_COMPLETED)
+            if not future.done():
+                # (the client has gone, so if the prediction is still
+                # queued, it is not run)
+                return
+            req, body = future.result()
+        except api.APIException:
+            raise
+        except Exception as e:
+            raise api.InternalException(
+                    "Internal exception experienced whilst running the "
+                    "prediction: '%s'." % str(e))
+        finally:
+            future.cancel()
+            disconnected.cancel()
+
+        body = api._add_fields(body, metadata=api._format_metadata(
+                                   start_time, time.time()))
+        if req['format'] == api.FORMAT_BINARY:
+            content_type = b'application/octet-stream'
+        else:
+            content_type = b'application/json'
+        await _respond(send, 200, content_type, body)
+
+    async def _batch(self, receive, send, start_time):
+        body = b''
+        while True:
+            message = await receive()
+            body += message.get('body', b'')
+            if not message.get('more_body'):
+                break
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            data = None
+        reqs, errors = api.parse_batch(data)
+
+        if not self.scheduler.admit(PRIORITY_BATCH, len(reqs)):
+            raise api.ServiceUnavailableException(
+                    "Too many predictions are waiting to be run.")
+        futures = [self.scheduler.submit(PRIORITY_BATCH,
+                                         api._run_batch_prediction, item)
+                   for item in reqs]
+
+        try:
+            await send({'type': 'http.response.start', 'status': 200,
+                        'headers': [(b'content-type',
+                                     b'application/x-ndjson')]})
+            for resp in errors:
+                await _send_body(send, json.dumps(resp).encode('utf-8') +
+                                       b'\n')
+            for future in asyncio.as_completed(futures):
+                await _send_body(send, (await future) + b'\n')
+            await send({'type': 'http.response.body', 'body': b''})
+        finally:
+            # (if the client has gone, the rest of the batch is not run)
+            for future in futures:
+                future.cancel()
+
+    async def _error(self, send, error, start_time, status=None):
+        response = {
+            "error": api._format_error(error),
+            "metadata": api._format_metadata(start_time, time.time()),
+        }
+        headers = []
+        if isinstance(error, api.ServiceUnavailableException):
+            retry_after = self.config.get('ASYNC_RETRY_AFTER', 10)
+            headers.append((b'retry-after', str(retry_after).encode('ascii')))
+        await _respond(send, status or error.status_code, b'application/json',
+                       json.dumps(response).encode('utf-8'), headers)
+
+
+async def _respond(send, status, content_type, body, headers=()):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', content_type)] + list(headers)})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+async def _disconnected(receive):
+    """Wait until the client has disconnected"""
+    while (await receive())['type'] != 'http.disconnect':
+        pass
+
+
+async def _send_body(send, body):
+    await send({'type': 'http.response.body', 'body': body,
+                'more_body': True})
+
+
+#: The ASGI application, configured like :data:`tawhiri.api.app`
+application = Application()
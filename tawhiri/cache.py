@@ -0,0 +1,222 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Cache the responses to prediction requests
+
+Many users ask for the same predictions (e.g., from popular launch sites),
+which, for the same dataset, always have the same result. A
+:class:`ResultCache` keeps the (JSON encoded) responses in memory, and
+optionally in a directory shared by every process of the web server.
+"""
+
+import collections
+import hashlib
+import json
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+import threading
+
+
+logger = logging.getLogger("tawhiri.cache")
+
+
+class ResultCache(object):
+    """
+    A cache of responses, by request and dataset
+
+    Entries are kept in memory, least recently used first, up to `size`
+    bytes in total; and, if `directory` is given, in files in it (in a
+    subdirectory for each dataset), which other processes may share. If
+    `disk_size` is given, the least recently used files (by modification
+    time, which reading a file updates) are removed once those in the
+    directory add up to more than `disk_size` bytes. (Since other processes
+    write to the directory too, its size is only checked after each
+    process has written a tenth of `disk_size`, so may briefly exceed it.)
+
+    Once an entry for a newer dataset is added (i.e., a new dataset has
+    become the latest), the entries for older datasets are dropped.
+    """
+
+    def __init__(self, size, directory=None, disk_size=None):
+        self.size = size
+        self.directory = directory
+        self.disk_size = disk_size
+
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self._newest = None
+        # bytes written to the directory since it was last trimmed (None
+        # until it first is)
+        self._written = None
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(req, ds_time):
+        """
+        The key for a request (as :func:`tawhiri.api.parse_request` returns)
+        that is run with the dataset for `ds_time` (a
+        :class:`datetime.datetime`): a (dataset, digest) pair of strings
+        """
+        # (the dataset that "latest" refers to is part of the key instead)
+        canonical = dict(req)
+        canonical.pop("dataset", None)
+        canonical = json.dumps(canonical, sort_keys=True,
+                               separators=(",", ":"))
+        digest = hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+        return ds_time.strftime("%Y%m%d%H"), digest
+
+    def get(self, key):
+        """The cached response (:class:`bytes`) for `key`, or None"""
+        with self._lock:
+            body = self._entries.get(key)
+            if body is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return body
+
+        body = self._read(key)
+        with self._lock:
+            if body is not None:
+                self.disk_hits += 1
+                self._add(key, body)
+            else:
+                self.misses += 1
+        return body
+
+    def put(self, key, body):
+        """Cache the response `body` (:class:`bytes`) for `key`"""
+        with self._lock:
+            newer = self._newest is None or key[0] > self._newest
+            if newer:
+                self._newest = key[0]
+                for old in [k for k in self._entries if k[0] < key[0]]:
+                    self._bytes -= len(self._entries.pop(old))
+            self._add(key, body)
+
+        if self.directory is not None:
+            if newer:
+                self._remove_older(key[0])
+            self._write(key, body)
+
+            if self.disk_size is not None:
+                with self._lock:
+                    trim = self._written is None or \
+                           self._written + len(body) > self.disk_size // 10
+                    self._written = 0 if trim else self._written + len(body)
+                if trim:
+                    self._trim()
+
+    def stats(self):
+        """Counts of hits (in memory and on disk) and misses, and the size"""
+        with self._lock:
+            return {"hits": self.hits, "disk_hits": self.disk_hits,
+                    "misses": self.misses, "entries": len(self._entries),
+                    "bytes": self._bytes}
+
+    def _add(self, key, body):
+        if len(body) > self.size:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key))
+        self._entries[key] = body
+        self._bytes += len(body)
+        while self._bytes > self.size:
+            _, old = self._entries.popitem(last=False)
+            self._bytes -= len(old)
+
+    def _filename(self, key):
+        return os.path.join(self.directory, key[0], key[1] + ".json")
+
+    def _read(self, key):
+        if self.directory is None:
+            return None
+        fn = self._filename(key)
+        try:
+            with open(fn, "rb") as f:
+                body = f.read()
+        except (IOError, OSError):
+            return None
+        if self.disk_size is not None:
+            # (so that the entries that are used are removed last)
+            try:
+                os.utime(fn)
+            except (IOError, OSError):
+                pass
+        return body
+
+    def _write(self, key, body):
+        # Write to a temporary file and rename it into place, so that
+        # other processes never see a partially written entry
+        fn = self._filename(key)
+        try:
+            os.makedirs(os.path.dirname(fn), exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=os.path.dirname(fn))
+            with os.fdopen(fd, "wb") as f:
+                f.write(body)
+            os.rename(temp, fn)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write %s: %s", fn, e)
+
+    def _remove_older(self, ds):
+        try:
+            names = os.listdir(self.directory)
+        except (IOError, OSError):
+            return
+        for name in names:
+            if name < ds:
+                # (another process may be removing it too)
+                shutil.rmtree(os.path.join(self.directory, name),
+                              ignore_errors=True)
+
+    def _trim(self):
+        """
+        Remove the least recently used files in the directory until they
+        add up to no more than `disk_size` bytes
+        """
+        files = []
+        total = 0
+        for path, _, names in os.walk(self.directory):
+            for name in names:
+                if not name.endswith(".json"):
+                    # (a temporary file, which is about to be renamed)
+                    continue
+                fn = os.path.join(path, name)
+                try:
+                    st = os.stat(fn)
+                except (IOError, OSError):
+                    continue
+                files.append((st.st_mtime, st.st_size, fn))
+                total += st.st_size
+
+        files.sort()
+        for _, size, fn in files:
+            if total <= self.disk_size:
+                break
+            try:
+                os.remove(fn)
+            except (IOError, OSError):
+                # (another process may be removing it too)
+                pass
+            total -= size
@@ -0,0 +1,402 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: cdivision=True
+
+"""
+Convert datasets between formats (see :attr:`tawhiri.dataset.Dataset.layout`
+and :attr:`tawhiri.dataset.Dataset.ELEMENT_INT16`)
+
+Run as ``tawhiri-convert``; see ``tawhiri-convert --help``.
+"""
+
+import os
+import argparse
+import logging
+from datetime import datetime
+
+from array import array
+
+from magicmemoryview import MagicMemoryView
+from cython.view cimport array as cvarray
+from libc.math cimport lround, INFINITY
+
+from .dataset import Dataset
+from .interpolate cimport dataset, tiled_dataset, \
+                          quantized_dataset, quantized_tiled_dataset
+
+
+logger = logging.getLogger("tawhiri.convert")
+
+
+# Quantized values are in [-QUANTIZED_MAX, QUANTIZED_MAX]
+DEF QUANTIZED_MAX = 32767
+
+cdef enum:
+    STANDARD
+    TILED
+    QUANTIZED
+    QUANTIZED_TILED
+
+
+def convert(source, target):
+    """
+    Copy the data in `source` (a standard, float32, global
+    :class:`tawhiri.dataset.Dataset`) into `target` (a new dataset on the
+    same grid, in any format, which may cover only part of the grid; see
+    :attr:`tawhiri.dataset.Dataset.extent`)
+
+    If `source` is on pressure levels and `target` is on altitude levels
+    (:attr:`tawhiri.dataset.Dataset.VERTICAL_ALTITUDE`) but otherwise on
+    the same grid, the wind is interpolated to each altitude, as
+    :mod:`tawhiri.interpolate` would (by finding the pressure levels above
+    and below it at each grid point).
+
+    Padding (where the tiles of a tiled dataset overhang the edge of the
+    grid) is left as is.
+    """
+
+    converter = Converter(source, target)
+    if converter.quantized:
+        converter.run(True)
+    converter.run(False)
+
+
+cdef class Converter:
+    """The state of a :func:`convert`"""
+
+    cdef dataset src
+    cdef int kind
+    cdef readonly bint quantized
+    cdef dataset dst
+    cdef tiled_dataset dst_tiles
+    cdef quantized_dataset dst_q
+    cdef quantized_tiled_dataset dst_qtiles
+    cdef double[:, :, :, :] quantization
+    cdef long n
+
+    # The target's grid, and where it starts in the source's
+    cdef long hours, levels, variables, lats, lngs
+    cdef long start_hour, start_lat, start_lng, src_levels, src_lngs
+
+    # When regridding to altitude levels: the target's altitudes, the
+    # source variable for each target variable, and for the current band
+    # of rows at the current hour, the source level below each target
+    # altitude and the weight of that level (see prepare(...))
+    cdef bint regrid
+    cdef double[:] altitudes
+    cdef long[:] src_variables
+    cdef long[:, :, :] below
+    cdef double[:, :, :] weights
+    cdef long band_start
+
+    def __init__(self, source, target):
+        if source.layout != Dataset.LAYOUT_STANDARD or \
+                source.data_element_type != Dataset.ELEMENT_FLOAT32 or \
+                source.grid_shape != source.shape:
+            raise ValueError("Source dataset must have the standard format")
+        if not source.is_complete():
+            raise ValueError("Source dataset is incomplete")
+
+        if target.vertical == source.vertical:
+            if target.grid != source.grid:
+                raise ValueError("Target dataset must be on the source's grid")
+            self.regrid = False
+        elif target.vertical == Dataset.VERTICAL_ALTITUDE:
+            if any(target.grid[name] != source.grid[name]
+                   for name in ("hour", "latitude", "longitude")) or \
+                    source.axes.variable[0] != "height" or \
+                    not set(target.axes.variable) <= set(source.axes.variable):
+                raise ValueError("Target dataset must be on the source's grid "
+                                 "(apart from its altitude levels)")
+            self.regrid = True
+            self.altitudes = array("d", target.axes.altitude)
+            self.src_variables = array("l", [
+                    source.axes.variable.index(name)
+                    for name in target.axes.variable])
+        else:
+            raise ValueError("Cannot convert from altitude to pressure levels")
+
+        self.src = MagicMemoryView(source.data, source.data_shape, b"f")
+        self.src_levels = source.shape[1]
+        self.src_lngs = source.shape[4]
+
+        self.quantized = target.data_element_type == Dataset.ELEMENT_INT16
+        fmt = b"h" if self.quantized else b"f"
+        view = MagicMemoryView(target.data, target.data_shape, fmt)
+        self.n = 1
+        if target.layout == Dataset.LAYOUT_TILED:
+            self.n = target.header["tile_size"]
+            if self.quantized:
+                self.kind = QUANTIZED_TILED
+                self.dst_qtiles = view
+            else:
+                self.kind = TILED
+                self.dst_tiles = view
+        elif self.quantized:
+            self.kind = QUANTIZED
+            self.dst_q = view
+        else:
+            self.kind = STANDARD
+            self.dst = view
+
+        if self.quantized:
+            self.quantization = MagicMemoryView(target.quantization,
+                                                target.quantization_shape,
+                                                b"d")
+
+        self.hours, self.levels, self.variables, self.lats, self.lngs = \
+                target.grid_shape
+        self.start_hour = target.extent.hour.start
+        self.start_lat = target.extent.latitude.start
+        self.start_lng = target.extent.longitude.start
+
+    def run(self, bint measure):
+        """
+        Write the target; or if `measure` is true, choose the (offset,
+        scale) of each slab of a quantized target so that its values span
+        the range of a quantized value
+        """
+
+        cdef long band, band_start, band_end
+        cdef long hour, level, variable, lat, lng
+        cdef double offset, scale, low, high
+        cdef float value
+
+        # Write the target a band of rows (of tiles) at a time, reading the
+        # source in order within each band; for standard targets the band is
+        # the whole grid, so both are read and written in order (or when
+        # regridding, a few rows, to keep the tables from prepare(...)
+        # small).
+        if self.kind == TILED or self.kind == QUANTIZED_TILED:
+            band = self.n
+        elif self.regrid:
+            band = 16
+        else:
+            band = self.lats
+
+        if self.regrid:
+            self.below = cvarray(shape=(self.levels, band, self.lngs),
+                                 itemsize=sizeof(long), format="l")
+            self.weights = cvarray(shape=(self.levels, band, self.lngs),
+                                   itemsize=sizeof(double), format="d")
+
+        if measure:
+            # (the range of values in each slab, until they are all seen)
+            self.quantization[:, :, :, 0] = INFINITY
+            self.quantization[:, :, :, 1] = -INFINITY
+
+        for band_start in range(0, self.lats, band):
+            band_end = min(band_start + band, self.lats)
+            for hour in range(self.hours):
+                if self.regrid:
+                    self.prepare(hour, band_start, band_end)
+
+                for level in range(self.levels):
+                    for variable in range(self.variables):
+                        if self.quantized:
+                            offset = self.quantization[hour, level,
+                                                       variable, 0]
+                            scale = self.quantization[hour, level,
+                                                      variable, 1]
+                        if measure:
+                            low, high = offset, scale
+
+                        for lat in range(band_start, band_end):
+                            for lng in range(self.lngs):
+                                value = self.read(hour, level, variable,
+                                                  lat, lng)
+                                if measure:
+                                    if value < low:
+                                        low = value
+                                    if value > high:
+                                        high = value
+                                else:
+                                    self.write(hour, level, variable,
+                                               lat, lng, value, offset, scale)
+
+                        if measure:
+                            self.quantization[hour, level, variable, 0] = low
+                            self.quantization[hour, level, variable, 1] = high
+
+        if measure:
+            for hour in range(self.hours):
+                for level in range(self.levels):
+                    for variable in range(self.variables):
+                        low = self.quantization[hour, level, variable, 0]
+                        high = self.quantization[hour, level, variable, 1]
+                        self.quantization[hour, level, variable, 0] = \
+                                (low + high) / 2
+                        self.quantization[hour, level, variable, 1] = \
+                                (high - low) / (2 * QUANTIZED_MAX)
+
+    cdef void prepare(self, long hour, long band_start, long band_end):
+        """
+        Find the source levels either side of each target altitude, for
+        the points in rows band_start..band_end at `hour`
+
+        As in tawhiri.interpolate, the level below an altitude is the
+        highest (excluding the top level) whose height is less than it, and
+        altitudes outside the source's levels are extrapolated.
+        """
+
+        cdef long lat, lng, level, k, src_lat, src_lng
+        cdef long src_hour = self.start_hour + hour
+        cdef long top = self.src_levels - 2
+        cdef double altitude, lower, upper
+
+        self.band_start = band_start
+        for lat in range(band_start, band_end):
+            src_lat = self.start_lat + lat
+            for lng in range(self.lngs):
+                src_lng = (self.start_lng + lng) % self.src_lngs
+                # (the altitudes are in order, so the levels below them are
+                # too)
+                level = 0
+                for k in range(self.levels):
+                    altitude = self.altitudes[k]
+                    while level < top and \
+                            self.src[src_hour, level + 1, 0,
+                                     src_lat, src_lng] < altitude:
+                        level += 1
+                    lower = self.src[src_hour, level, 0, src_lat, src_lng]
+                    upper = self.src[src_hour, level + 1, 0, src_lat, src_lng]
+                    self.below[k, lat - band_start, lng] = level
+                    if lower != upper:
+                        self.weights[k, lat - band_start, lng] = \
+                                (upper - altitude) / (upper - lower)
+                    else:
+                        self.weights[k, lat - band_start, lng] = 0.5
+
+    cdef inline float read(self, long hour, long level, long variable,
+                           long lat, long lng):
+        """The value of the target at a point (in the target's grid)"""
+
+        cdef long src_hour = self.start_hour + hour
+        cdef long src_lat = self.start_lat + lat
+        cdef long src_lng = (self.start_lng + lng) % self.src_lngs
+        cdef long below, src_variable
+        cdef double weight
+
+        if not self.regrid:
+            return self.src[src_hour, level, variable, src_lat, src_lng]
+
+        below = self.below[level, lat - self.band_start, lng]
+        weight = self.weights[level, lat - self.band_start, lng]
+        src_variable = self.src_variables[variable]
+        return self.src[src_hour, below, src_variable,
+                        src_lat, src_lng] * weight + \
+               self.src[src_hour, below + 1, src_variable,
+                        src_lat, src_lng] * (1 - weight)
+
+    cdef inline void write(self, long hour, long level, long variable,
+                           long lat, long lng, float value,
+                           double offset, double scale):
+        cdef long n = self.n
+        cdef short x
+
+        if self.kind == STANDARD:
+            self.dst[hour, level, variable, lat, lng] = value
+        elif self.kind == TILED:
+            self.dst_tiles[lat / n, lng / n, hour, level,
+                           variable, lat % n, lng % n] = value
+        else:
+            x = quantize(value, offset, scale)
+            if self.kind == QUANTIZED:
+                self.dst_q[hour, level, variable, lat, lng] = x
+            else:
+                self.dst_qtiles[lat / n, lng / n, hour, level,
+                                variable, lat % n, lng % n] = x
+
+
+cdef inline short quantize(float value, double offset, double scale):
+    if scale == 0:
+        return 0
+    return <short> lround((value - offset) / scale)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Convert a wind dataset to another format")
+    parser.add_argument("ds_time",
+            type=lambda s: datetime.strptime(s, "%Y%m%d%H"),
+            help="forecast time of the dataset (YYYYMMDDHH)")
+    parser.add_argument("-d", "--directory", default=Dataset.DEFAULT_DIRECTORY,
+            help="directory containing the dataset (default: %(default)s)")
+    parser.add_argument("-o", "--output-directory",
+            help="directory to write the converted dataset to (default: "
+                 "replace the dataset in --directory)")
+    parser.add_argument("-l", "--layout", default=Dataset.LAYOUT_TILED,
+            choices=(Dataset.LAYOUT_STANDARD, Dataset.LAYOUT_TILED),
+            help="layout of the converted dataset (default: %(default)s)")
+    parser.add_argument("-n", "--tile-size", type=int,
+            default=Dataset.DEFAULT_TILE_SIZE,
+            help="tile size in grid points (default: %(default)s)")
+    parser.add_argument("-q", "--quantize", action="store_true",
+            help="store 16 bit integers rather than 32 bit floats")
+    parser.add_argument("-r", "--region", type=float, nargs=4,
+            metavar=("SOUTH", "NORTH", "WEST", "EAST"),
+            help="only keep this region (degrees north and east; WEST may "
+                 "be greater than EAST if the region crosses the meridian)")
+    parser.add_argument("--hours", type=float, nargs=2,
+            metavar=("FIRST", "LAST"),
+            help="only keep these hours of the forecast")
+    parser.add_argument("-a", "--altitude", type=float, nargs=3,
+            metavar=("START", "STEP", "COUNT"),
+            help="interpolate the wind to COUNT altitude levels, STEP metres "
+                 "apart, from START metres above sea level")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    output_directory = args.output_directory or args.directory
+    source = Dataset(args.ds_time, directory=args.directory)
+
+    header = {"layout": args.layout, "grid": source.grid}
+    if args.altitude is not None:
+        start, step, count = args.altitude
+        grid = dict(source.grid, variable=["wind_u", "wind_v"],
+                    altitude={"start": start, "step": step,
+                              "count": int(count)})
+        del grid[Dataset.VERTICAL_PRESSURE]
+        header["grid"] = grid
+    if args.layout == Dataset.LAYOUT_TILED:
+        header["tile_size"] = args.tile_size
+    if args.quantize:
+        header["element_type"] = Dataset.ELEMENT_INT16
+    if args.region is not None or args.hours is not None:
+        south, north, west, east = args.region or (-90, 90, 0, 360)
+        header["extent"] = Dataset.region_extent((south, north), (west, east),
+                                                 args.hours, source.axes)
+
+    # Convert to a temporary file, and rename it into place when done, so
+    # that the predictor never sees a partially written dataset
+    target = Dataset(args.ds_time, directory=output_directory, new=True,
+                     suffix=".temp", header=header)
+    convert(source, target)
+    target.array.flush()
+    source.close()
+    target.close()
+
+    final = Dataset.filename(args.ds_time, directory=output_directory)
+    os.rename(target.fn, final)
+    logger.info("Wrote %s", final)
@@ -27,17 +27,54 @@ directory, and can open (& create) dataset files.
 Note: once opened, the dataset is mmaped as :attr:`Dataset.array`, which by
 itself is not particularly useful.  :mod:`tawhiri.interpolate` casts it (via a
 memory view) to a pointer in Cython.
+
+Datasets are normally a bare array of ``float32``s in the order given by
+:attr:`Dataset.shape`. Datasets in other formats (see :attr:`Dataset.layout`)
+start with a header: :attr:`Dataset.HEADER_MAGIC`, the size of the header and
+of the JSON that follows, and then a JSON object describing the format,
+padded to a multiple of :attr:`Dataset.HEADER_ALIGN` bytes. The array follows
+the header.
+
+The header also describes the grid (see :attr:`Dataset.grid`), so datasets
+need not have the resolution or length of :attr:`Dataset.axes`, and may be
+on altitude rather than pressure levels (see
+:attr:`Dataset.VERTICAL_ALTITUDE`).
+
+Quantized datasets (see :attr:`Dataset.ELEMENT_INT16`) store each value as a
+16 bit integer, with an offset and scale per (hour, pressure, variable) slab.
+The table of offsets and scales is the last part of the header, immediately
+before the array.
+
+Datasets that are written an hour at a time may have a completeness map
+(see :meth:`Dataset.is_complete`): a byte for each hour, which is set once
+all of that hour's data has been written, so that the dataset can be used
+before it is finished. It precedes the table of offsets and scales (if
+any).
 """
 
 from collections import namedtuple
+from concurrent.futures import Future
+import bisect
+import collections
+import contextlib
+import ctypes
+import ctypes.util
+import json
+import math
 import mmap
 import os
 import os.path
-import signal
+import struct
 import operator
+import threading
+import time
+import warnings
+import weakref
 from datetime import datetime
 import logging
 
+from . import residency
+
 logger = logging.getLogger("tawhiri.dataset")
 
 
@@ -56,6 +93,57 @@ class Dataset(object):
 
         The forecast time of this dataset (:class:`datetime.datetime`).
 
+    .. attribute:: layout
+
+        How the array is laid out: :attr:`LAYOUT_STANDARD` or
+        :attr:`LAYOUT_TILED`.
+
+    .. attribute:: header
+
+        The header (a :class:`dict`) describing the format of the dataset;
+        :attr:`default_header` if the file has no header.
+
+    .. attribute:: grid
+
+        The grid that the dataset's data is on: a dict with an entry for
+        each axis (see :attr:`axes`). ``hour``, ``latitude`` and
+        ``longitude`` are evenly spaced: ``{"start": ..., "step": ...,
+        "count": ...}``; ``pressure`` and ``variable`` are lists of values.
+        Instead of ``pressure``, the grid may have an ``altitude`` axis
+        (see :attr:`VERTICAL_ALTITUDE`), which is either evenly spaced or a
+        list of increasing values.
+        :attr:`default_grid` if the header does not say otherwise.
+
+    .. attribute:: vertical
+
+        The vertical axis of the grid: :attr:`VERTICAL_PRESSURE` or
+        :attr:`VERTICAL_ALTITUDE`.
+
+        The attributes :attr:`shape` and :attr:`axes` of an instance
+        describe its grid (rather than the default grid).
+
+    .. attribute:: extent
+
+        The part of the grid (:attr:`axes`) covered by the dataset:
+        a 3-(named)tuple ``(hour, latitude, longitude)`` of ranges of
+        indices. If the grid goes all the way around the world, longitude
+        indices wrap around at ``shape[4]``.
+
+    .. attribute:: grid_shape
+
+        The dimensions of the part of the grid covered by the dataset:
+        :attr:`shape`, unless the dataset is a regional subset (see
+        :attr:`extent`).
+
+    .. attribute:: data_shape
+
+        The dimensions of :attr:`data`
+
+    .. attribute:: data_element_type
+
+        The type of the elements of :attr:`data`: :attr:`element_type`,
+        unless the dataset is quantized.
+
     """
 
     #: The dimensions of the dataset
@@ -80,6 +168,8 @@ class Dataset(object):
 
     _axes_type = namedtuple("axes",
                 ("hour", "pressure", "variable", "latitude", "longitude"))
+    _altitude_axes_type = namedtuple("axes",
+                ("hour", "altitude", "variable", "latitude", "longitude"))
 
     #: The values of the points on each axis: a 5-(named)tuple ``(hour,
     #: pressure variable, latitude, longitude)``.
@@ -94,17 +184,39 @@ class Dataset(object):
         [x/2.0 for x in range(0, 720)]
     )
 
+    _extent_type = namedtuple("extent", ("hour", "latitude", "longitude"))
+
     _listdir_type = namedtuple("dataset_in_row",
                 ("ds_time", "suffix", "filename", "path"))
 
     assert shape == tuple(len(x) for x in axes)
 
+    #: The grid of :attr:`axes`, as described in a header (see :attr:`grid`)
+    default_grid = {
+        "hour": {"start": 0, "step": 3, "count": 65},
+        "pressure": list(axes.pressure),
+        "variable": list(axes.variable),
+        "latitude": {"start": -90.0, "step": 0.5, "count": 361},
+        "longitude": {"start": 0.0, "step": 0.5, "count": 720},
+    }
+
+    #: Vertical axis: pressure levels, at which the height (in metres above
+    #: sea level) is the first variable (``axes.pressure``; see
+    #: :attr:`axes`)
+    VERTICAL_PRESSURE = "pressure"
+    #: Vertical axis: fixed altitudes, in metres above sea level
+    #: (``axes.altitude``), with variables ``wind_u`` and ``wind_v``.
+    #: Interpolating in such a dataset does not need to search for the
+    #: altitude. See :func:`tawhiri.convert.convert`.
+    VERTICAL_ALTITUDE = "altitude"
+
     #: The data type of dataset elements
     element_type = 'float32'
     #: The size in bytes of `element_type`
     element_size = 4    # float32
 
-    #: The size in bytes of the entire dataset
+    #: The size in bytes of the entire dataset (with the default grid and
+    #: format)
     size = element_size
     for _x in shape:
         size *= _x
@@ -116,6 +228,41 @@ class Dataset(object):
     #: The default location of wind data
     DEFAULT_DIRECTORY = '/srv/tawhiri-datasets'
 
+    #: Datasets with a header start with these bytes
+    HEADER_MAGIC = b"TAWHIRI\0"
+    #: The header is padded to a multiple of this many bytes (so that the
+    #: array is page aligned)
+    HEADER_ALIGN = 4096
+    _header_struct = struct.Struct("<8sII")
+
+    #: Layout: an array with dimensions :attr:`shape`
+    LAYOUT_STANDARD = "standard"
+    #: Layout: the latitude and longitude axes are split into square tiles
+    #: of ``tile_size`` points, and the array has dimensions
+    #: ``(lat tile, lng tile, hour, pressure, variable, lat, lng)``, so that
+    #: all the data for a tile, for all levels and variables and adjacent
+    #: hours, is contiguous. See :func:`tawhiri.convert.convert`.
+    LAYOUT_TILED = "tiled"
+    #: The default ``tile_size`` for :attr:`LAYOUT_TILED`
+    DEFAULT_TILE_SIZE = 4
+
+    #: Element type: 32 bit floats
+    ELEMENT_FLOAT32 = "float32"
+    #: Element type: 16 bit integers, which are mapped to values by
+    #: ``offset + scale * x`` with an ``(offset, scale)`` pair (see
+    #: :attr:`quantization`) for each (hour, pressure, variable) slab.
+    #: Halves the size of the dataset, losing about 1m of resolution in
+    #: height and 0.005m/s in wind speed.
+    #: See :func:`tawhiri.convert.convert`.
+    ELEMENT_INT16 = "int16"
+    _element_sizes = {ELEMENT_FLOAT32: 4, ELEMENT_INT16: 2}
+    _quantization_element_size = 8  # float64
+
+    #: The header of a dataset without one
+    default_header = {"layout": LAYOUT_STANDARD,
+                      "element_type": ELEMENT_FLOAT32,
+                      "grid": default_grid}
+
     @classmethod
     def filename(cls, ds_time, directory=DEFAULT_DIRECTORY, suffix=''):
         """
@@ -168,52 +315,45 @@ class Dataset(object):
                 yield cls._listdir_type(ds_time, suffix, filename,
                                         os.path.join(directory, filename))
 
-    cached_latest = None
+    # All open datasets (see open_datasets)
+    _open = weakref.WeakSet()
 
-    # prune_latest is registered as the signal handler for SIGALRM at the
-    # bottom of the file.
     @classmethod
-    def prune_latest(cls, signum, stack_frame):
-        cls.cached_latest = None
-
-    @classmethod
-    def open_latest(cls, directory=DEFAULT_DIRECTORY, persistent=False):
+    def open_latest(cls, directory=DEFAULT_DIRECTORY, persistent=False,
+                    residency=None):
         """
         Find the most recent datset in `directory`, and open it
 
+        To keep datasets open and re-use them, use a
+        :class:`DatasetRegistry`, which knows when they are no longer in
+        use.
+
         :type directory: string
         :param directory: directory to search
         :type persistent: bool
-        :param persistent: should the latest dataset be cached, and re-used?
+        :param persistent: deprecated, and ignored (the dataset that was
+                           re-used could be dropped while still in use)
+        :type residency: dict
+        :param residency: if not ``None``, call :meth:`manage_residency`
+                          with these arguments
         :rtype: :class:`Dataset`
         """
 
+        if persistent:
+            warnings.warn("open_latest(persistent=True) is deprecated; "
+                          "use a DatasetRegistry", DeprecationWarning,
+                          stacklevel=2)
+
         datasets = Dataset.listdir(directory, only_suffices=('', ))
         latest = sorted(datasets, reverse=True)[0].ds_time
 
-        cached = cls.cached_latest
-        valid = cached and \
-                cached.ds_time == latest and \
-                cached.directory == directory
+        ds = Dataset(latest, directory=directory)
+        if residency is not None:
+            ds.manage_residency(**residency)
+        return ds
 
-        if valid:
-            if persistent:
-                # Refresh countdown
-                signal.alarm(60)
-
-            return cls.cached_latest
-        else:
-            ds = Dataset(latest, directory=directory)
-
-            if persistent:
-                # Start the countdown
-                signal.alarm(60)
-                # note, this creates a ref cycle.
-                cls.cached_latest = ds
-
-            return ds
-
-    def __init__(self, ds_time, directory=DEFAULT_DIRECTORY, new=False):
+    def __init__(self, ds_time, directory=DEFAULT_DIRECTORY, new=False,
+                 suffix='', header=None, writable=False):
         """
         Open the dataset file for `ds_time`, in `directory`
 
@@ -225,13 +365,25 @@ class Dataset(object):
         :param new: should a new (blank) dataset be created (overwriting
                     any file that happened to already be there), or should
                     an existing dataset be opened?
+        :type suffix: string
+        :param suffix: filename suffix (see :meth:`filename`)
+        :type header: dict
+        :param header: when creating a dataset, the format of the new
+                       dataset, e.g., ``{"layout": "tiled",
+                       "element_type": "int16"}`` (see
+                       :attr:`default_header`). The default is the
+                       standard (header-less) format.
+        :type writable: bool
+        :param writable: should an existing dataset be opened for writing?
+                         (New datasets always are.)
         """
 
         self.directory = directory
         self.ds_time = ds_time
         self.new = new
 
-        self.fn = self.filename(self.ds_time, directory=self.directory)
+        self.fn = self.filename(self.ds_time, directory=self.directory,
+                                suffix=suffix)
 
         prot = mmap.PROT_READ
         flags = mmap.MAP_SHARED
@@ -240,6 +392,10 @@ class Dataset(object):
             mode = "w+b"
             prot |= mmap.PROT_WRITE
             msg = "truncate and write"
+        elif writable:
+            mode = "r+b"
+            prot |= mmap.PROT_WRITE
+            msg = "write"
         else:
             mode = "rb"
             msg = "read"
@@ -248,18 +404,532 @@ class Dataset(object):
 
         with open(self.fn, mode) as f:
             if new:
-                f.seek(self.size - 1)
+                self._set_header(header)
+                header_bytes = self._pack_header()
+                f.seek(self.data_offset + self.data_size - 1)
                 f.write(b"\0")
+                f.seek(0, 0)
+                f.write(header_bytes)
             else:
+                self._set_header(*self._read_header(f))
                 f.seek(0, 2)
                 sz = f.tell()
-                if sz != self.size:
+                expect = self.data_offset + self.data_size
+                if sz != expect:
                     raise ValueError("Dataset should be {0} bytes (was {1})"
-                                        .format(self.size, sz))
+                                        .format(expect, sz))
             f.seek(0, 0)
 
             self.array = mmap.mmap(f.fileno(), 0, prot=prot, flags=flags)
 
+        self._open.add(self)
+
+    def _set_header(self, header, data_offset=None):
+        """
+        Set :attr:`header` and the attributes that depend on it
+
+        `data_offset` is the size of the header (read from an existing
+        dataset) or ``None`` to work it out.
+        """
+
+        if header is None:
+            header = self.default_header
+        header = dict(header)
+        header.setdefault("layout", self.LAYOUT_STANDARD)
+        header.setdefault("element_type", self.ELEMENT_FLOAT32)
+        header.setdefault("grid", self.default_grid)
+
+        axes = self._parse_grid(header["grid"])
+        shape = tuple(len(x) for x in axes)
+        extent = self._parse_extent(header.get("extent"), axes)
+        grid_shape = (len(extent.hour), shape[1], shape[2],
+                      len(extent.latitude), len(extent.longitude))
+
+        if header["layout"] == self.LAYOUT_STANDARD:
+            data_shape = grid_shape
+        elif header["layout"] == self.LAYOUT_TILED:
+            header.setdefault("tile_size", self.DEFAULT_TILE_SIZE)
+            n = int(header["tile_size"])
+            if n < 1:
+                raise ValueError("Bad tile size {0}".format(n))
+            hours, pressures, variables, lats, lngs = grid_shape
+            data_shape = (-(-lats // n), -(-lngs // n),
+                          hours, pressures, variables, n, n)
+        else:
+            raise ValueError("Unknown layout {0!r}".format(header["layout"]))
+
+        element_type = header["element_type"]
+        if element_type not in self._element_sizes:
+            raise ValueError("Unknown element type {0!r}".format(element_type))
+
+        data_size = self._element_sizes[element_type]
+        for x in data_shape:
+            data_size *= x
+
+        if element_type == self.ELEMENT_INT16:
+            quantization_shape = grid_shape[:3] + (2, )
+            quantization_size = self._quantization_element_size
+            for x in quantization_shape:
+                quantization_size *= x
+        else:
+            quantization_shape = None
+            quantization_size = 0
+
+        if header.get("completeness"):
+            completeness_size = grid_shape[0]
+        else:
+            completeness_size = 0
+
+        if data_offset is None:
+            if header == self.default_header:
+                data_offset = 0
+            else:
+                json_size = len(json.dumps(header).encode("utf-8"))
+                data_offset = self._header_struct.size + json_size + \
+                              completeness_size + quantization_size
+                data_offset += -data_offset % self.HEADER_ALIGN
+
+        self.header = header
+        self.layout = header["layout"]
+        self.grid = header["grid"]
+        self.vertical = axes._fields[1]
+        self.axes = axes
+        self.shape = shape
+        self.extent = extent
+        self.grid_shape = grid_shape
+        self.data_element_type = element_type
+        self.data_shape = data_shape
+        self.data_size = data_size
+        self.data_offset = data_offset
+        self.quantization_shape = quantization_shape
+        self.quantization_size = quantization_size
+        self.completeness_size = completeness_size
+
+    @classmethod
+    def expected_size(cls, path):
+        """
+        The size in bytes that the dataset file at `path` should be,
+        according to its header
+
+        Raises :exc:`ValueError` if the header is invalid.
+        """
+
+        with open(path, "rb") as f:
+            probe = cls._probe(f)
+        return probe.data_offset + probe.data_size
+
+    @classmethod
+    def file_is_complete(cls, path, first=None, last=None):
+        """
+        As :meth:`is_complete`, for the dataset file at `path`, which is not
+        opened: only its header and completeness map are read
+        """
+
+        with open(path, "rb") as f:
+            probe = cls._probe(f)
+            if not probe.completeness_size:
+                return True
+            end = probe.data_offset - probe.quantization_size
+            f.seek(end - probe.completeness_size)
+            completeness = f.read(probe.completeness_size)
+
+        start, stop = probe._hour_indices(first, last)
+        return all(completeness[start:stop])
+
+    @classmethod
+    def _probe(cls, f):
+        """An unopened Dataset, just to interpret the header of `f`"""
+        header, data_offset = cls._read_header(f)
+        probe = cls.__new__(cls)
+        probe._set_header(header, data_offset)
+        return probe
+
+    @classmethod
+    def _parse_grid(cls, grid):
+        """
+        Check the ``grid`` of a header (see :attr:`grid`), and return its
+        :attr:`axes`
+        """
+
+        if grid == cls.default_grid:
+            return cls.axes
+
+        if cls.VERTICAL_ALTITUDE in grid:
+            axes_type = cls._altitude_axes_type
+        else:
+            axes_type = cls._axes_type
+
+        try:
+            axes = {}
+            for name in axes_type._fields:
+                axis = grid[name]
+                if name in ("pressure", "variable") or \
+                        (name == "altitude" and isinstance(axis, list)):
+                    values = list(axis)
+                    valid = len(values) >= 2
+                else:
+                    start, step, count = \
+                            axis["start"], axis["step"], int(axis["count"])
+                    values = [start + i * step for i in range(count)]
+                    valid = count >= 2 and step > 0
+                if name == "latitude":
+                    valid = valid and -90 <= values[0] and values[-1] <= 90
+                elif name == "longitude":
+                    valid = valid and values[-1] - values[0] < 360
+                elif name == "altitude":
+                    valid = valid and all(a < b for a, b in
+                                          zip(values, values[1:]))
+                if not valid:
+                    raise ValueError("Bad {0} axis {1!r}".format(name, axis))
+                axes[name] = values
+        except (KeyError, TypeError) as e:
+            raise ValueError("Bad grid {0!r} ({1!r})".format(grid, e))
+
+        return axes_type(**axes)
+
+    @staticmethod
+    def _wraps(axes):
+        """Does the longitude axis go all the way around the world?"""
+        lngs = axes.longitude
+        step = lngs[1] - lngs[0]
+        return abs(lngs[-1] + step - lngs[0] - 360) < step / 1000
+
+    @classmethod
+    def _parse_extent(cls, extent, axes=None):
+        """
+        Check the ``extent`` of a header, which is ``None`` (the whole grid)
+        or a dict of ``[start, stop]`` pairs of indices into `axes` (default:
+        :attr:`axes`), and return it as a tuple of ranges (see
+        :attr:`extent`)
+        """
+
+        if extent is None:
+            extent = {}
+        if axes is None:
+            axes = cls.axes
+
+        ranges = []
+        for name in cls._extent_type._fields:
+            size = len(getattr(axes, name))
+            start, stop = extent.get(name, (0, size))
+            if name == "longitude" and cls._wraps(axes):
+                valid = 0 <= start < size and start < stop <= start + size
+            else:
+                valid = 0 <= start < stop <= size
+            if not valid:
+                raise ValueError("Bad {0} extent {1}".format(name,
+                                                             (start, stop)))
+            ranges.append(range(start, stop))
+
+        return cls._extent_type(*ranges)
+
+    @classmethod
+    def region_extent(cls, lat_range, lng_range, hour_range=None, axes=None):
+        """
+        The ``extent`` (for the header of a new dataset) of the smallest part
+        of the grid (`axes`, default: :attr:`axes`) that contains a region
+
+        :type lat_range: tuple
+        :param lat_range: ``(south, north)``, in degrees
+        :type lng_range: tuple
+        :param lng_range: ``(west, east)``, in degrees east, 0 to 360; `west`
+                          may be greater than `east` if the region crosses
+                          the meridian
+        :type hour_range: tuple
+        :param hour_range: ``(first, last)`` hours of the forecast, or
+                           ``None`` for all of them
+        :rtype: dict
+        """
+
+        def index(axis, value, rounding):
+            left, step = axis[0], axis[1] - axis[0]
+            return int(rounding((value - left) / step))
+
+        if axes is None:
+            axes = cls.axes
+        hours, lats, lngs = axes.hour, axes.latitude, axes.longitude
+
+        south, north = lat_range
+        lat = [max(index(lats, south, math.floor), 0),
+               min(index(lats, north, math.ceil) + 1, len(lats))]
+
+        west, east = lng_range
+        if not cls._wraps(axes):
+            lng = [max(index(lngs, west, math.floor), 0),
+                   min(index(lngs, east, math.ceil) + 1, len(lngs))]
+        else:
+            if east < west:
+                east += 360
+            start = index(lngs, west, math.floor)
+            width = index(lngs, east, math.ceil) + 1 - start
+            if width >= len(lngs):
+                lng = [0, len(lngs)]
+            else:
+                start %= len(lngs)
+                lng = [start, start + width]
+
+        extent = {"latitude": lat, "longitude": lng}
+
+        if hour_range is not None:
+            first, last = hour_range
+            extent["hour"] = [max(index(hours, first, math.floor), 0),
+                              min(index(hours, last, math.ceil) + 1,
+                                  len(hours))]
+
+        return extent
+
+    def _pack_header(self):
+        """The bytes of the header (empty, for the standard format)"""
+
+        if self.data_offset == 0:
+            return b""
+
+        header_json = json.dumps(self.header).encode("utf-8")
+        return self._header_struct.pack(self.HEADER_MAGIC, self.data_offset,
+                                        len(header_json)) + header_json
+
+    @classmethod
+    def _read_header(cls, f):
+        """
+        Read the header from the start of `f`
+
+        Returns ``(header, data offset)``, or ``(None, 0)`` if it has none.
+        """
+
+        f.seek(0, 0)
+        start = f.read(cls._header_struct.size)
+        if not start.startswith(cls.HEADER_MAGIC):
+            return None, 0
+
+        magic, data_offset, json_size = cls._header_struct.unpack(start)
+        header = json.loads(f.read(json_size).decode("utf-8"))
+        return header, data_offset
+
+    @property
+    def data(self):
+        """
+        A :class:`memoryview` of the array (i.e., :attr:`array`, excluding
+        any header), which has dimensions :attr:`data_shape`
+        """
+
+        view = memoryview(self.array)
+        return view[self.data_offset:self.data_offset + self.data_size]
+
+    @property
+    def quantization(self):
+        """
+        For quantized datasets, a :class:`memoryview` of the table of
+        ``float64`` ``(offset, scale)`` pairs, which has dimensions
+        ``(hour, pressure, variable, 2)``; otherwise ``None``
+        """
+
+        if not self.quantization_size:
+            return None
+
+        view = memoryview(self.array)
+        return view[self.data_offset - self.quantization_size:
+                    self.data_offset]
+
+    @property
+    def completeness(self):
+        """
+        For datasets with a completeness map (see :meth:`is_complete`), a
+        :class:`memoryview` of it: a byte for each hour of the dataset,
+        which is non-zero once that hour's data has been written;
+        otherwise ``None``
+        """
+
+        if not self.completeness_size:
+            return None
+
+        view = memoryview(self.array)
+        end = self.data_offset - self.quantization_size
+        return view[end - self.completeness_size:end]
+
+    def is_complete(self, first=None, last=None):
+        """
+        Has all of the data for hours `first` to `last` (see
+        :meth:`hour_ranges`) been written?
+
+        Datasets are created with a completeness map if their header has
+        ``"completeness": true`` (see :func:`tawhiri.ingest.ingest`);
+        hours are then incomplete until :meth:`mark_complete` is called.
+        Datasets without one are always complete.
+        """
+
+        completeness = self.completeness
+        if completeness is None:
+            return True
+
+        start, stop = self._hour_indices(first, last)
+        return all(completeness[start:stop])
+
+    def mark_complete(self, index):
+        """
+        Record that the data for the hour at `index` in :attr:`extent`
+        (of a dataset with a completeness map) has been written
+        """
+
+        self.completeness[index] = 1
+
+    @classmethod
+    def open_datasets(cls):
+        """The datasets that are currently open in this process"""
+        return list(cls._open)
+
+    def hour_ranges(self, first=None, last=None):
+        """
+        The parts of :attr:`array` that contain the data for some hours
+
+        ... i.e., that are needed to interpolate at times from `first` to
+        `last` hours into the forecast (default: all of them).
+
+        :rtype: list of ``(offset, length)`` pairs, in bytes
+        """
+
+        start, stop = self._hour_indices(first, last)
+        if start >= stop:
+            return []
+
+        if self.layout == self.LAYOUT_STANDARD:
+            hour_size = self.data_size // self.data_shape[0]
+            return [(self.data_offset + start * hour_size,
+                     (stop - start) * hour_size)]
+        else:
+            # each tile holds all of the hours, one after another
+            tiles = self.data_shape[0] * self.data_shape[1]
+            tile_size = self.data_size // tiles
+            hour_size = tile_size // self.data_shape[2]
+            return [(self.data_offset + i * tile_size + start * hour_size,
+                     (stop - start) * hour_size)
+                    for i in range(tiles)]
+
+    def _hour_indices(self, first, last):
+        """
+        The range ``(start, stop)`` of the indices (in :attr:`extent`) of
+        the hours needed to interpolate at times from `first` to `last`
+        """
+
+        hours = [self.axes.hour[i] for i in self.extent.hour]
+        step = self.axes.hour[1] - self.axes.hour[0]
+        start, stop = 0, len(hours)
+        if first is not None:
+            start = max(int(math.floor((first - hours[0]) / step)), start)
+        if last is not None:
+            stop = min(int(math.ceil((last - hours[0]) / step)) + 1, stop)
+        return start, stop
+
+    def advise(self, *advice):
+        """
+        Tell the kernel how the dataset will be used
+
+        :param advice: names of hints, e.g. ``"random"`` (see
+                       :data:`tawhiri.residency.advice_names`)
+        """
+
+        for a in advice:
+            residency.advise(self.array, a, self.data_offset, self.data_size)
+
+    def lock(self, first=None, last=None):
+        """
+        Lock the data for hours `first` to `last` (see :meth:`hour_ranges`)
+        into RAM
+
+        The pages are unlocked when the dataset is unmapped. Raises
+        :exc:`OSError` if they cannot be locked (e.g., because of
+        ``RLIMIT_MEMLOCK``).
+        """
+
+        for offset, length in self.hour_ranges(first, last):
+            residency.lock(self.array, offset, length)
+
+    def prewarm(self, first=None, last=None, background=True):
+        """
+        Read the data for hours `first` to `last` (see :meth:`hour_ranges`)
+        into the page cache
+
+        :type background: bool
+        :param background: if true, read in a (daemon) thread, and return
+                           it (:class:`threading.Thread`)
+        """
+
+        array = self.array
+        ranges = self.hour_ranges(first, last)
+
+        def run():
+            logger.info("Prewarming dataset %s %s", self.ds_time, self.fn)
+            chunk = 64 * 1024 * 1024
+            for offset, length in ranges:
+                for start in range(offset, offset + length, chunk):
+                    n = min(chunk, offset + length - start)
+                    residency.advise(array, "willneed", start, n)
+                    residency.touch(array, start, n)
+            logger.info("Prewarmed dataset %s %s", self.ds_time, self.fn)
+
+        if background:
+            thread = threading.Thread(target=run, daemon=True,
+                                      name="prewarm {0}".format(self.fn))
+            thread.start()
+            return thread
+        else:
+            run()
+
+    def manage_residency(self, advice=(), lock_hours=None, prewarm=False):
+        """
+        Apply :meth:`advise`, :meth:`lock` and :meth:`prewarm`
+
+        Failing to lock the dataset is logged, rather than raised.
+
+        :type advice: list
+        :param advice: names of hints for :meth:`advise`
+        :type lock_hours: tuple
+        :param lock_hours: if not ``None``, ``(first, last)``: the hours
+                           to :meth:`lock`
+        :type prewarm: bool
+        :param prewarm: start prewarming the dataset in the background?
+        """
+
+        self.advise(*advice)
+        if lock_hours is not None:
+            try:
+                self.lock(*lock_hours)
+            except OSError as e:
+                logger.warning("Could not lock dataset %s %s: %s",
+                               self.ds_time, self.fn, e)
+        if prewarm:
+            self.prewarm()
+
+    def residency_report(self):
+        """
+        Report how much of the dataset is in RAM (in the page cache)
+
+        Returns a dict: ``size`` and ``resident``, in bytes, and ``hours``,
+        a list of the fraction of the data for each hour of the dataset
+        that is resident.
+        """
+
+        page = residency.PAGE_SIZE
+        vec = residency.resident(self.array)
+
+        def pages(offset, length):
+            return range(offset // page, (offset + length + page - 1) // page)
+
+        data = pages(self.data_offset, self.data_size)
+        hours = []
+        for i in self.extent.hour:
+            hour = self.axes.hour[i]
+            total = present = 0
+            for offset, length in self.hour_ranges(hour, hour):
+                r = pages(offset, length)
+                total += len(r)
+                present += vec[r.start:r.stop].count(1)
+            hours.append(present / total)
+
+        return {"size": self.data_size,
+                "resident": min(vec[data.start:data.stop].count(1) * page,
+                                self.data_size),
+                "hours": hours}
+
     def __del__(self):
         self.close()
 
@@ -277,6 +947,448 @@ class Dataset(object):
         if hasattr(self, 'array'):
             logger.info("Closing dataset %s %s", self.ds_time, self.fn)
             del self.array
+            self._open.discard(self)
+
+
+class _DirectoryWatch(object):
+    """
+    Watch a directory for changes with inotify (Linux only; through
+    :mod:`ctypes`, so that nothing needs to be compiled for it)
+
+    Raises :exc:`OSError` if inotify is not available.
+    """
+
+    # (from <sys/inotify.h>)
+    IN_MODIFY = 0x2
+    IN_ATTRIB = 0x4
+    IN_CLOSE_WRITE = 0x8
+    IN_MOVED_FROM = 0x40
+    IN_MOVED_TO = 0x80
+    IN_CREATE = 0x100
+    IN_DELETE = 0x200
+    IN_DELETE_SELF = 0x400
+    IN_MOVE_SELF = 0x800
+    IN_Q_OVERFLOW = 0x4000
+    IN_NONBLOCK = os.O_NONBLOCK
+    IN_CLOEXEC = os.O_CLOEXEC
+
+    # Events that add, remove or rename files (so that the directory must
+    # be rescanned); the others may change the size of a file
+    MOVES = IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | \
+            IN_DELETE_SELF | IN_MOVE_SELF | IN_Q_OVERFLOW
+
+    _event_struct = struct.Struct("iIII")
+
+    def __init__(self, directory):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+            init, add_watch = libc.inotify_init1, libc.inotify_add_watch
+        except (OSError, AttributeError):
+            raise OSError("inotify is not available")
+
+        self.fd = init(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.MOVES | self.IN_MODIFY | self.IN_ATTRIB | \
+               self.IN_CLOSE_WRITE
+        if add_watch(self.fd, os.fsencode(directory), mask) < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), directory)
+        # (after a fork, the events would be shared with the parent)
+        self.pid = os.getpid()
+
+    def changes(self):
+        """
+        What has happened since the last call: ``None`` (nothing),
+        ``"modified"`` (only changes to files) or ``"moved"`` (files have
+        been added, removed or renamed)
+        """
+
+        changes = None
+        while True:
+            try:
+                data = os.read(self.fd, 65536)
+            except BlockingIOError:
+                return changes
+            offset = 0
+            while offset < len(data):
+                wd, mask, cookie, size = \
+                        self._event_struct.unpack_from(data, offset)
+                offset += self._event_struct.size + size
+                if mask & self.MOVES:
+                    changes = "moved"
+                elif changes is None:
+                    changes = "modified"
+
+    def close(self):
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def __del__(self):
+        self.close()
+
+
+class DatasetIndex(object):
+    """
+    An index of the datasets in a directory, which is kept up to date
+
+    Scanning a directory (:meth:`Dataset.listdir`) on every request gets
+    slow once it holds many datasets. The index watches the directory with
+    inotify, and is rescanned only when files are added, removed or renamed
+    in it. Where inotify is not available (or if `inotify` is false), the
+    directory's modification time is checked instead, at most once every
+    `poll_interval` seconds, when the index is used.
+
+    Only complete datasets (files of the size that their header says they
+    should be) are considered by :meth:`latest` and :meth:`best`;
+    incomplete ones are checked again whenever a file in the directory
+    changes (or each time the directory is polled).
+
+    The index may be used from many threads at once.
+    """
+
+    _row_type = namedtuple("dataset_in_index",
+                ("ds_time", "suffix", "filename", "path", "size", "valid"))
+
+    def __init__(self, directory=Dataset.DEFAULT_DIRECTORY,
+                 only_suffices=('', ), poll_interval=1.0, inotify=True):
+        """
+        :type directory: string
+        :param directory: directory to index
+        :type only_suffices: set
+        :param only_suffices: only index datasets with these suffices (see
+                              :meth:`Dataset.listdir`)
+        :type poll_interval: float
+        :param poll_interval: how often (at most) to check the directory
+                              for changes, in seconds, if it is not
+                              watched with inotify
+        :type inotify: bool
+        :param inotify: watch the directory with inotify, if available?
+        """
+
+        self.directory = directory
+        self.only_suffices = only_suffices
+        self.poll_interval = poll_interval
+        self.inotify = inotify
+
+        self._lock = threading.Lock()
+        self._watch = None
+        self._checked = None
+        self._mtime = None
+        self._rows = []
+        # The forecast times of the valid datasets, in order
+        self._times = []
+
+    def refresh(self, force=False):
+        """
+        Check the directory for changes (now), and rescan it if there are
+        any (or if `force` is true)
+        """
+
+        with self._lock:
+            self._refresh(force)
+
+    def _refresh(self, force, recheck=False):
+        # (with self._lock held; recheck: files may have changed size)
+        self._checked = time.monotonic()
+        mtime = os.stat(self.directory).st_mtime_ns
+
+        if force or mtime != self._mtime:
+            previous = {row.path: row for row in self._rows}
+            rows = [self._check(row, previous.get(row.path))
+                    for row in Dataset.listdir(self.directory,
+                                               self.only_suffices)]
+            self._mtime = mtime
+        elif recheck:
+            rows = [self._check(row, row) for row in self._rows]
+        elif all(row.valid for row in self._rows):
+            return
+        else:
+            # incomplete datasets may have been finished since
+            rows = [row if row.valid else self._check(row, row)
+                    for row in self._rows]
+
+        rows = sorted(row for row in rows if row is not None)
+        self._rows = rows
+        self._times = sorted(set(row.ds_time for row in rows if row.valid))
+        logger.debug("Indexed %s: %d datasets", self.directory, len(rows))
+
+    def _check(self, row, previous):
+        """
+        Make an index row for `row` (from :meth:`Dataset.listdir`), or
+        ``None`` if it has been deleted
+
+        (The file's header is only read if its size differs from that in
+        the `previous` row for it.)
+        """
+
+        try:
+            size = os.stat(row.path).st_size
+        except OSError:
+            return None
+
+        if previous is not None and previous.size == size:
+            valid = previous.valid
+        else:
+            try:
+                valid = size == Dataset.expected_size(row.path)
+            except (IOError, ValueError):
+                valid = False
+
+        return self._row_type(row.ds_time, row.suffix, row.filename,
+                              row.path, size, valid)
+
+    def _poll(self):
+        with self._lock:
+            if self._checked is None or \
+                    (self._watch is not None and
+                     self._watch.pid != os.getpid()):
+                # (first use, or in a new process)
+                self._start_watch()
+                self._refresh(True)
+            elif self._watch is not None:
+                changes = self._watch.changes()
+                if changes is not None:
+                    self._refresh(changes == "moved", recheck=True)
+            elif time.monotonic() - self._checked >= self.poll_interval:
+                self._refresh(False)
+            return self._times
+
+    def _start_watch(self):
+        # (with self._lock held)
+        if self._watch is not None:
+            self._watch.close()
+            self._watch = None
+        if self.inotify:
+            try:
+                self._watch = _DirectoryWatch(self.directory)
+            except OSError as e:
+                logger.info("Polling %s (not watching it: %s)",
+                            self.directory, e)
+
+    def rows(self):
+        """
+        All of the datasets in the directory, in order
+
+        :rtype: list of (named) tuples ``(dataset time, suffix, filename,
+                full path, size, valid)``
+        """
+
+        self._poll()
+        return list(self._rows)
+
+    def times(self):
+        """The forecast times of the datasets (of the right size), in order"""
+        return list(self._poll())
+
+    def latest(self):
+        """
+        The forecast time of the most recent dataset, or ``None``
+
+        :rtype: :class:`datetime.datetime`
+        """
+
+        times = self._poll()
+        return times[-1] if times else None
+
+    def best(self, launch_time):
+        """
+        The forecast time of the most recent dataset that starts at or
+        before `launch_time` (a :class:`datetime.datetime`), or ``None``
+        """
+
+        times = self._poll()
+        i = bisect.bisect_right(times, launch_time)
+        return times[i - 1] if i else None
+
+
+class DatasetRegistry(object):
+    """
+    Keeps the most recently used datasets in a directory open
+
+    Datasets are shared by everything (e.g., every thread) that uses the
+    registry. While a dataset is in use (between :meth:`acquire` and
+    :meth:`release`, or in a :meth:`dataset` block) it stays in the
+    registry; otherwise, the least recently used datasets are dropped
+    when there are more than `size` of them. (A dropped dataset is closed
+    once nothing else refers to it.)
+
+    The registry may be used from many threads at once.
+    """
+
+    def __init__(self, directory=Dataset.DEFAULT_DIRECTORY, size=2,
+                 residency=None):
+        """
+        :type directory: string
+        :param directory: directory containing the datasets
+        :type size: int
+        :param size: how many datasets to keep open
+        :type residency: dict
+        :param residency: if not ``None``, when a dataset is opened, call
+                          :meth:`Dataset.manage_residency` with these
+                          arguments
+        """
+
+        self.directory = directory
+        self.size = size
+        self.residency = residency
+        self.index = DatasetIndex(directory)
+        self._lock = threading.Lock()
+        # ds_time -> [future of the dataset, number of users], least
+        # recently used first
+        self._entries = collections.OrderedDict()
+
+    def latest(self):
+        """
+        The forecast time of the most recent dataset in the directory
+
+        :rtype: :class:`datetime.datetime`
+        """
+
+        latest = self.index.latest()
+        if latest is None:
+            raise IOError("No datasets in {0}".format(self.directory))
+        return latest
+
+    def acquire(self, ds_time=None, times=None):
+        """
+        Open (or find the open) dataset for `ds_time`
+
+        If `ds_time` is ``None``, the dataset is the most recent one that
+        has all of the data needed between `times`, a ``(first, last)``
+        pair of :class:`datetime.datetime` (default: all of its data; see
+        :meth:`Dataset.is_complete`). So a dataset that is still being
+        written is used as soon as it has the hours that a prediction
+        needs.
+
+        Each call must be matched by a call to :meth:`release`.
+
+        :rtype: :class:`Dataset`
+        """
+
+        if ds_time is not None:
+            return self._acquire(ds_time)
+
+        # (datasets only become more complete, so one that is complete now
+        # will still be once it has been opened)
+        for ds_time in reversed(self.index.times()):
+            if self._is_complete(ds_time, times):
+                return self._acquire(ds_time)
+
+        raise IOError("No complete datasets in {0}".format(self.directory))
+
+    def _is_complete(self, ds_time, times):
+        """
+        Does the dataset for `ds_time` have the data for `times` (see
+        :meth:`acquire`)?
+
+        If it isn't open, only its header and completeness map are read, so
+        that datasets that are still being written aren't opened (and
+        perhaps locked into memory) just to find that out.
+        """
+
+        if times is None:
+            first = last = None
+        else:
+            first, last = [(t - ds_time).total_seconds() / 3600
+                           for t in times]
+
+        with self._lock:
+            entry = self._entries.get(ds_time)
+            dataset = self._opened(entry) if entry is not None else None
+        if dataset is not None:
+            return dataset.is_complete(first, last)
+
+        try:
+            return Dataset.file_is_complete(
+                    Dataset.filename(ds_time, self.directory), first, last)
+        except (IOError, OSError, ValueError):
+            # (e.g., it has been deleted)
+            return False
+
+    def _acquire(self, ds_time):
+        with self._lock:
+            entry = self._entries.get(ds_time)
+            if entry is None:
+                # Publish a placeholder, so that other threads wait for
+                # this one to open the dataset, which (with residency) may
+                # take a while, rather than holding the lock meanwhile
+                entry = self._entries[ds_time] = [Future(), 0]
+                opening = True
+            else:
+                self._entries.move_to_end(ds_time)
+                opening = False
+
+            entry[1] += 1
+            self._evict()
+
+        if opening:
+            try:
+                dataset = Dataset(ds_time, directory=self.directory)
+                if self.residency is not None:
+                    dataset.manage_residency(**self.residency)
+            except BaseException as e:
+                with self._lock:
+                    if self._entries.get(ds_time) is entry:
+                        del self._entries[ds_time]
+                entry[0].set_exception(e)
+                raise
+            entry[0].set_result(dataset)
+
+        return entry[0].result()
+
+    def release(self, dataset):
+        """Stop using a dataset returned by :meth:`acquire`"""
+
+        with self._lock:
+            entry = self._entries.get(dataset.ds_time)
+            if entry is not None and self._opened(entry) is dataset:
+                entry[1] -= 1
+                self._evict()
+
+    @staticmethod
+    def _opened(entry):
+        """The dataset of an entry, or ``None`` if it is still opening"""
+        future = entry[0]
+        if future.done() and future.exception() is None:
+            return future.result()
+        return None
+
+    @contextlib.contextmanager
+    def dataset(self, ds_time=None, times=None):
+        """:meth:`acquire` a dataset for the duration of a ``with`` block"""
+
+        dataset = self.acquire(ds_time, times)
+        try:
+            yield dataset
+        finally:
+            self.release(dataset)
+
+    def open_datasets(self):
+        """
+        The datasets in the registry
+
+        :rtype: list of ``(dataset, number of users)`` pairs, least
+                recently used first
+        """
 
+        with self._lock:
+            entries = [(self._opened(entry), entry[1])
+                       for entry in self._entries.values()]
+        return [entry for entry in entries if entry[0] is not None]
 
-signal.signal(signal.SIGALRM, Dataset.prune_latest)
+    def _evict(self):
+        # (with self._lock held; datasets that are being opened have a
+        # user, so are never dropped)
+        excess = len(self._entries) - self.size
+        for ds_time, entry in list(self._entries.items()):
+            if excess <= 0:
+                break
+            if entry[1] == 0:
+                logger.info("Dropping dataset %s %s", ds_time,
+                            self._opened(entry).fn)
+                del self._entries[ds_time]
+                excess -= 1
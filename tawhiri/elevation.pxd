@@ -0,0 +1,58 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+from .workcounts cimport WorkCounts
+
+cdef enum:
+    # The most levels that a MaximumElevation may have
+    MAX_PYRAMID_LEVELS = 16
+    # The number of samples in the cache of an Elevation (a power of two)
+    ELEVATION_CACHE_SIZE = 64
+
+cdef class MaximumElevation:
+    cdef readonly tuple res
+    cdef readonly long cells
+    cdef double lat_resolution, lng_resolution
+    cdef long lng_samples
+
+    # all of the levels, finest first
+    cdef short[::1] data
+    cdef int n_levels
+    cdef long divisor[MAX_PYRAMID_LEVELS]
+    cdef long cols[MAX_PYRAMID_LEVELS]
+    cdef long offset[MAX_PYRAMID_LEVELS]
+
+    cdef bint above(self, long i, long j, double alt)
+
+cdef class Elevation:
+    cdef readonly object dataset
+    cdef readonly MaximumElevation maximum
+    cdef double lat_resolution, lng_resolution
+
+    # a direct mapped cache of samples, each in slot
+    # (i * 31 + j) % ELEVATION_CACHE_SIZE of its indices
+    cdef long long cache_key[ELEVATION_CACHE_SIZE]
+    cdef double cache_value[ELEVATION_CACHE_SIZE]
+
+    cdef int lookup(self, double lat, double lng, double* out,
+                    WorkCounts workcounts=*) except -1
+    cdef bint underground(self, double lat, double lng, double alt,
+                          WorkCounts workcounts=*) except -1
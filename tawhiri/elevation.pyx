@@ -0,0 +1,341 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+# cython: boundscheck=False
+# cython: wraparound=False
+# cython: cdivision=True
+
+"""
+Elevation lookups for the elevation terminator
+
+:class:`Elevation` wraps a :class:`ruaumoko.Dataset`, which gives the
+elevation of the nearest sample to a point, so that
+:class:`tawhiri.native.ElevationTermination` can avoid asking it: it keeps
+a small direct mapped cache of samples, and consults a
+:class:`MaximumElevation`, a pyramid of the highest ground in coarse
+cells, which lets it skip the lookup entirely when a balloon is above
+all of the ground nearby (as it is for most of its descent).
+
+``tawhiri-elevation`` builds a :class:`MaximumElevation` from a ruaumoko
+dataset; see ``tawhiri-elevation --help``.
+"""
+
+import json
+import mmap
+import argparse
+import logging
+
+from array import array
+
+from magicmemoryview import MagicMemoryView
+from libc.math cimport round, fmod
+from posix.time cimport clock_gettime, timespec, CLOCK_MONOTONIC
+
+from .workcounts cimport WorkCounts
+
+
+logger = logging.getLogger("tawhiri.elevation")
+
+
+#: The shape of each block of a ruaumoko dataset (columns, rows), as
+#: :attr:`ruaumoko.Dataset.default_res`
+RUAUMOKO_RES = (14401, 10801)
+
+#: A ruaumoko dataset is a grid of blocks: 4 of latitude (45 degrees each),
+#: from the north, by 6 of longitude (60 degrees each), from 180 degrees
+BLOCKS = (4, 6)
+
+#: The default number of samples on each side of a cell of the finest level
+#: of a :class:`MaximumElevation` (a quarter of a degree, in ruaumoko's
+#: default resolution)
+DEFAULT_CELLS = 60
+
+# Lower than any elevation
+DEF LOWEST = -32768
+DEF FACTOR = 8
+
+#: The number of cells on each side of a cell of the level below
+PYRAMID_FACTOR = FACTOR
+
+
+cdef inline double monotonic():
+    cdef timespec ts
+    clock_gettime(CLOCK_MONOTONIC, &ts)
+    return ts.tv_sec + ts.tv_nsec * 1e-9
+
+
+cdef inline void sample(double lat, double lng,
+                        double lat_resolution, double lng_resolution,
+                        long* i, long* j):
+    """The indices of the sample nearest to a point, as ruaumoko finds it"""
+    i[0] = <long> round((90 - lat) * lat_resolution)
+    j[0] = <long> round(fmod(lng + 180, 360) * lng_resolution)
+
+
+def _resolution(res):
+    """The number of samples per degree (latitude, longitude) in a dataset"""
+    return (res[1] - 1) / 45.0, (res[0] - 1) / 60.0
+
+
+def _shape(res, long cells):
+    """The shape (rows, columns) of the finest level of a pyramid"""
+    cdef long lat_samples = BLOCKS[0] * (res[1] - 1) + 1
+    cdef long lng_samples = BLOCKS[1] * (res[0] - 1)
+    return (lat_samples + cells - 1) // cells, \
+           (lng_samples + cells - 1) // cells
+
+
+cdef class MaximumElevation:
+    """
+    The highest ground in each cell of a pyramid of grids
+
+    The finest level, `grid` (an :class:`array.array` of ``"h"``, by row
+    from the north and then by column from 180 degrees), holds the highest
+    sample of a ruaumoko dataset (whose blocks are of shape `res`) in each
+    cell of `cells` by `cells` samples; each coarser level holds the
+    highest in :data:`PYRAMID_FACTOR` by :data:`PYRAMID_FACTOR` cells of
+    the level below, up to a single cell covering the whole world.
+
+    See :meth:`build`, :meth:`load` and :meth:`save`.
+    """
+
+    def __init__(self, grid, res=RUAUMOKO_RES, long cells=DEFAULT_CELLS):
+        cdef long rows, cols, size, total, r, c, i, k
+        cdef short[::1] data
+        cdef short value
+
+        rows, cols = _shape(res, cells)
+        if len(grid) != rows * cols:
+            raise ValueError("Expected a {0}x{1} grid".format(rows, cols))
+
+        self.res = tuple(res)
+        self.cells = cells
+        self.lat_resolution, self.lng_resolution = _resolution(res)
+        self.lng_samples = BLOCKS[1] * (res[0] - 1)
+
+        # (the shapes of the levels)
+        shapes = [(rows, cols)]
+        while (rows, cols) != (1, 1):
+            shapes.append(((rows + FACTOR - 1) // FACTOR,
+                           (cols + FACTOR - 1) // FACTOR))
+            rows, cols = shapes[len(shapes) - 1]
+        if len(shapes) > MAX_PYRAMID_LEVELS:
+            raise ValueError("Too many levels")
+
+        total = sum(rows * cols for rows, cols in shapes)
+        levels = array("h", grid)
+        levels.extend(array("h", [LOWEST]) * (total - len(grid)))
+        data = levels
+
+        self.n_levels = len(shapes)
+        size = 0
+        for k, (rows, cols) in enumerate(shapes):
+            self.divisor[k] = cells if k == 0 else \
+                              self.divisor[k - 1] * FACTOR
+            self.cols[k] = cols
+            self.offset[k] = size
+            size += rows * cols
+
+            if k == 0:
+                continue
+            for r in range(shapes[k - 1][0]):
+                for c in range(self.cols[k - 1]):
+                    value = data[self.offset[k - 1] + r * self.cols[k - 1] + c]
+                    i = self.offset[k] + (r // FACTOR) * cols + c // FACTOR
+                    if value > data[i]:
+                        data[i] = value
+
+        self.data = data
+
+    @classmethod
+    def build(cls, filename, res=RUAUMOKO_RES, long cells=DEFAULT_CELLS):
+        """
+        Build the pyramid for the ruaumoko dataset in `filename`
+
+        This reads the whole dataset, so takes a while.
+        """
+
+        cdef long block_rows = res[1] - 1, block_cols = res[0] - 1
+        cdef long lng_samples = BLOCKS[1] * block_cols
+        cdef long n_block_rows = BLOCKS[0], n_block_cols = BLOCKS[1]
+        cdef long rows, cols, br, bc, r, c, i, j, row
+        cdef short[:, :, :, :] source
+        cdef short[::1] data
+        cdef short value
+
+        rows, cols = _shape(res, cells)
+        grid = array("h", [LOWEST]) * (rows * cols)
+        data = grid
+
+        with open(filename, "rb") as f:
+            m = mmap.mmap(f.fileno(), 0, prot=mmap.PROT_READ)
+        source = MagicMemoryView(m, BLOCKS + (res[1], res[0]), b"h")
+
+        with nogil:
+            for br in range(n_block_rows):
+                # (the last row and column of a block are the first of the
+                # next: those of the last block are the south pole and 180
+                # degrees, which is where the first column starts)
+                for r in range(block_rows + 1):
+                    i = br * block_rows + r
+                    row = (i // cells) * cols
+                    for bc in range(n_block_cols):
+                        for c in range(block_cols + 1):
+                            j = (bc * block_cols + c) % lng_samples
+                            value = source[br, bc, r, c]
+                            if value > data[row + j // cells]:
+                                data[row + j // cells] = value
+
+        return cls(grid, res, cells)
+
+    @classmethod
+    def load(cls, filename):
+        """Load a pyramid saved by :meth:`save`"""
+        with open(filename, "rb") as f:
+            header = json.loads(f.readline().decode("ascii"))
+            grid = array("h")
+            grid.frombytes(f.read())
+        return cls(grid, header["res"], header["cells"])
+
+    def save(self, filename):
+        """Save the pyramid (its finest level, in native byte order)"""
+        rows, cols = _shape(self.res, self.cells)
+        header = {"res": list(self.res), "cells": self.cells}
+        with open(filename, "wb") as f:
+            f.write(json.dumps(header).encode("ascii") + b"\n")
+            f.write(bytes(self.data[:rows * cols]))
+
+    def highest(self, double lat, double lng):
+        """The highest ground in the cell (of the finest level) of a point"""
+        cdef long i, j
+        sample(lat, lng, self.lat_resolution, self.lng_resolution, &i, &j)
+        j %= self.lng_samples
+        return self.data[(i // self.cells) * self.cols[0] + j // self.cells]
+
+    cdef bint above(self, long i, long j, double alt):
+        """Is `alt` at least as high as the ground around sample (i, j)?"""
+        cdef int k
+        j %= self.lng_samples
+        # (from the coarsest level down, so that high altitudes, which are
+        # above the highest ground anywhere, only need one comparison)
+        for k in range(self.n_levels - 1, -1, -1):
+            if alt >= self.data[self.offset[k] +
+                                (i // self.divisor[k]) * self.cols[k] +
+                                j // self.divisor[k]]:
+                return True
+        return False
+
+
+cdef class Elevation:
+    """
+    Elevations from `dataset` (a :class:`ruaumoko.Dataset`, or anything else
+    with the same ``get(lat, lng)`` method and resolution), optionally with
+    the :class:`MaximumElevation` of the dataset
+
+    Since the dataset gives the elevation of the nearest sample, points
+    that round to the same sample are the same. Samples are cached in a
+    direct mapped table of 64 slots: each sample has one slot (chosen by a
+    hash of its indices), and replaces whichever sample was there.
+
+    One Elevation may be shared by many requests, so lookups of the dataset
+    (cache misses) are counted in the :class:`tawhiri.workcounts.WorkCounts`
+    of the caller, if it has one.
+    """
+
+    def __init__(self, dataset, MaximumElevation maximum=None,
+                 res=RUAUMOKO_RES):
+        if maximum is not None:
+            res = maximum.res
+        self.dataset = dataset
+        self.maximum = maximum
+        self.lat_resolution, self.lng_resolution = _resolution(res)
+        for i in range(ELEVATION_CACHE_SIZE):
+            self.cache_key[i] = -1
+
+    def get(self, double lat, double lng):
+        """The elevation at a point (see :meth:`ruaumoko.Dataset.get`)"""
+        cdef double out
+        self.lookup(lat, lng, &out)
+        return out
+
+    cdef int lookup(self, double lat, double lng, double* out,
+                    WorkCounts workcounts=None) except -1:
+        cdef long i, j
+        cdef double start
+        cdef long long key
+        cdef int slot
+
+        if not (-90 <= lat <= 90 and 0 <= lng < 360):
+            # (so that the dataset raises its exception)
+            out[0] = self.dataset.get(lat, lng)
+            return 0
+
+        sample(lat, lng, self.lat_resolution, self.lng_resolution, &i, &j)
+        key = (<long long> i << 32) | j
+        slot = (i * 31 + j) & (ELEVATION_CACHE_SIZE - 1)
+        if self.cache_key[slot] == key:
+            out[0] = self.cache_value[slot]
+        else:
+            start = monotonic()
+            out[0] = self.dataset.get(lat, lng)
+            if workcounts is not None:
+                workcounts.elevation_lookups += 1
+                workcounts.elevation_seconds += monotonic() - start
+            self.cache_value[slot] = out[0]
+            self.cache_key[slot] = key
+        return 0
+
+    cdef bint underground(self, double lat, double lng, double alt,
+                          WorkCounts workcounts=None) except -1:
+        """Is `alt` below the ground?"""
+        cdef long i, j
+        cdef double ground
+
+        if self.maximum is not None and -90 <= lat <= 90 and 0 <= lng < 360:
+            sample(lat, lng, self.lat_resolution, self.lng_resolution, &i, &j)
+            if self.maximum.above(i, j, alt):
+                return False
+
+        self.lookup(lat, lng, &ground, workcounts)
+        return ground > alt
+
+
+def main():
+    # (only needed for its default location)
+    from ruaumoko import Dataset as ElevationDataset
+
+    parser = argparse.ArgumentParser(
+            description="Find the highest ground in each part of an "
+                        "elevation dataset")
+    parser.add_argument("output",
+            help="file to write the maximum elevations to")
+    parser.add_argument("-e", "--elevation-dataset",
+            default=ElevationDataset.default_location,
+            help="ruaumoko dataset (default: %(default)s)")
+    parser.add_argument("-c", "--cells", type=int, default=DEFAULT_CELLS,
+            help="samples on each side of the finest cells "
+                 "(default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    maximum = MaximumElevation.build(args.elevation_dataset, cells=args.cells)
+    maximum.save(args.output)
+    logger.info("Wrote %s", args.output)
@@ -0,0 +1,314 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Create a dataset from decoded forecast data
+
+The data is read by a :class:`Reader`, in pieces (e.g., one GRIB file
+each), which are read in parallel by a pool of worker processes. Each
+worker maps the new dataset and copies each (hour, pressure, variable) slab
+that it reads straight into place; the slabs are disjoint parts of the
+file, so the workers need not coordinate. Once every slab has been
+written, the dataset is synced to disk and renamed into place, so that
+the predictor never sees a partially written dataset; or, if it is
+written progressively, each hour is marked complete as soon as all of its
+slabs have been written.
+
+Run as ``tawhiri-ingest``; see ``tawhiri-ingest --help``.
+"""
+
+import os
+import argparse
+import logging
+import multiprocessing
+from datetime import datetime
+
+from .dataset import Dataset
+
+
+logger = logging.getLogger("tawhiri.ingest")
+
+
+class Reader(object):
+    """
+    A source of forecast data for :func:`ingest`
+
+    Readers are sent to the worker processes, so must be picklable.
+    """
+
+    #: The grid of the data (see :attr:`tawhiri.dataset.Dataset.grid`)
+    grid = Dataset.default_grid
+
+    def pieces(self):
+        """
+        The pieces that the data is read in: a list of picklable objects
+        (e.g., filenames) to pass to :meth:`read`
+        """
+        raise NotImplementedError
+
+    def read(self, piece):
+        """
+        Read a piece of the data
+
+        Yields ``(hour, level, variable, values)`` for each slab in the
+        piece: `hour`, `level` and `variable` are values on the axes of
+        :attr:`grid` (e.g., ``(3, 500, "wind_u")``) and `values` supports
+        the buffer protocol and holds the slab's ``float32`` values, by
+        latitude and then longitude (in the order of the grid's axes).
+        """
+        raise NotImplementedError
+
+
+class GribReader(Reader):
+    """
+    Read GRIB2 files (e.g., the NOAA's "pgrb2f" and "pgrb2bf" files), one
+    piece per file
+
+    Requires :mod:`pygrib` (and :mod:`numpy`). Messages for variables or
+    pressure levels that are not in :attr:`grid` are skipped.
+    """
+
+    #: The GRIB short names of the variables in a dataset
+    short_names = {"gh": "height", "u": "wind_u", "v": "wind_v"}
+
+    def __init__(self, filenames, grid=Dataset.default_grid):
+        self.filenames = list(filenames)
+        self.grid = grid
+
+    def pieces(self):
+        return self.filenames
+
+    def read(self, filename):
+        # (optional dependencies, only needed by this reader)
+        import numpy
+        import pygrib
+
+        pressures = set(self.grid["pressure"])
+        variables = set(self.grid["variable"])
+
+        grbs = pygrib.open(filename)
+        try:
+            for message in grbs:
+                variable = self.short_names.get(message.shortName)
+                if message.typeOfLevel != "isobaricInhPa" or \
+                        message.level not in pressures or \
+                        variable not in variables:
+                    continue
+
+                values = message.values
+                # The NOAA's grids run from north to south
+                if message.latitudeOfFirstGridPointInDegrees > \
+                        message.latitudeOfLastGridPointInDegrees:
+                    values = values[::-1]
+                values = numpy.ascontiguousarray(values, dtype=numpy.float32)
+                yield message.forecastTime, message.level, variable, values
+        finally:
+            grbs.close()
+
+
+# The state of a worker process (see _start_worker)
+_worker = None
+
+
+class _Worker(object):
+    def __init__(self, ds_time, directory, suffix, reader):
+        self.dataset = Dataset(ds_time, directory=directory, suffix=suffix,
+                               writable=True)
+        self.reader = reader
+
+        axes = self.dataset.axes
+        self.indices = [{value: i for i, value in enumerate(axis)}
+                        for axis in axes[:3]]
+        self.slab_size = self.dataset.data_size // \
+                         (len(axes[0]) * len(axes[1]) * len(axes[2]))
+
+    def read(self, piece):
+        """
+        Copy the slabs in `piece` into the dataset, and return their
+        ``(hour, level, variable)`` indices
+        """
+
+        hours, levels, variables = self.indices
+        written = []
+
+        for hour, level, variable, values in self.reader.read(piece):
+            try:
+                index = (hours[hour], levels[level], variables[variable])
+            except KeyError:
+                raise ValueError("{0}: slab {1} is not on the grid"
+                                    .format(piece, (hour, level, variable)))
+
+            view = memoryview(values)
+            if view.format != "f" or view.nbytes != self.slab_size:
+                raise ValueError("{0}: slab {1} should be {2} float32s"
+                                    .format(piece, (hour, level, variable),
+                                            self.slab_size // 4))
+
+            i = (index[0] * len(levels) + index[1]) * len(variables) + index[2]
+            offset = self.dataset.data_offset + i * self.slab_size
+            self.dataset.array[offset:offset + self.slab_size] = \
+                    view.cast("B")
+            written.append(index)
+
+        logger.debug("Read %s (%d slabs)", piece, len(written))
+        return written
+
+
+def _start_worker(*args):
+    global _worker
+    _worker = _Worker(*args)
+
+
+def _stop_worker():
+    global _worker
+    _worker.dataset.close()
+    _worker = None
+
+
+def _read(piece):
+    return _worker.read(piece)
+
+
+def ingest(ds_time, reader, directory=Dataset.DEFAULT_DIRECTORY, suffix='',
+           processes=None, progressive=False):
+    """
+    Create the dataset for `ds_time` in `directory`, from the data read by
+    `reader` (a :class:`Reader`)
+
+    The dataset is written to a temporary file, which is renamed into
+    place once every slab has been read (and the file synced); if any
+    are missing, or a piece cannot be read, the temporary file is deleted
+    and an exception raised.
+
+    :type suffix: string
+    :param suffix: filename suffix of the dataset (see
+                   :meth:`tawhiri.dataset.Dataset.filename`)
+    :type processes: int
+    :param processes: number of worker processes (default: one per CPU);
+                      if 1, the data is read in this process
+    :type progressive: bool
+    :param progressive: if true, write the dataset in place, with a
+                        completeness map, marking each hour complete as
+                        soon as all of its slabs have been written (see
+                        :meth:`tawhiri.dataset.Dataset.is_complete`), so
+                        that predictions may use it before it is finished
+    :rtype: string
+    :returns: the filename of the new dataset
+    """
+
+    header = {"grid": reader.grid}
+    if progressive:
+        header["completeness"] = True
+        write_suffix = suffix
+    else:
+        write_suffix = suffix + ".temp"
+
+    target = Dataset(ds_time, directory=directory, suffix=write_suffix,
+                     new=True, header=header)
+    fn = target.fn
+    slabs_per_hour = target.shape[1] * target.shape[2]
+    # the number of slabs written, for each hour
+    counts = [0] * target.shape[0]
+    written = set()
+
+    def record(slabs):
+        for index in slabs:
+            if index in written:
+                logger.warning("Slab %s was read more than once", index)
+                continue
+            written.add(index)
+            hour = index[0]
+            counts[hour] += 1
+            if counts[hour] == slabs_per_hour and progressive:
+                target.mark_complete(hour)
+                logger.info("Hour %s of %s is complete",
+                            target.axes.hour[hour], fn)
+
+    try:
+        pieces = reader.pieces()
+        args = (ds_time, directory, write_suffix, reader)
+        if processes == 1:
+            _start_worker(*args)
+            try:
+                for piece in pieces:
+                    record(_read(piece))
+            finally:
+                _stop_worker()
+        else:
+            pool = multiprocessing.Pool(processes, _start_worker, args)
+            try:
+                for slabs in pool.imap_unordered(_read, pieces):
+                    record(slabs)
+                pool.close()
+            finally:
+                pool.terminate()
+                pool.join()
+
+        expect = slabs_per_hour * len(counts)
+        if len(written) != expect:
+            missing = [hour for hour, count in enumerate(counts)
+                       if count != slabs_per_hour]
+            raise ValueError("{0} of {1} slabs are missing (from hours {2})"
+                                .format(expect - len(written), expect,
+                                        [target.axes.hour[i]
+                                         for i in missing]))
+
+        target.array.flush()
+        with open(fn, "rb") as f:
+            os.fsync(f.fileno())
+    except:
+        os.unlink(fn)
+        raise
+    finally:
+        target.close()
+
+    final = Dataset.filename(ds_time, directory=directory, suffix=suffix)
+    if fn != final:
+        os.rename(fn, final)
+        # (so that the rename is durable too)
+        fd = os.open(directory, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    logger.info("Wrote %s", final)
+    return final
+
+
+def main():
+    parser = argparse.ArgumentParser(
+            description="Create a wind dataset from GRIB2 files")
+    parser.add_argument("ds_time",
+            type=lambda s: datetime.strptime(s, "%Y%m%d%H"),
+            help="forecast time of the dataset (YYYYMMDDHH)")
+    parser.add_argument("filenames", nargs="+", metavar="FILE",
+            help="GRIB2 files containing the forecast")
+    parser.add_argument("-d", "--directory", default=Dataset.DEFAULT_DIRECTORY,
+            help="directory to write the dataset to (default: %(default)s)")
+    parser.add_argument("-j", "--processes", type=int,
+            help="number of worker processes (default: one per CPU)")
+    parser.add_argument("-p", "--progressive", action="store_true",
+            help="write the dataset in place, so that predictions can use "
+                 "each hour as soon as it has been written")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+
+    ingest(args.ds_time, GribReader(args.filenames),
+           directory=args.directory, processes=args.processes,
+           progressive=args.progressive)
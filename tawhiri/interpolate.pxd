@@ -0,0 +1,99 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+from .warnings cimport WarningCounts
+from .workcounts cimport WorkCounts
+
+ctypedef float[:, :, :, :, :] dataset
+ctypedef float[:, :, :, :, :, :, :] tiled_dataset
+ctypedef short[:, :, :, :, :] quantized_dataset
+ctypedef short[:, :, :, :, :, :, :] quantized_tiled_dataset
+
+# The most pressure levels that a dataset may have
+cdef enum:
+    MAX_LEVELS = 256
+
+cdef struct Lerp1:
+    long index
+    double lerp
+
+cdef struct Lerp3:
+    long hour, lat, lng
+    double lerp
+
+cdef class Interpolator:
+    # One of data, tiles, qdata or qtiles is set, depending on the layout
+    # and whether the dataset is quantized
+    cdef int layout
+    cdef bint quantized
+    cdef dataset data
+    cdef tiled_dataset tiles
+    cdef quantized_dataset qdata
+    cdef quantized_tiled_dataset qtiles
+    cdef long tile_size
+    # quantization[hour, level, variable] is the (offset, scale) of that slab
+    cdef double[:, :, :, :] quantization
+    # The part of the grid covered by the dataset (which may be a regional
+    # subset): the first point on each axis, the spacing of the points,
+    # and the number of points. If the dataset covers all longitudes, they
+    # wrap around.
+    cdef double hour0, lat0, lng0
+    cdef double hour_step, lat_step, lng_step
+    cdef long n_hours, n_lats, n_lngs, n_levels
+    cdef bint lng_wraps
+    # If the dataset is on altitude levels (rather than pressure levels,
+    # where the height is a variable), their altitudes; alt0 and alt_step
+    # are set if they are evenly spaced.
+    cdef bint altitude_levels, altitude_uniform
+    cdef double altitudes[MAX_LEVELS]
+    cdef double alt0, alt_step
+    # The indices of the wind_u and wind_v variables
+    cdef long var_u, var_v
+    # If the dataset has a completeness map (see Dataset.is_complete), it:
+    # lookups may only use the hours whose byte is non-zero
+    cdef bint check_complete
+    cdef const unsigned char[:] complete
+    cdef WarningCounts warnings
+    cdef WorkCounts workcounts
+    # The pressure level found by the previous lookup, where the next
+    # search starts (see hunt(...))
+    cdef long level_hint
+
+    # The cell (indices of the corner in lerps[0]) that the cache holds,
+    # and for each (level, variable), its 8 corners. corners[level][variable]
+    # is valid if loaded[level][variable] == generation.
+    cdef long cell_hour, cell_lat, cell_lng
+    cdef float corners[MAX_LEVELS][3][8]
+    cdef unsigned int loaded[MAX_LEVELS][3]
+    cdef unsigned int generation
+    cdef public long cache_hits, cache_misses
+
+    cdef long lookup_batch(self, Py_ssize_t n, double* hours, double* lats,
+                           double* lngs, double* alts, double* u, double* v,
+                           signed char* status)
+    cdef int get_wind(self, double hour, double lat, double lng, double alt,
+                      double* u, double* v) except -1
+    cdef int lookup(self, double hour, double lat, double lng, double alt,
+                    double* u, double* v)
+    cdef void enter_cell(self, Lerp3* lerps)
+
+cdef int raise_status(int status, double hour, double lat, double lng,
+                      double alt) except -1
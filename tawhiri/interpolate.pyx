@@ -37,24 +37,20 @@ memory access.
 
 
 from magicmemoryview import MagicMemoryView
-from .warnings cimport WarningCounts
+from libc.math cimport NAN, floor, isfinite
+from libc.string cimport memset
 
 
-# These need to match Dataset.axes.variable
+# These need to match Dataset.axes.variable (for datasets on pressure
+# levels; see Interpolator.var_u and var_v)
 DEF VAR_A = 0
 DEF VAR_U = 1
 DEF VAR_V = 2
 
-
-ctypedef float[:, :, :, :, :] dataset
-
-cdef struct Lerp1:
-    long index
-    double lerp
-
-cdef struct Lerp3:
-    long hour, lat, lng
-    double lerp
+# Dataset.layout
+cdef enum:
+    LAYOUT_STANDARD
+    LAYOUT_TILED
 
 
 class RangeError(ValueError):
@@ -65,95 +61,383 @@ class RangeError(ValueError):
         super(RangeError, self).__init__(s)
 
 
-def make_interpolator(dataset, WarningCounts warnings):
+class IncompleteError(RangeError):
+    """
+    The data for an hour has not yet been written to the dataset (see
+    :meth:`tawhiri.dataset.Dataset.is_complete`)
+    """
+
+    def __init__(self, value):
+        super(IncompleteError, self).__init__("hour", value)
+        self.args = ("hour={0} is not yet in the dataset".format(value), )
+
+
+# Status codes, as returned by lookup(...) and written to the `status`
+# array by Interpolator.get_wind_batch
+cdef enum:
+    STATUS_OK = 0
+    STATUS_HOUR = 1
+    STATUS_LAT = 2
+    STATUS_LNG = 3
+    STATUS_INCOMPLETE = 4
+    STATUS_ALT = 5
+
+#: The variable that was out of range, indexed by status code
+#: (see :meth:`Interpolator.get_wind_batch`; the second "hour" is for hours
+#: that are not yet in the dataset, and altitudes are only out of range if
+#: they are not finite)
+status_variables = (None, "hour", "lat", "lng", "hour", "alt")
+
+
+def make_interpolator(dataset, WarningCounts warnings,
+                      WorkCounts workcounts=None):
     """
     Produce a function that can get wind data from `dataset`
 
     This wrapper casts :attr:`Dataset.array` into a form that is useful
-    to us, and then returns a closure that can be used to retrieve
-    wind velocities.
+    to us, and then returns a callable :class:`Interpolator` that can be
+    used to retrieve wind velocities.
     """
 
-    cdef float[:, :, :, :, :] data
+    return Interpolator(dataset, warnings, workcounts)
 
-    if warnings is None:
-        raise TypeError("Warnings must not be None")
 
-    data = MagicMemoryView(dataset.array, (65, 47, 3, 361, 720), b"f")
+cdef class Interpolator:
+    """
+    Get wind data from a dataset
 
-    def f(hour, lat, lng, alt):
-        return get_wind(data, warnings, hour, lat, lng, alt)
+    Calling an interpolator, ``f(hour, lat, lng, alt)``, returns the
+    ``(u, v)`` wind components at that point, or raises :exc:`RangeError`.
+    :meth:`get_wind_batch` does many lookups in one call.
 
-    return f
+    Each lookup starts its search for the pressure level where the last one
+    finished, and the interpolator keeps the data it has read for the
+    grid cell (hour, lat, lng) it is in until a lookup lands in a
+    different cell. So lookups are fastest if each interpolator follows a
+    single trajectory.
 
+    .. attribute:: cache_hits
 
-cdef object get_wind(dataset ds, WarningCounts warnings,
-                     double hour, double lat, double lng, double alt):
-    """
-    Return [u, v] wind components for the given position.
-    Time is in fractional hours since the dataset starts.
-    Alt is metres above sea level.
-    Lat is latitude in decimal degrees, -90 to +90.
-    Lng is longitude in decimal degrees, 0 to 360.
-
-    Returned coordinates are interpolated from the surrounding grid
-    points in time, latitude, longitude and altitude.
+        The number of lookups in the same cell as the previous lookup
+
+    .. attribute:: cache_misses
+
+        The number of lookups that moved to a new cell
+
+    Lookups, and those that move to a new cell, are also counted in
+    `workcounts` (a :class:`tawhiri.workcounts.WorkCounts`), if given.
     """
 
-    cdef Lerp3[8] lerps
-    cdef long altidx
-    cdef double lower, upper, u, v
+    def __init__(self, dataset, WarningCounts warnings,
+                 WorkCounts workcounts=None):
+        if warnings is None:
+            raise TypeError("Warnings must not be None")
+
+        if dataset.data_element_type == dataset.ELEMENT_FLOAT32:
+            self.quantized = False
+            fmt = b"f"
+        elif dataset.data_element_type == dataset.ELEMENT_INT16:
+            self.quantized = True
+            fmt = b"h"
+            self.quantization = MagicMemoryView(dataset.quantization,
+                                                dataset.quantization_shape,
+                                                b"d")
+        else:
+            raise ValueError("Unknown element type {0!r}"
+                                .format(dataset.data_element_type))
+
+        if dataset.layout == dataset.LAYOUT_STANDARD:
+            self.layout = LAYOUT_STANDARD
+            view = MagicMemoryView(dataset.data, dataset.data_shape, fmt)
+            if self.quantized:
+                self.qdata = view
+            else:
+                self.data = view
+        elif dataset.layout == dataset.LAYOUT_TILED:
+            self.layout = LAYOUT_TILED
+            view = MagicMemoryView(dataset.data, dataset.data_shape, fmt)
+            if self.quantized:
+                self.qtiles = view
+            else:
+                self.tiles = view
+            self.tile_size = dataset.header["tile_size"]
+        else:
+            raise ValueError("Unknown layout {0!r}".format(dataset.layout))
 
-    pick3(hour, lat, lng, lerps)
+        hours, levels, variables, lats, lngs = dataset.grid_shape
+        axes, extent = dataset.axes, dataset.extent
+        if dataset.vertical == dataset.VERTICAL_ALTITUDE:
+            self.altitude_levels = True
+            expect_variables = ["wind_u", "wind_v"]
+        else:
+            self.altitude_levels = False
+            expect_variables = ["height", "wind_u", "wind_v"]
+        if list(axes.variable) != expect_variables:
+            raise ValueError("Dataset must have the variables {0}"
+                                .format(", ".join(expect_variables)))
+        self.var_u = expect_variables.index("wind_u")
+        self.var_v = expect_variables.index("wind_v")
+        if levels > MAX_LEVELS:
+            raise ValueError("Dataset has more than {0} levels"
+                                .format(MAX_LEVELS))
+        if self.altitude_levels:
+            for i in range(levels):
+                self.altitudes[i] = axes.altitude[i]
+            grid = dataset.grid["altitude"]
+            self.altitude_uniform = isinstance(grid, dict)
+            if self.altitude_uniform:
+                self.alt0 = grid["start"]
+                self.alt_step = grid["step"]
+        self.hour0 = axes.hour[extent.hour.start]
+        self.lat0 = axes.latitude[extent.latitude.start]
+        self.lng0 = axes.longitude[extent.longitude.start]
+        self.hour_step = axes.hour[1] - axes.hour[0]
+        self.lat_step = axes.latitude[1] - axes.latitude[0]
+        self.lng_step = axes.longitude[1] - axes.longitude[0]
+        self.n_hours = hours
+        self.n_lats = lats
+        self.n_lngs = lngs
+        self.n_levels = levels
+        self.lng_wraps = lngs == len(axes.longitude) and \
+                         dataset._wraps(axes)
+
+        completeness = dataset.completeness
+        self.check_complete = completeness is not None
+        if self.check_complete:
+            self.complete = completeness
+
+        self.warnings = warnings
+        self.workcounts = workcounts
+        self.level_hint = 0
+        self.cell_hour = self.cell_lat = self.cell_lng = -1
+        self.generation = 1
+        self.cache_hits = self.cache_misses = 0
+
+    def __call__(self, double hour, double lat, double lng, double alt):
+        cdef double u, v
+        self.get_wind(hour, lat, lng, alt, &u, &v)
+        return u, v
+
+    def get_wind_batch(self, double[:] hours, double[:] lats,
+                       double[:] lngs, double[:] alts,
+                       double[:] u, double[:] v, signed char[:] status):
+        """
+        Look up the wind at many points in one go
+
+        All arguments are equal-length one dimensional arrays (anything
+        that supports the buffer protocol: :mod:`array` or :mod:`numpy`
+        arrays). `hours`, `lats`, `lngs` and `alts` have the same meaning
+        as the arguments to ``f(hour, lat, lng, alt)``; the results are
+        written to the preallocated arrays `u`, `v` and `status` (a
+        ``signed char``/``int8`` array).
+
+        Rather than raising :exc:`RangeError`, out of range points have
+        their `status` set to the index in :data:`status_variables` of
+        the offending variable, and `u` and `v` set to NaN. Points that
+        were interpolated successfully have status zero.
+
+        Returns the number of points that were out of range.
+        """
+
+        cdef Py_ssize_t i, n
+        cdef long failed
+        cdef int s
+
+        n = hours.shape[0]
+        if not (lats.shape[0] == lngs.shape[0] == alts.shape[0] ==
+                u.shape[0] == v.shape[0] == status.shape[0] == n):
+            raise ValueError("Arrays must all be the same length")
+
+        failed = 0
+        for i in range(n):
+            s = self.lookup(hours[i], lats[i], lngs[i], alts[i], &u[i], &v[i])
+            status[i] = s
+            if s != STATUS_OK:
+                u[i] = v[i] = NAN
+                failed += 1
+
+        return failed
+
+    cdef long lookup_batch(self, Py_ssize_t n, double* hours, double* lats,
+                           double* lngs, double* alts, double* u, double* v,
+                           signed char* status):
+        """As get_wind_batch(...), for the solver, which has C arrays"""
+        cdef Py_ssize_t i
+        cdef long failed = 0
+
+        for i in range(n):
+            status[i] = self.lookup(hours[i], lats[i], lngs[i], alts[i],
+                                    &u[i], &v[i])
+            if status[i] != STATUS_OK:
+                u[i] = v[i] = NAN
+                failed += 1
+
+        return failed
+
+    cdef int get_wind(self, double hour, double lat, double lng, double alt,
+                      double* u, double* v) except -1:
+        """As lookup(...), but raises RangeError rather than returning it"""
+        return raise_status(self.lookup(hour, lat, lng, alt, u, v),
+                            hour, lat, lng, alt)
+
+    cdef int lookup(self, double hour, double lat, double lng, double alt,
+                    double* u, double* v):
+        """
+        Set `u` and `v` to the wind components at the given position.
+        Time is in fractional hours since the dataset starts.
+        Alt is metres above sea level.
+        Lat is latitude in decimal degrees, -90 to +90.
+        Lng is longitude in decimal degrees, 0 to 360.
+
+        Returned coordinates are interpolated from the surrounding grid
+        points in time, latitude, longitude and altitude.
+
+        Returns a status code: STATUS_OK, or the variable that was out of
+        range.
+        """
+
+        cdef Lerp3[8] lerps
+        cdef Lerp1 alt_lerp
+        cdef long altidx
+        cdef double lower, upper, lerp
+        cdef int s
+
+        s = pick3(self, hour, lat, lng, lerps)
+        if s != STATUS_OK:
+            return s
+        # (altitudes outside the levels are extrapolated, but NaN or
+        # infinity would pick a level by accident)
+        if not isfinite(alt):
+            return STATUS_ALT
+
+        self.enter_cell(lerps)
+
+        if self.altitude_levels:
+            alt_lerp = pick_altitude(self, alt)
+        else:
+            altidx = hunt(self, lerps, alt, self.level_hint)
+            self.level_hint = altidx
+            lower = interp3(self, lerps, VAR_A, altidx)
+            upper = interp3(self, lerps, VAR_A, altidx + 1)
 
-    altidx = search(ds, lerps, alt)
-    lower = interp3(ds, lerps, VAR_A, altidx)
-    upper = interp3(ds, lerps, VAR_A, altidx + 1)
+            if lower != upper:
+                lerp = (upper - alt) / (upper - lower)
+            else:
+                lerp = 0.5
 
-    if lower != upper:
-        lerp = (upper - alt) / (upper - lower)
-    else:
-        lerp = 0.5
+            alt_lerp = Lerp1(altidx, lerp)
+
+        if alt_lerp.lerp < 0: self.warnings.altitude_too_high += 1
 
-    if lerp < 0: warnings.altitude_too_high += 1
+        u[0] = interp4(self, lerps, alt_lerp, self.var_u)
+        v[0] = interp4(self, lerps, alt_lerp, self.var_v)
 
-    cdef Lerp1 alt_lerp = Lerp1(altidx, lerp)
+        return STATUS_OK
 
-    u = interp4(ds, lerps, alt_lerp, VAR_U)
-    v = interp4(ds, lerps, alt_lerp, VAR_V)
+    cdef void enter_cell(self, Lerp3* lerps):
+        """
+        Prepare the cache for lookups in the cell with corners `lerps`
 
-    return u, v, 
+        lerps[0] is the (hour, lat, lng) corner with the lowest indices, so
+        identifies the cell.
+        """
 
-cdef long pick(double left, double step, long n, double value,
-               object variable_name, Lerp1[2] out) except -1:
+        if self.workcounts is not None:
+            self.workcounts.wind_lookups += 1
+
+        if lerps[0].hour == self.cell_hour and \
+                lerps[0].lat == self.cell_lat and \
+                lerps[0].lng == self.cell_lng:
+            self.cache_hits += 1
+        else:
+            self.cache_misses += 1
+            if self.workcounts is not None:
+                self.workcounts.wind_cell_changes += 1
+            self.cell_hour = lerps[0].hour
+            self.cell_lat = lerps[0].lat
+            self.cell_lng = lerps[0].lng
+
+            # invalidate all of self.corners
+            self.generation += 1
+            if self.generation == 0:
+                # (wrapped around)
+                memset(self.loaded, 0, sizeof(self.loaded))
+                self.generation = 1
+
+
+cdef int raise_status(int status, double hour, double lat, double lng,
+                      double alt) except -1:
+    """Raise the RangeError for a status code from lookup(...), if any"""
+    if status == STATUS_HOUR:
+        raise RangeError("hour", hour)
+    elif status == STATUS_INCOMPLETE:
+        raise IncompleteError(hour)
+    elif status == STATUS_LAT:
+        raise RangeError("lat", lat)
+    elif status == STATUS_LNG:
+        raise RangeError("lng", lng)
+    elif status == STATUS_ALT:
+        raise RangeError("alt", alt)
+    return 0
+
+
+cdef bint pick(double left, double step, long n, double value,
+               Lerp1[2] out):
+    """Returns false if `value` is out of range (or is NaN)"""
 
     cdef double a, l
     cdef long b
 
     a = (value - left) / step
+    # (checked before the conversion to an index, which is undefined for
+    # NaN and infinity; a >= 0 is false for NaN, and catches values just
+    # before the first point, which <long> would round up to it. Those are
+    # outside the data, e.g. just outside a regional dataset, which should
+    # raise RangeError rather than be extrapolated from its edge)
+    if not (a >= 0 and a < n - 1):
+        return False
     b = <long> a
-    if b < 0 or b >= n - 1:
-        raise RangeError(variable_name, value)
     l = a - b
 
     out[0] = Lerp1(b, 1 - l)
     out[1] = Lerp1(b + 1, l)
-    return 0
+    return True
 
-cdef long pick3(double hour, double lat, double lng, Lerp3[8] out) except -1:
+cdef int pick3(Interpolator ip, double hour, double lat, double lng,
+               Lerp3[8] out):
     cdef Lerp1[2] lhour, llat, llng
 
-    # the dimensions of the lat/lon axes are 361 and 720
-    # (The latitude axis includes its two endpoints; the longitude only
-    # includes the lower endpoint)
+    # for a global dataset, the dimensions of the lat/lon axes are (e.g.)
+    # 361 and 720 (The latitude axis includes its two endpoints; the
+    # longitude only includes the lower endpoint)
     # However, the longitude does wrap around, so we tell `pick` that the
     # longitude axis is one larger than it is (so that it can "choose" the
     # 721st point/the 360 degrees point), then wrap it afterwards.
-    pick(0, 3, 65, hour, "hour", lhour)
-    pick(-90, 0.5, 361, lat, "lat", llat)
-    pick(0, 0.5, 720 + 1, lng, "lng", llng)
-    if llng[1].index == 720:
-        llng[1].index = 0
+    # A regional dataset's longitudes may start anywhere (and cross the
+    # meridian), so longitudes are taken to be in the 360 degrees east of
+    # its first point.
+    if not pick(ip.hour0, ip.hour_step, ip.n_hours, hour, lhour):
+        return STATUS_HOUR
+    # (the later hour is not needed if the lookup is exactly on the
+    # earlier one)
+    if ip.check_complete and \
+            (not ip.complete[lhour[0].index] or
+             (lhour[1].lerp != 0 and not ip.complete[lhour[1].index])):
+        return STATUS_INCOMPLETE
+    if not pick(ip.lat0, ip.lat_step, ip.n_lats, lat, llat):
+        return STATUS_LAT
+    if ip.lng_wraps:
+        if not pick(ip.lng0, ip.lng_step, ip.n_lngs + 1, lng, llng):
+            return STATUS_LNG
+        if llng[1].index == ip.n_lngs:
+            llng[1].index = 0
+    else:
+        if lng < ip.lng0:
+            lng += 360
+        elif lng >= ip.lng0 + 360:
+            lng -= 360
+        if not pick(ip.lng0, ip.lng_step, ip.n_lngs, lng, llng):
+            return STATUS_LNG
 
     cdef long i = 0
 
@@ -164,29 +448,108 @@ cdef long pick3(double hour, double lat, double lng, Lerp3[8] out) except -1:
                 out[i] = Lerp3(a.index, b.index, c.index, p)
                 i += 1
 
-    return 0
+    return STATUS_OK
+
+cdef inline float dequantize(Interpolator ip, long hour, long level,
+                             long variable, short x):
+    return ip.quantization[hour, level, variable, 0] + \
+           ip.quantization[hour, level, variable, 1] * x
+
+# (Loading is kept out of interp3 so that interp3 stays small enough to
+# be inlined.)
+cdef void load(Interpolator ip, Lerp3* lerps, long variable, long level):
+    """Read the corners of the current cell at (variable, level)"""
+    cdef float* corners = ip.corners[level][variable]
+    cdef long n, hour, lat, lng
+    cdef int i
+
+    if ip.layout == LAYOUT_TILED:
+        n = ip.tile_size
+        for i in range(8):
+            hour = lerps[i].hour
+            lat = lerps[i].lat
+            lng = lerps[i].lng
+            if ip.quantized:
+                corners[i] = dequantize(ip, hour, level, variable,
+                                        ip.qtiles[lat / n, lng / n, hour,
+                                                  level, variable,
+                                                  lat % n, lng % n])
+            else:
+                corners[i] = ip.tiles[lat / n, lng / n, hour, level,
+                                      variable, lat % n, lng % n]
+    elif ip.quantized:
+        for i in range(8):
+            hour = lerps[i].hour
+            corners[i] = dequantize(ip, hour, level, variable,
+                                    ip.qdata[hour, level, variable,
+                                             lerps[i].lat, lerps[i].lng])
+    else:
+        for i in range(8):
+            corners[i] = ip.data[lerps[i].hour, level, variable,
+                                 lerps[i].lat, lerps[i].lng]
+    ip.loaded[level][variable] = ip.generation
 
-cdef double interp3(dataset ds, Lerp3[8] lerps, long variable, long level):
+cdef inline double interp3(Interpolator ip, Lerp3* lerps,
+                           long variable, long level):
     cdef double r, v
+    cdef float* corners = ip.corners[level][variable]
+    cdef int i
+
+    # (re)load the corners from the dataset if this (variable, level) has
+    # not been used since the lookup moved into this cell
+    if ip.loaded[level][variable] != ip.generation:
+        load(ip, lerps, variable, level)
 
     r = 0
     for i in range(8):
-        lerp = lerps[i]
-        v = ds[lerp.hour, level, variable, lerp.lat, lerp.lng]
-        r += v * lerp.lerp
+        v = corners[i]
+        r += v * lerps[i].lerp
 
     return r
 
+cdef Lerp1 pick_altitude(Interpolator ip, double alt):
+    """
+    For a dataset on altitude levels, the level below `alt` and how close
+    to it `alt` is (as interp4 expects). Altitudes below the bottom level
+    or above the top level are extrapolated from the bottom or top two.
+    """
+
+    cdef long i, top = ip.n_levels - 2
+    cdef double lower, upper
+
+    if ip.altitude_uniform:
+        i = <long> floor((alt - ip.alt0) / ip.alt_step)
+        if i < 0:
+            i = 0
+        elif i > top:
+            i = top
+    else:
+        # as hunt(...), but the altitudes are known
+        i = ip.level_hint
+        while i < top and ip.altitudes[i + 1] < alt:
+            i += 1
+        while i > 0 and ip.altitudes[i] >= alt:
+            i -= 1
+        ip.level_hint = i
+
+    lower = ip.altitudes[i]
+    upper = ip.altitudes[i + 1]
+    return Lerp1(i, (upper - alt) / (upper - lower))
+
 # Searches for the largest index lower than target, excluding the topmost level.
-cdef long search(dataset ds, Lerp3[8] lerps, double target):
-    cdef long lower, upper, mid
+cdef long search(Interpolator ip, Lerp3* lerps, double target):
+    return search_between(ip, lerps, target, 0, ip.n_levels - 2)
+
+# As search(...), but only considers levels lower..upper, and assumes that
+# level `lower` is lower than target (or is level 0).
+cdef inline long search_between(Interpolator ip, Lerp3* lerps, double target,
+                                long lower, long upper):
+    cdef long mid
     cdef double test
-    
-    lower, upper = 0, 45
 
     while lower < upper:
         mid = (lower + upper + 1) / 2
-        test = interp3(ds, lerps, VAR_A, mid)
+        test = interp3(ip, lerps, VAR_A, mid)
         if target <= test:
             upper = mid - 1
         else:
@@ -194,8 +557,55 @@ cdef long search(dataset ds, Lerp3[8] lerps, double target):
 
     return lower
 
-cdef double interp4(dataset ds, Lerp3[8] lerps, Lerp1 alt_lerp, long variable):
-    lower = interp3(ds, lerps, variable, alt_lerp.index)
+# As search(...), but starts from `hint` (the result of a previous search),
+# and expands outwards until it has bracketed the result. Successive
+# lookups along a trajectory are usually at the same level or the next.
+cdef long hunt(Interpolator ip, Lerp3* lerps, double target, long hint):
+    cdef long lower, upper, step
+    cdef long top = ip.n_levels - 2
+
+    if hint < 0 or hint > top:
+        return search(ip, lerps, target)
+
+    step = 1
+
+    if interp3(ip, lerps, VAR_A, hint) < target:
+        # the result is in hint..top
+        lower = hint
+        while lower + step <= top and \
+                interp3(ip, lerps, VAR_A, lower + step) < target:
+            lower += step
+            step *= 2
+        upper = min(lower + step - 1, top)
+    else:
+        # the result is in 0..hint - 1 (or is 0)
+        upper = hint - 1
+        lower = hint - step
+        while lower > 0 and interp3(ip, lerps, VAR_A, lower) >= target:
+            upper = lower - 1
+            step *= 2
+            lower = hint - step
+        if lower < 0:
+            lower = 0
+
+    return search_between(ip, lerps, target, lower, upper)
+
+def _levels(Interpolator ip, double hour, double lat, double lng,
+            double alt, long hint):
+    """
+    The pressure level below `alt` at a point, as found by hunt(...) from
+    `hint` and by search(...) (for the tests)
+    """
+    cdef Lerp3[8] lerps
+
+    raise_status(pick3(ip, hour, lat, lng, lerps), hour, lat, lng, alt)
+    ip.enter_cell(lerps)
+    return hunt(ip, lerps, alt, hint), search(ip, lerps, alt)
+
+cdef inline double interp4(Interpolator ip, Lerp3* lerps, Lerp1 alt_lerp,
+                           long variable):
+    cdef double lower, upper
+    lower = interp3(ip, lerps, variable, alt_lerp.index)
     # and we can infer what the other lerp1 is...
-    upper = interp3(ds, lerps, variable, alt_lerp.index + 1)
+    upper = interp3(ip, lerps, variable, alt_lerp.index + 1)
     return lower * alt_lerp.lerp + upper * (1 - alt_lerp.lerp)
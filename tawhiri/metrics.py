@@ -0,0 +1,376 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Measure where the time goes in predictions
+
+:class:`Timings` records how long each phase of a request took (parsing,
+opening the dataset, each stage of the flight, ...) and counts of the work
+done (solver steps, wind lookups, ...). :class:`Metrics` adds those of
+every request up, as histograms and counters, and formats them for
+Prometheus; it may share them with the other processes of the web server
+through files in a directory.
+"""
+
+import atexit
+import collections
+import contextlib
+import copy
+import fcntl
+import json
+import logging
+import os
+import os.path
+import tempfile
+import threading
+import time
+
+
+logger = logging.getLogger("tawhiri.metrics")
+
+#: The upper bounds (seconds) of the buckets of the histograms of phases
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5,
+           1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+#: The least time (seconds) between writes of a process's metrics to the
+#: directory
+WRITE_INTERVAL = 1.0
+
+# The pid of the process that has archived the file left by an earlier
+# process with its pid (see Metrics._archive_stale)
+_started_pid = None
+_started_lock = threading.Lock()
+
+
+class Timings(object):
+    """
+    The time taken by each phase of a request, in seconds, and counts of
+    the work done
+    """
+
+    def __init__(self):
+        self.phases = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """Time the phase `name` (a context manager)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(name, time.perf_counter() - start)
+
+    def add(self, name, seconds):
+        """Add `seconds` to the time of phase `name`"""
+        self.phases[name] = self.phases.get(name, 0.0) + seconds
+
+    def count(self, name, n=1):
+        """Add `n` to the count `name`"""
+        self.counts[name] = self.counts.get(name, 0) + n
+
+    def to_dict(self):
+        return {"phases": dict(self.phases), "counts": dict(self.counts)}
+
+
+class Metrics(object):
+    """
+    Histograms of the time taken by each phase, and totals of each count,
+    of every request recorded (see :meth:`record`)
+
+    If `directory` is given, the metrics of this process are written to a
+    file in it (named by its pid) soon after each request (at most once
+    every :data:`WRITE_INTERVAL`, and when the process exits), and :meth:`format` adds
+    up those of every process. The metrics of processes that are no longer
+    running are added to an archive (``dead.json``), so that the totals
+    never go down, and their files removed; so the directory should only be
+    shared by processes on the same machine.
+    """
+
+    def __init__(self, directory=None):
+        self.directory = directory
+
+        self._lock = threading.Lock()
+        # phase: [count in each bucket (not cumulative), then above the
+        # last bucket, and the sum]
+        self._histograms = {}
+        self._counters = {}
+
+        # (only one thread writes the file at once, in order)
+        self._write_lock = threading.Lock()
+        # whether the metrics have changed since the file was written, and
+        # when (time.monotonic) it was
+        self._pending = False
+        self._written = None
+
+        if self.directory is not None:
+            self._archive_stale()
+            atexit.register(self._flush)
+
+    def record(self, timings):
+        """Add the phases and counts of `timings`"""
+        with self._lock:
+            for name, seconds in timings.phases.items():
+                histogram = self._histograms.setdefault(
+                        name, [0] * (len(BUCKETS) + 1) + [0.0])
+                for i, bound in enumerate(BUCKETS):
+                    if seconds <= bound:
+                        break
+                else:
+                    i = len(BUCKETS)
+                histogram[i] += 1
+                histogram[-1] += seconds
+
+            for name, n in timings.counts.items():
+                self._counters[name] = self._counters.get(name, 0) + n
+
+            if self.directory is None or self._pending:
+                return
+            self._pending = True
+            if self._written is None:
+                delay = 0.0
+            else:
+                delay = self._written + WRITE_INTERVAL - time.monotonic()
+
+        # The file is written outside the lock (so that requests do not wait
+        # for it), by this thread or, if it was written too recently, later
+        # by a timer
+        if delay <= 0.0:
+            self._flush()
+        else:
+            timer = threading.Timer(delay, self._flush)
+            timer.daemon = True
+            timer.start()
+
+    def format(self):
+        """The metrics, in the Prometheus text format"""
+        histograms, counters = self._collect()
+
+        lines = ["# TYPE tawhiri_phase_seconds histogram"]
+        for name in sorted(histograms):
+            histogram = histograms[name]
+            total = 0
+            for bound, n in zip(BUCKETS + ("+Inf",), histogram[:-1]):
+                total += n
+                lines.append('tawhiri_phase_seconds_bucket'
+                             '{phase="%s",le="%s"} %d' % (name, bound, total))
+            lines.append('tawhiri_phase_seconds_sum{phase="%s"} %r'
+                         % (name, histogram[-1]))
+            lines.append('tawhiri_phase_seconds_count{phase="%s"} %d'
+                         % (name, total))
+
+        for name in sorted(counters):
+            lines.append("# TYPE tawhiri_%s_total counter" % name)
+            lines.append("tawhiri_%s_total %d" % (name, counters[name]))
+
+        return "\n".join(lines) + "\n"
+
+    def _state(self):
+        return {"histograms": self._histograms, "counters": self._counters}
+
+    def _collect(self):
+        """Add up the metrics of every process (or just this one)"""
+        if self.directory is not None:
+            self._flush()
+            states = list(self._read())
+        else:
+            with self._lock:
+                states = [copy.deepcopy(self._state())]
+
+        histograms = {}
+        counters = {}
+        for state in states:
+            _add(histograms, counters, state)
+        return histograms, counters
+
+    def _flush(self):
+        """Write the metrics of this process, if they have changed"""
+        with self._write_lock:
+            with self._lock:
+                if not self._pending:
+                    return
+                self._pending = False
+                self._written = time.monotonic()
+                state = copy.deepcopy(self._state())
+            self._write(state)
+
+    def _filename(self, pid=None):
+        if pid is None:
+            pid = os.getpid()
+        return os.path.join(self.directory, "{0}.json".format(pid))
+
+    @contextlib.contextmanager
+    def _archive_lock(self):
+        """
+        Hold the lock (shared by every process) on the archive, while
+        reading it or the files of the processes to add to it; yields
+        whether the lock is held
+        """
+        fn = os.path.join(self.directory, "dead.lock")
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            f = open(fn, "a")
+        except (IOError, OSError) as e:
+            logger.warning("Could not open %s: %s", fn, e)
+            yield False
+            return
+        with f:
+            # (released when the file is closed)
+            fcntl.flock(f, fcntl.LOCK_EX)
+            yield True
+
+    def _archive(self, pid):
+        """
+        Add the metrics of `pid`, which is no longer running, to the archive
+        and remove its file (holding :meth:`_archive_lock`)
+        """
+        fn = self._filename(pid)
+        try:
+            with open(fn) as f:
+                state = json.load(f)
+        except FileNotFoundError:
+            # (another process has already archived it)
+            return
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Could not read %s: %s", fn, e)
+            return
+
+        histograms = {}
+        counters = {}
+        _add(histograms, counters, self._read_archive())
+        _add(histograms, counters, state)
+        # (if the archive cannot be written, the file is kept, to be
+        # archived later)
+        archive = {"histograms": histograms, "counters": counters}
+        if self._write(archive, os.path.join(self.directory, "dead.json")):
+            _remove(fn)
+
+    def _read_archive(self):
+        fn = os.path.join(self.directory, "dead.json")
+        try:
+            with open(fn) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            pass
+        except (IOError, OSError, ValueError) as e:
+            logger.warning("Could not read %s: %s", fn, e)
+        return {"histograms": {}, "counters": {}}
+
+    def _archive_stale(self):
+        """
+        Archive the file left by an earlier process that had this process's
+        pid, which would otherwise be replaced when this process first
+        writes its own (once per process)
+        """
+        global _started_pid
+        with _started_lock:
+            if _started_pid == os.getpid():
+                return
+            _started_pid = os.getpid()
+        if os.path.exists(self._filename()):
+            with self._archive_lock():
+                self._archive(os.getpid())
+
+    def _write(self, state, fn=None):
+        """
+        Write `state` to `fn` (by default, this process's file); returns
+        whether it succeeded
+        """
+        if fn is None:
+            fn = self._filename()
+        # Write to a temporary file and rename it into place, so that
+        # other processes never see a partially written file
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            fd, temp = tempfile.mkstemp(dir=self.directory)
+            with os.fdopen(fd, "w") as f:
+                json.dump(state, f)
+            os.rename(temp, fn)
+        except (IOError, OSError) as e:
+            logger.warning("Could not write %s: %s", fn, e)
+            return False
+        return True
+
+    def _read(self):
+        """
+        The metrics in the archive and those of each running process,
+        archiving those of processes that are no longer running
+        """
+        with self._archive_lock() as locked:
+            try:
+                names = os.listdir(self.directory)
+            except (IOError, OSError):
+                names = []
+            pids = []
+            for name in names:
+                if not name.endswith(".json"):
+                    continue
+                try:
+                    pid = int(name[:-len(".json")])
+                except ValueError:
+                    # (e.g., the archive)
+                    continue
+                if pid <= 0:
+                    continue
+                if locked and not _running(pid):
+                    # (without the lock, another process might archive it
+                    # too, and it would be counted twice; so it is counted
+                    # as if it were running)
+                    self._archive(pid)
+                else:
+                    pids.append(pid)
+
+            yield self._read_archive()
+            for pid in pids:
+                try:
+                    with open(self._filename(pid)) as f:
+                        yield json.load(f)
+                except (IOError, OSError, ValueError):
+                    # (e.g., it is being replaced)
+                    continue
+
+
+def _running(pid):
+    """Is the process `pid` running?"""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        # (it is, but belongs to another user)
+        return True
+    return True
+
+
+def _add(histograms, counters, state):
+    """Add the metrics in `state` to `histograms` and `counters`"""
+    for name, histogram in state["histograms"].items():
+        if name in histograms:
+            histograms[name] = [a + b for a, b in
+                                zip(histograms[name], histogram)]
+        else:
+            histograms[name] = list(histogram)
+    for name, n in state["counters"].items():
+        counters[name] = counters.get(name, 0) + n
+
+
+def _remove(fn):
+    try:
+        os.remove(fn)
+    except (IOError, OSError):
+        # (e.g., another process has already removed it)
+        pass
@@ -18,16 +18,17 @@
 """
 Provide all the balloon models, termination conditions and
 functions to combine models and termination conditions.
+
+The factories return native models (see :mod:`tawhiri.native`), which
+are callable from Python like ordinary functions but which the solver
+calls directly. Any Python function with the same signature may be used
+as a model or terminator too, including as part of a linear model or
+:func:`make_any_terminator`.
 """
 
 import calendar
-import math
-
-from . import interpolate
-
 
-_PI_180 = math.pi / 180.0
-_180_PI = 180.0 / math.pi
+from . import interpolate, native
 
 
 ## Up/Down Models #############################################################
@@ -35,9 +36,7 @@ _180_PI = 180.0 / math.pi
 
 def make_constant_ascent(ascent_rate):
     """Return a constant-ascent model at `ascent_rate` (m/s)"""
-    def constant_ascent(t, lat, lng, alt):
-        return 0.0, 0.0, ascent_rate
-    return constant_ascent
+    return native.ConstantAscent(ascent_rate)
 
 
 def make_drag_descent(sea_level_descent_rate):
@@ -50,44 +49,22 @@ def make_drag_descent(sea_level_descent_rate):
        estimated from the sea level descent rate, and the resulting terminal
        velocity is computed by the returned model function.
     """
-    def density(alt):
-        temp = pressure = 0.0
-        if alt > 25000:
-            temp = -131.21 + 0.00299 * alt
-            pressure = 2.488 * ((temp + 273.1)/(216.6)) ** (-11.388)
-        elif 11000 < alt <= 25000:
-            temp = -56.46
-            pressure = 22.65 * math.exp(1.73 - 0.000157 * alt)
-        else:
-            temp = 15.04 - 0.00649 * alt
-            pressure = 101.29 * ((temp + 273.1)/288.08) ** (5.256)
-        return pressure / (0.2869*(temp + 273.1))
-
-    drag_coefficient = sea_level_descent_rate * 1.1045
-
-    def drag_descent(t, lat, lng, alt):
-        return 0.0, 0.0, -drag_coefficient/math.sqrt(density(alt))
-    return drag_descent
+    return native.DragDescent(sea_level_descent_rate)
 
 
 ## Sideways Models ############################################################
 
 
-def make_wind_velocity(dataset, warningcounts):
+def make_wind_velocity(dataset, warningcounts, workcounts=None):
     """Return a wind-velocity model, which gives lateral movement at
        the wind velocity for the current time, latitude, longitude and
        altitude. The `dataset` argument is the wind dataset in use.
+       Lookups are counted in `workcounts`, if given.
     """
-    get_wind = interpolate.make_interpolator(dataset, warningcounts)
+    get_wind = interpolate.make_interpolator(dataset, warningcounts,
+                                             workcounts)
     dataset_epoch = calendar.timegm(dataset.ds_time.timetuple())
-    def wind_velocity(t, lat, lng, alt):
-        t -= dataset_epoch
-        u, v = get_wind(t / 3600.0, lat, lng, alt)
-        R = 6371009 + alt
-        dlat = _180_PI * v / R
-        dlng = _180_PI * u / (R * math.cos(lat * _PI_180))
-        return dlat, dlng, 0.0
-    return wind_velocity
+    return native.WindVelocity(get_wind, dataset_epoch)
 
 
 ## Termination Criteria #######################################################
@@ -97,38 +74,32 @@ def make_burst_termination(burst_altitude):
     """Return a burst-termination criteria, which terminates integration
        when the altitude reaches `burst_altitude`.
     """
-    def burst_termination(t, lat, lng, alt):
-        if alt >= burst_altitude:
-            return True
-    return burst_termination
+    return native.BurstTermination(burst_altitude)
 
 
-def sea_level_termination(t, lat, lng, alt):
-    """A termination criteria which terminates integration when
-       the altitude is less than (or equal to) zero.
+#: A termination criteria which terminates integration when
+#: the altitude is less than (or equal to) zero.
+#:
+#: Note that this is not a model factory.
+sea_level_termination = native.SeaLevelTermination()
 
-       Note that this is not a model factory.
-    """
-    if alt <= 0:
-        return True
-
-def make_elevation_data_termination(dataset=None):
+def make_elevation_data_termination(dataset=None, workcounts=None):
     """A termination criteria which terminates integration when the
        altitude goes below ground level, using the elevation data
-       in `dataset` (which should be a ruaumoko.Dataset).
+       in `dataset` (which should be a ruaumoko.Dataset, or a
+       :class:`tawhiri.elevation.Elevation` wrapping one, with its
+       maximum elevations, so that most lookups can be skipped).
+       Lookups of the dataset are counted in `workcounts` (a
+       :class:`tawhiri.workcounts.WorkCounts`), if given.
     """
-    def tc(t, lat, lng, alt):
-        return dataset.get(lat, lng) > alt
-    return tc
+    return native.ElevationTermination(dataset, workcounts)
+
 
 def make_time_termination(max_time):
     """A time based termination criteria, which terminates integration when
        the current time is greater than `max_time` (a UNIX timestamp).
     """
-    def time_termination(t, lat, lng, alt):
-        if t > max_time:
-            return True
-    return time_termination
+    return native.TimeTermination(max_time)
 
 
 ## Model Combinations #########################################################
@@ -137,29 +108,22 @@ def make_time_termination(max_time):
 def make_linear_model(models):
     """Return a model that returns the sum of all the models in `models`.
     """
-    def linear_model(t, lat, lng, alt):
-        dlat, dlng, dalt = 0.0, 0.0, 0.0
-        for model in models:
-            d = model(t, lat, lng, alt)
-            dlat, dlng, dalt = dlat + d[0], dlng + d[1], dalt + d[2]
-        return dlat, dlng, dalt
-    return linear_model
+    return native.LinearModel(models)
 
 
 def make_any_terminator(terminators):
     """Return a terminator that terminates when any of `terminators` would
        terminate.
     """
-    def terminator(t, lat, lng, alt):
-        return any(term(t, lat, lng, alt) for term in terminators)
-    return terminator
+    return native.AnyTerminator(terminators)
 
 
 ## Pre-Defined Profiles #######################################################
 
 
 def standard_profile(ascent_rate, burst_altitude, descent_rate,
-                     wind_dataset, elevation_dataset, warningcounts):
+                     wind_dataset, elevation_dataset, warningcounts,
+                     workcounts=None):
     """Make a model chain for the standard high altitude balloon situation of
        ascent at a constant rate followed by burst and subsequent descent
        at terminal velocity under parachute with a predetermined sea level
@@ -167,31 +131,67 @@ def standard_profile(ascent_rate, burst_altitude, descent_rate,
 
        Requires the balloon `ascent_rate`, `burst_altitude` and `descent_rate`,
        and additionally requires the dataset to use for wind velocities.
+       Work done is counted in `workcounts`, if given.
 
        Returns a tuple of (model, terminator) pairs.
     """
 
     model_up = make_linear_model([make_constant_ascent(ascent_rate),
-                                  make_wind_velocity(wind_dataset, warningcounts)])
+                                  make_wind_velocity(wind_dataset, warningcounts,
+                                                     workcounts)])
     term_up = make_burst_termination(burst_altitude)
 
     model_down = make_linear_model([make_drag_descent(descent_rate),
-                                    make_wind_velocity(wind_dataset, warningcounts)])
-    term_down = make_elevation_data_termination(elevation_dataset)
+                                    make_wind_velocity(wind_dataset, warningcounts,
+                                                       workcounts)])
+    term_down = make_elevation_data_termination(elevation_dataset,
+                                                workcounts)
 
     return ((model_up, term_up), (model_down, term_down))
 
 
-def float_profile(ascent_rate, float_altitude, stop_time, dataset, warningcounts):
+def float_profile(ascent_rate, float_altitude, stop_time, dataset, warningcounts,
+                  workcounts=None):
     """Make a model chain for the typical floating balloon situation of ascent
        at constant altitude to a float altitude which persists for some
        amount of time before stopping. Descent is in general not modelled.
+       Work done is counted in `workcounts`, if given.
     """
 
     model_up = make_linear_model([make_constant_ascent(ascent_rate),
-                                  make_wind_velocity(dataset, warningcounts)])
+                                  make_wind_velocity(dataset, warningcounts,
+                                                     workcounts)])
     term_up = make_burst_termination(float_altitude)
-    model_float = make_wind_velocity(dataset, warningcounts)
+    model_float = make_wind_velocity(dataset, warningcounts, workcounts)
     term_float = make_time_termination(stop_time)
 
     return ((model_up, term_up), (model_float, term_float))
+
+
+def standard_ensemble(ascent_rates, burst_altitudes, descent_rates,
+                      wind_dataset, elevation_dataset, warningcounts,
+                      workcounts=None):
+    """Make a :func:`standard_profile` model chain for each member of an
+       ensemble, for use with :func:`tawhiri.solver.solve_ensemble`.
+
+       `ascent_rates`, `burst_altitudes` and `descent_rates` are equal-length
+       sequences giving the parameters of each member.
+
+       Returns a list of model chains.
+    """
+
+    if not len(ascent_rates) == len(burst_altitudes) == len(descent_rates):
+        raise ValueError("Need the same number of each parameter")
+
+    # The members share one wind model, so that the solver looks up all of
+    # their winds in one go
+    wind = make_wind_velocity(wind_dataset, warningcounts, workcounts)
+    term_down = make_elevation_data_termination(elevation_dataset,
+                                                workcounts)
+
+    return [((make_linear_model([make_constant_ascent(ascent_rate), wind]),
+              make_burst_termination(burst_altitude)),
+             (make_linear_model([make_drag_descent(descent_rate), wind]),
+              term_down))
+            for ascent_rate, burst_altitude, descent_rate
+            in zip(ascent_rates, burst_altitudes, descent_rates)]
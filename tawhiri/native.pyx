@@ -0,0 +1,277 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+"""
+Native versions of the models and termination criteria in
+:mod:`tawhiri.models`.
+
+These are :class:`tawhiri.solver.Model` and
+:class:`tawhiri.solver.Terminator` subclasses, so the solver can call them
+(and they can call each other) without going through the interpreter.
+Use the factories in :mod:`tawhiri.models` rather than constructing these
+directly.
+"""
+
+from libc.math cimport sqrt, exp, pow, cos, M_PI
+
+from .solver cimport Vector, Model, Terminator, as_model, as_terminator
+from .interpolate cimport Interpolator
+from .elevation cimport Elevation
+from .workcounts cimport WorkCounts
+
+
+cdef double _PI_180 = M_PI / 180.0
+cdef double _180_PI = 180.0 / M_PI
+
+
+## Up/Down Models #############################################################
+
+
+cdef class ConstantAscent(Model):
+    cdef double ascent_rate
+
+    def __init__(self, double ascent_rate):
+        self.ascent_rate = ascent_rate
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        out.lat = 0.0
+        out.lng = 0.0
+        out.alt = self.ascent_rate
+        return 0
+
+
+cdef double density(double alt):
+    cdef double temp, pressure
+
+    if alt > 25000:
+        temp = -131.21 + 0.00299 * alt
+        pressure = 2.488 * pow((temp + 273.1)/(216.6), -11.388)
+    elif 11000 < alt <= 25000:
+        temp = -56.46
+        pressure = 22.65 * exp(1.73 - 0.000157 * alt)
+    else:
+        temp = 15.04 - 0.00649 * alt
+        pressure = 101.29 * pow((temp + 273.1)/288.08, 5.256)
+    return pressure / (0.2869*(temp + 273.1))
+
+
+cdef class DragDescent(Model):
+    cdef double drag_coefficient
+
+    def __init__(self, double sea_level_descent_rate):
+        self.drag_coefficient = sea_level_descent_rate * 1.1045
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        out.lat = 0.0
+        out.lng = 0.0
+        out.alt = -self.drag_coefficient / sqrt(density(y.alt))
+        return 0
+
+
+## Sideways Models ############################################################
+
+
+cdef class WindVelocity(Model):
+    # If get_wind is an Interpolator, it is called natively (or the solver
+    # looks the wind up for us: see Model.wind_source); otherwise it is
+    # called like a Python function.
+    cdef object get_wind
+    cdef Interpolator interpolator
+    cdef double dataset_epoch
+
+    def __init__(self, get_wind, double dataset_epoch):
+        self.get_wind = get_wind
+        if isinstance(get_wind, Interpolator):
+            self.interpolator = get_wind
+        self.dataset_epoch = dataset_epoch
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        cdef double u, v
+
+        t -= self.dataset_epoch
+        if self.interpolator is not None:
+            self.interpolator.get_wind(t / 3600.0, y.lat, y.lng, y.alt, &u, &v)
+        else:
+            u, v = self.get_wind(t / 3600.0, y.lat, y.lng, y.alt)
+
+        velocity(y, u, v, out)
+        return 0
+
+    cdef Interpolator wind_source(self, double* epoch):
+        epoch[0] = self.dataset_epoch
+        return self.interpolator
+
+    cdef int f_wind(self, double t, Vector y, double u, double v,
+                    Vector* out) except -1:
+        if self.interpolator is None:
+            # (u and v are some other model's wind)
+            return self.f(t, y, out)
+        velocity(y, u, v, out)
+        return 0
+
+
+cdef inline void velocity(Vector y, double u, double v, Vector* out):
+    """Set `out` to the movement at `y` in the wind (`u`, `v`)"""
+    cdef double R
+
+    R = 6371009 + y.alt
+    out.lat = _180_PI * v / R
+    out.lng = _180_PI * u / (R * cos(y.lat * _PI_180))
+    out.alt = 0.0
+
+
+## Termination Criteria #######################################################
+
+
+cdef class BurstTermination(Terminator):
+    cdef double burst_altitude
+
+    def __init__(self, double burst_altitude):
+        self.burst_altitude = burst_altitude
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        return y.alt >= self.burst_altitude
+
+    cdef bint distance(self, double t, Vector y, double* out) except -1:
+        out[0] = self.burst_altitude - y.alt
+        return True
+
+
+cdef class SeaLevelTermination(Terminator):
+    cdef bint tc(self, double t, Vector y) except -1:
+        return y.alt <= 0
+
+    cdef bint distance(self, double t, Vector y, double* out) except -1:
+        out[0] = y.alt
+        return True
+
+
+cdef class ElevationTermination(Terminator):
+    # Lookups go through an Elevation, which skips or caches them where
+    # it can (see tawhiri.elevation), and are counted in workcounts.
+    cdef Elevation elevation
+    cdef WorkCounts workcounts
+
+    def __init__(self, dataset, WorkCounts workcounts=None):
+        if isinstance(dataset, Elevation):
+            self.elevation = dataset
+        else:
+            self.elevation = Elevation(dataset)
+        self.workcounts = workcounts
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        return self.elevation.underground(y.lat, y.lng, y.alt,
+                                          self.workcounts)
+
+    cdef bint distance(self, double t, Vector y, double* out) except -1:
+        cdef double ground
+        self.elevation.lookup(y.lat, y.lng, &ground, self.workcounts)
+        out[0] = y.alt - ground
+        return True
+
+
+cdef class TimeTermination(Terminator):
+    cdef double max_time
+
+    def __init__(self, double max_time):
+        self.max_time = max_time
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        return t > self.max_time
+
+    cdef bint distance(self, double t, Vector y, double* out) except -1:
+        out[0] = self.max_time - t
+        return True
+
+
+## Model Combinations #########################################################
+
+
+cdef class LinearModel(Model):
+    cdef list models
+
+    def __init__(self, models):
+        self.models = [as_model(m) for m in models]
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        cdef Vector d
+        cdef Model model
+
+        out.lat = out.lng = out.alt = 0.0
+        for model in self.models:
+            model.f(t, y, &d)
+            out.lat += d.lat
+            out.lng += d.lng
+            out.alt += d.alt
+        return 0
+
+    cdef Interpolator wind_source(self, double* epoch):
+        # (that of the one model that has one)
+        cdef Interpolator source = None, other
+        cdef Model model
+        cdef double e
+
+        for model in self.models:
+            other = model.wind_source(&e)
+            if other is not None:
+                if source is not None:
+                    return None
+                source = other
+                epoch[0] = e
+        return source
+
+    cdef int f_wind(self, double t, Vector y, double u, double v,
+                    Vector* out) except -1:
+        cdef Vector d
+        cdef Model model
+
+        out.lat = out.lng = out.alt = 0.0
+        for model in self.models:
+            model.f_wind(t, y, u, v, &d)
+            out.lat += d.lat
+            out.lng += d.lng
+            out.alt += d.alt
+        return 0
+
+
+cdef class AnyTerminator(Terminator):
+    cdef list terminators
+
+    def __init__(self, terminators):
+        self.terminators = [as_terminator(t) for t in terminators]
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        cdef Terminator terminator
+
+        for terminator in self.terminators:
+            if terminator.tc(t, y):
+                return True
+        return False
+
+    cdef list fired(self, double t, Vector y):
+        # (the solver finds the point of each of these by its own distance,
+        # since their distances may not be in the same units)
+        cdef Terminator terminator
+        cdef list fired = []
+
+        for terminator in self.terminators:
+            fired.extend(terminator.fired(t, y))
+        return fired
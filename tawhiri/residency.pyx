@@ -0,0 +1,172 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+"""
+Control and report which pages of a memory mapped dataset are in RAM
+
+These functions operate on a byte range of a :class:`mmap.mmap` (e.g.,
+:attr:`tawhiri.dataset.Dataset.array`); the range is extended to whole
+pages. See :meth:`tawhiri.dataset.Dataset.advise`,
+:meth:`~tawhiri.dataset.Dataset.lock`,
+:meth:`~tawhiri.dataset.Dataset.prewarm` and
+:meth:`~tawhiri.dataset.Dataset.residency_report`.
+
+``tawhiri-residency`` reports how much of each dataset in a directory is
+in RAM.
+"""
+
+import os
+import mmap
+import argparse
+
+from libc.errno cimport errno
+from posix.mman cimport madvise, mlock, munlock, mincore, \
+                        MADV_NORMAL, MADV_RANDOM, MADV_SEQUENTIAL, \
+                        MADV_WILLNEED, MADV_DONTNEED, MADV_HUGEPAGE
+
+
+#: The size of a page
+PAGE_SIZE = mmap.PAGESIZE
+
+#: The names of the hints that :func:`advise` accepts
+advice_names = {
+    "normal": MADV_NORMAL,
+    "random": MADV_RANDOM,
+    "sequential": MADV_SEQUENTIAL,
+    "willneed": MADV_WILLNEED,
+    "dontneed": MADV_DONTNEED,
+    "hugepage": MADV_HUGEPAGE,
+}
+
+
+cdef const unsigned char* pages(const unsigned char[:] array, size_t offset,
+                                size_t length, size_t* pages_length) except NULL:
+    """The start of the pages containing [offset, offset + length)"""
+    cdef size_t page_size = PAGE_SIZE
+    cdef size_t start = offset - offset % page_size
+    cdef size_t end = offset + length
+
+    if length == 0 or end > <size_t> array.shape[0]:
+        raise ValueError("Bad range {0}+{1}".format(offset, length))
+
+    pages_length[0] = end - start
+    return &array[start]
+
+
+cdef int check(int result) except -1:
+    if result != 0:
+        raise OSError(errno, os.strerror(errno))
+    return 0
+
+
+def advise(const unsigned char[:] array, advice, size_t offset,
+           size_t length):
+    """Give the kernel a hint (see :data:`advice_names`) about a range"""
+    cdef size_t n
+    cdef const unsigned char* start = pages(array, offset, length, &n)
+    check(madvise(<void*> start, n, advice_names[advice]))
+
+
+def lock(const unsigned char[:] array, size_t offset, size_t length):
+    """Lock a range into RAM (raises :exc:`OSError` if it cannot)"""
+    cdef size_t n
+    cdef const unsigned char* start = pages(array, offset, length, &n)
+    check(mlock(start, n))
+
+
+def unlock(const unsigned char[:] array, size_t offset, size_t length):
+    """Undo :func:`lock`"""
+    cdef size_t n
+    cdef const unsigned char* start = pages(array, offset, length, &n)
+    check(munlock(start, n))
+
+
+def touch(const unsigned char[:] array, size_t offset, size_t length):
+    """
+    Read a byte from every page in a range, so that it is read from disk
+
+    The GIL is released, so this may be called from a background thread
+    without stalling the others while pages are read.
+    """
+
+    cdef size_t n, i
+    cdef size_t page_size = PAGE_SIZE
+    cdef const unsigned char* start = pages(array, offset, length, &n)
+    cdef volatile unsigned char total = 0
+
+    with nogil:
+        i = 0
+        while i < n:
+            total += start[i]
+            i += page_size
+
+
+def resident(const unsigned char[:] array):
+    """
+    Which pages of `array` are in RAM
+
+    Returns a :class:`bytearray` with an element for each page of the
+    array, which is non-zero if it is resident.
+    """
+
+    cdef size_t n, i
+    cdef const unsigned char* start = pages(array, 0, array.shape[0], &n)
+    cdef size_t page_size = PAGE_SIZE
+    result = bytearray((n + page_size - 1) // page_size)
+    cdef unsigned char[:] vec = result
+
+    check(mincore(<void*> start, n, &vec[0]))
+    for i in range(len(result)):
+        vec[i] &= 1
+    return result
+
+
+def main():
+    # (imported here, as tawhiri.dataset imports this module)
+    from .dataset import Dataset
+
+    parser = argparse.ArgumentParser(
+            description="Report how much of each wind dataset is in RAM")
+    parser.add_argument("-d", "--directory", default=Dataset.DEFAULT_DIRECTORY,
+            help="directory containing the datasets (default: %(default)s)")
+    parser.add_argument("--hours", action="store_true",
+            help="also show the fraction of each hour that is in RAM")
+    args = parser.parse_args()
+
+    # The page cache is shared, so mapping the datasets here shows how much
+    # of them is available to the predictor.
+    for row in sorted(Dataset.listdir(args.directory)):
+        try:
+            dataset = Dataset(row.ds_time, directory=args.directory,
+                              suffix=row.suffix)
+        except (IOError, ValueError) as e:
+            print("{0}: {1}".format(row.filename, e))
+            continue
+
+        report = dataset.residency_report()
+        print("{0}: {1:.0f}/{2:.0f} MiB ({3:.1%}) resident".format(
+                row.filename, report["resident"] / 2**20,
+                report["size"] / 2**20, report["resident"] / report["size"]))
+        if args.hours:
+            for i, fraction in zip(dataset.extent.hour, report["hours"]):
+                print("    {0:3d}h {1:6.1%}".format(dataset.axes.hour[i],
+                                                   fraction))
+        dataset.close()
@@ -0,0 +1,44 @@
+# Copyright 2014 (C) Adam Greig, Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+from .interpolate cimport Interpolator
+
+cdef struct Vector:
+    double lat
+    double lng
+    double alt
+
+# Models and terminators that the solver can call without going through
+# Python. See tawhiri.native for implementations.
+
+cdef class Model:
+    cdef int f(self, double t, Vector y, Vector* out) except -1
+    cdef Interpolator wind_source(self, double* epoch)
+    cdef int f_wind(self, double t, Vector y, double u, double v,
+                    Vector* out) except -1
+
+cdef class Terminator:
+    cdef bint tc(self, double t, Vector y) except -1
+    cdef bint distance(self, double t, Vector y, double* out) except -1
+    cdef list fired(self, double t, Vector y)
+
+cdef Model as_model(object model)
+cdef Terminator as_terminator(object terminator)
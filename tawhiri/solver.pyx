@@ -21,28 +21,149 @@
 Perform numerical integration of the balloon state.
 """
 
-def solve(t, lat, lng, alt, chain):
+from libc.math cimport sqrt, pow, cos, fabs, M_PI
+from cpython cimport array
+from cpython.mem cimport PyMem_Malloc, PyMem_Free
+
+from .interpolate cimport Interpolator, raise_status
+from .workcounts cimport WorkCounts
+import array
+
+def solve(t, lat, lng, alt, chain, integrator=None):
     """Solve from initial conditions `t`, `lat`, `lng`, and `alt`, using
        models and termination criteria from `chain`, an iterable of (model,
        terminator) pairs which make up each stage of the flight.
+
+       Each stage is integrated by `integrator`, which is :func:`rk4` by
+       default, or :func:`dopri5` (use :func:`functools.partial` to change
+       their options).
+    """
+    return list(solve_iter(t, lat, lng, alt, chain, integrator))
+
+def solve_iter(t, lat, lng, alt, chain, integrator=None):
+    """Like :func:`solve`, but yield each stage as soon as it is integrated
+       (so that it may be sent on while the later stages are integrated).
     """
-    results = []
+    if integrator is None:
+        integrator = rk4
+
     for model, terminator in chain:
-        stage = rk4(t, lat, lng, alt, model, terminator)
-        results.append(stage)
+        stage = integrator(t, lat, lng, alt, model, terminator)
+        yield stage
         t, lat, lng, alt = stage[-1]
-    return results
 
 # Keeping all the components as separate variables is quite unpleasant.
 # We don't want to pay the cost of numpy, or repeatedly boxing and unboxing
 # tuples.
-# Soln: cython & structs (so that they may be passed & returned by value),
-# thin wrapper so that they may be passed to and returned by `f`.
+# Soln: cython & structs (so that they may be passed & returned by value).
+# Models and terminators are extension types (see solver.pxd), so that the
+# integration loop may call them directly; Python callables are wrapped
+# by PyModel and PyTerminator.
+
+cdef class Model:
+    """
+    A model that the solver can call natively
+
+    Subclasses implement ``f``, which sets `out` to the derivative of the
+    state `y` at time `t`. Models are also callable from Python, like
+    the functions in :mod:`tawhiri.models`:
+    ``model(t, lat, lng, alt) -> (dlat, dlng, dalt)``.
+
+    Models that get the wind from an :class:`Interpolator` may also
+    implement ``wind_source``, which returns it (and sets `epoch` to the
+    time of the start of its dataset), and ``f_wind``, which is ``f`` given
+    the wind ``(u, v)`` at that point; :func:`rk4_ensemble` then looks up
+    the winds of many balloons at once.
+    """
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        raise NotImplementedError
+
+    cdef Interpolator wind_source(self, double* epoch):
+        """The interpolator that this model gets the wind from, if any"""
+        return None
+
+    cdef int f_wind(self, double t, Vector y, double u, double v,
+                    Vector* out) except -1:
+        """As f, with the wind at (`t`, `y`) (see wind_source)"""
+        return self.f(t, y, out)
+
+    def __call__(self, double t, double lat, double lng, double alt):
+        cdef Vector y, r
+        y.lat, y.lng, y.alt = lat, lng, alt
+        self.f(t, y, &r)
+        return r.lat, r.lng, r.alt
+
+cdef class Terminator:
+    """
+    A termination criterion that the solver can call natively
+
+    Subclasses implement ``tc``, which returns true when integration
+    should stop. Terminators are also callable from Python:
+    ``terminator(t, lat, lng, alt) -> bool``.
+
+    Subclasses may also implement ``distance``, which sets ``out`` to the
+    signed distance (in metres, or seconds) from a point to where the
+    terminator fires: positive where ``tc`` is false, negative where it is
+    true, and zero on the boundary (where ``tc`` decides). The solver can
+    then find that point by root finding (see `termination_distance` of
+    :func:`rk4`). A combination of terminators implements ``fired``
+    instead, so that the solver finds the point of whichever of them fired,
+    by its own distance.
+    """
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        raise NotImplementedError
+
+    cdef bint distance(self, double t, Vector y, double* out) except -1:
+        """Set `out`, and return true, if this terminator can"""
+        return False
 
-cdef struct Vector:
-    double lat
-    double lng
-    double alt
+    cdef list fired(self, double t, Vector y):
+        """The terminators that fire at (t, y): this one, if it does"""
+        return [self] if self.tc(t, y) else []
+
+    def __call__(self, double t, double lat, double lng, double alt):
+        cdef Vector y
+        y.lat, y.lng, y.alt = lat, lng, alt
+        return self.tc(t, y)
+
+cdef class PyModel(Model):
+    """Wraps a Python function ``f(t, lat, lng, alt) -> (dlat, dlng, dalt)``"""
+
+    cdef object model
+
+    def __init__(self, model):
+        self.model = model
+
+    cdef int f(self, double t, Vector y, Vector* out) except -1:
+        out[0] = tuptovec(self.model(t, y.lat, y.lng, y.alt))
+        return 0
+
+cdef class PyTerminator(Terminator):
+    """Wraps a Python function ``tc(t, lat, lng, alt) -> bool``"""
+
+    cdef object terminator
+
+    def __init__(self, terminator):
+        self.terminator = terminator
+
+    cdef bint tc(self, double t, Vector y) except -1:
+        return bool(self.terminator(t, y.lat, y.lng, y.alt))
+
+cdef Model as_model(object model):
+    """Return `model` if it is a :class:`Model`, else wrap it"""
+    if isinstance(model, Model):
+        return model
+    else:
+        return PyModel(model)
+
+cdef Terminator as_terminator(object terminator):
+    """Return `terminator` if it is a :class:`Terminator`, else wrap it"""
+    if isinstance(terminator, Terminator):
+        return terminator
+    else:
+        return PyTerminator(terminator)
 
 cdef Vector vecadd(Vector a, double k, Vector b):
     """a + k * b"""
@@ -80,103 +201,754 @@ cdef Vector veclerp(Vector a, Vector b, double l):
     r.alt = lerp(a.alt, b.alt, l)
     return r
 
+cdef Vector vechermite(Vector a, Vector da, Vector b, Vector db, double h,
+                       double l):
+    """
+    Cubic Hermite interpolation between a and b, with derivatives da and db
+    and time h between them, at fraction l of the way from a to b
+    """
+    cdef double h00, h10, h01, h11
+    cdef Vector r
+
+    h00 = (1 + 2 * l) * (1 - l) * (1 - l)
+    h10 = l * (1 - l) * (1 - l)
+    h01 = l * l * (3 - 2 * l)
+    h11 = l * l * (l - 1)
+
+    # unwrap b.lng so that it is within 180 degrees of a.lng
+    if b.lng - a.lng > 180.0:
+        b.lng -= 360.0
+    elif a.lng - b.lng > 180.0:
+        b.lng += 360.0
+
+    r.lat = h00 * a.lat + h10 * h * da.lat + h01 * b.lat + h11 * h * db.lat
+    r.lng = h00 * a.lng + h10 * h * da.lng + h01 * b.lng + h11 * h * db.lng
+    r.alt = h00 * a.alt + h10 * h * da.alt + h01 * b.alt + h11 * h * db.alt
+    r.lng %= 360.0
+    return r
+
 cdef Vector tuptovec(object tup):
     cdef Vector r
     r.lat, r.lng, r.alt = tup
     return r
 
-# Don't appear to be able to cdef closures / make efficient closures.
-cdef class Configuration:
-    cdef object model, terminator
+cdef int rk4_step(Model model, double t, Vector y, double dt,
+                  Vector* out) except -1:
+    """Set `out` to the state a time `dt` after (`t`, `y`)"""
+    cdef Vector k1, k2, k3, k4, y2
+
+    model.f(t, y, &k1)
+    model.f(t + dt / 2, vecadd(y, dt / 2, k1), &k2)
+    model.f(t + dt / 2, vecadd(y, dt / 2, k2), &k3)
+    model.f(t + dt, vecadd(y, dt, k3), &k4)
+
+    out[0] = rk4_combine(y, dt, k1, k2, k3, k4)
+    return 0
+
+cdef inline Vector rk4_combine(Vector y, double dt, Vector k1, Vector k2,
+                               Vector k3, Vector k4):
+    """y + dt * (k1 + 2*k2 + 2*k3 + k4)/6"""
+    y = vecadd(y, dt / 6, k1)
+    y = vecadd(y, dt / 3, k2)
+    y = vecadd(y, dt / 3, k3)
+    y = vecadd(y, dt / 6, k4)
+    return y
+
+cdef inline Vector rk4_stage(int stage, double t, Vector y, double dt,
+                             Vector* k, double* t_stage):
+    """
+    The point at which rk4_step evaluates the model for `stage` (0 to 3),
+    given the derivatives k[0:stage] of the earlier stages
+    """
+    if stage == 0:
+        t_stage[0] = t
+        return y
+    elif stage == 3:
+        t_stage[0] = t + dt
+        return vecadd(y, dt, k[2])
+    else:
+        t_stage[0] = t + dt / 2
+        return vecadd(y, dt / 2, k[stage - 1])
+
+# A step that the terminator fired at the end of, which is interpolated
+# linearly, or (if hermite) with the derivatives at each end
+cdef struct Step:
+    double t, t2
+    Vector y, y2
+    Vector dy, dy2
+    bint hermite
+
+cdef Vector step_at(Step* step, double l):
+    """The point a fraction `l` of the way through `step`"""
+    if step.hermite:
+        return vechermite(step.y, step.dy, step.y2, step.dy2,
+                          step.t2 - step.t, l)
+    else:
+        return veclerp(step.y, step.y2, l)
 
-    def __init__(self, model, terminator):
-        self.model = model
-        self.terminator = terminator
+# The most evaluations find_root makes in the middle of a step
+DEF MAX_ROOT_ITERATIONS = 50
+
+cdef inline bint fires(Terminator terminator, double t, Vector y,
+                       double d) except -1:
+    """
+    Does `terminator` fire at (t, y), where its distance is `d`? (On the
+    boundary, only its tc knows, since some terminators fire there and
+    some only beyond it.)
+    """
+    if d == 0:
+        return terminator.tc(t, y)
+    return d < 0
+
+cdef bint find_root(Terminator terminator, Step* step, double tolerance,
+                    double* t3, Vector* y3) except -1:
+    """
+    Find a point (t3, y3) in `step` within `tolerance` of where the
+    terminator fires, using its distance (see :class:`Terminator`)
+
+    Uses the Illinois variant of the method of false position, which keeps
+    the point bracketed (like bisection) but, where the distance changes
+    smoothly along the step (as altitude does), converges in a few
+    evaluations. Returns false if the terminator cannot measure its
+    distance.
+    """
+
+    cdef double left, right, mid, f_left, f_right, f_mid
+    cdef int i, side
+
+    if not terminator.distance(step.t, step.y, &f_left):
+        return False
+    terminator.distance(step.t2, step.y2, &f_right)
 
-    cdef Vector f(self, double t, Vector y) except *:
-        return tuptovec(self.model(t, y.lat, y.lng, y.alt))
+    left = 0.0
+    right = 1.0
+
+    # in case the loop executes zero times
+    t3[0] = step.t2
+    y3[0] = step.y2
+
+    if fires(terminator, step.t, step.y, f_left):
+        # (the terminator fires at the start of the step)
+        t3[0] = step.t
+        y3[0] = step.y
+        return True
+    if not fires(terminator, step.t2, step.y2, f_right):
+        # (the distance disagrees with tc at the end of the step, which
+        # will have to do)
+        return True
+
+    side = 0
+    for i in range(MAX_ROOT_ITERATIONS):
+        mid = (left * f_right - right * f_left) / (f_right - f_left)
+        t3[0] = lerp(step.t, step.t2, mid)
+        y3[0] = step_at(step, mid)
+        terminator.distance(t3[0], y3[0], &f_mid)
+
+        if fabs(f_mid) <= tolerance:
+            return True
+
+        # replace the end on the same side, and if the same end was kept
+        # twice in a row, halve its distance (the Illinois modification)
+        if not fires(terminator, t3[0], y3[0], f_mid):
+            left, f_left = mid, f_mid
+            if side == 1:
+                f_right /= 2
+            side = 1
+        else:
+            right, f_right = mid, f_mid
+            if side == -1:
+                f_left /= 2
+            side = -1
 
-    cdef bint tc(self, double t, Vector y) except *:
-        return self.terminator(t, y.lat, y.lng, y.alt)
+        if right - left <= 1e-9:
+            break
+
+    # the distance jumps (e.g., at the edge of a cliff), so take the
+    # point just after it
+    t3[0] = lerp(step.t, step.t2, right)
+    y3[0] = step_at(step, right)
+    return True
+
+cdef bint find_first_root(Terminator terminator, Step* step,
+                          double tolerance, double* t3,
+                          Vector* y3) except -1:
+    """
+    find_root, for each of the terminators that fire at the end of `step`
+    (see Terminator.fired) by its own distance, taking the earliest point.
+    Returns false if any of them cannot measure its distance.
+    """
+
+    cdef Terminator fired
+    cdef double t4
+    cdef Vector y4
+    cdef bint found = False
+
+    for fired in terminator.fired(step.t2, step.y2):
+        if not find_root(fired, step, tolerance, &t4, &y4):
+            return False
+        if not found or fabs(t4 - step.t) < fabs(t3[0] - step.t):
+            t3[0] = t4
+            y3[0] = y4
+            found = True
+    return found
+
+cdef int bisect(Terminator terminator, double t, Vector y, double t2, Vector y2,
+                double termination_tolerance, double* t3, Vector* y3) except -1:
+    """
+    Binary search to find a point (t3, y3) between (t, y) and (t2, y2)
+    close to where the terminator becomes true
+    """
+
+    cdef double left, right, mid
+
+    # binary search for the constant l in [0, 1]
+    # such that (t3, y3) = (1 - l) * (t, y) + l * (t2, y2)
+    # is near where tc(t3, y3) becomes true
+    left = 0.0
+    right = 1.0
+
+    # in case the loop executes zero times
+    t3[0] = t2
+    y3[0] = y2
+
+    while right - left > termination_tolerance:
+        mid = (left + right) / 2
+        t3[0] = lerp(t, t2, mid)
+        y3[0] = veclerp(y, y2, mid)
+
+        if terminator.tc(t3[0], y3[0]):
+            right = mid
+        else:
+            left = mid
+
+    return 0
+
+cdef int refine(Terminator terminator, double t, Vector y, double t2,
+                Vector y2, double termination_tolerance,
+                object termination_distance,
+                double* t3, Vector* y3) except -1:
+    """
+    Find a point (t3, y3) between (t, y) and (t2, y2) close to where the
+    terminator becomes true: with find_first_root, if `termination_distance`
+    is not None and the terminator can measure its distance, else by bisect
+    """
+
+    cdef Step step
+
+    if termination_distance is not None:
+        step.t, step.y, step.t2, step.y2 = t, y, t2, y2
+        step.hermite = False
+        if find_first_root(terminator, &step, termination_distance, t3, y3):
+            return 0
+
+    return bisect(terminator, t, y, t2, y2, termination_tolerance, t3, y3)
 
 def rk4(double t, double lat, double lng, double alt,
         object model, object terminator,
-        double dt=60.0, double termination_tolerance=0.01):
+        double dt=60.0, double termination_tolerance=0.01,
+        object termination_distance=None, double output_interval=0.0,
+        WorkCounts workcounts=None):
     """
     Use RK4 to integrate from initial conditions `t`, `lat`, `lng` and `alt`,
     using model `f` and termination criterion `terminator`, at timestep `dt`.
+
+    `model` and `terminator` may be native (:class:`Model` and
+    :class:`Terminator`, as produced by :mod:`tawhiri.models`) or plain
+    Python functions.
+
+    The last step is refined to find where the terminator fires by
+    bisection, to within `termination_tolerance` of the step; or, if
+    `termination_distance` is given and the terminator can measure its
+    distance (as the native burst, sea level, elevation and time
+    terminators can), by root finding, until within `termination_distance`
+    metres (or seconds, for a time terminator) of it, which takes fewer
+    evaluations of the terminator.
+
+    Every step is added to the result unless `output_interval` is given, in
+    which case only steps at least `output_interval` seconds after the last
+    one added are (the integration itself is unchanged). The first and final
+    points are always added.
+
+    The steps taken are counted in `workcounts`, if given.
     """
 
-    cfg = Configuration(model, terminator)
+    cdef Model cfg_model = as_model(model)
+    cdef Terminator cfg_term = as_terminator(terminator)
 
     # the current location
     cdef Vector y
     y.lat, y.lng, y.alt = (lat, lng, alt)
 
     result = [(t, y.lat, y.lng, y.alt)]
-
-    # rk4 variables
-    cdef Vector k1, k2, k3, k4
+    cdef double last_output = t
 
     # the next point
     cdef double t2
     cdef Vector y2
 
     while True:
-        k1 = cfg.f(t, y)
-        k2 = cfg.f(t + dt / 2, vecadd(y, dt / 2, k1))
-        k3 = cfg.f(t + dt / 2, vecadd(y, dt / 2, k2))
-        k4 = cfg.f(t + dt, vecadd(y, dt, k3))
-
-        # y2 = y + (k1 + 2*k2 + 2*k3 + k4)/6
-        y2 = y
-        y2 = vecadd(y2, dt / 6, k1)
-        y2 = vecadd(y2, dt / 3, k2)
-        y2 = vecadd(y2, dt / 3, k3)
-        y2 = vecadd(y2, dt / 6, k4)
-
+        rk4_step(cfg_model, t, y, dt, &y2)
         t2 = t + dt
+        if workcounts is not None:
+            workcounts.solver_steps += 1
 
-        if cfg.tc(t2, y2):
+        if cfg_term.tc(t2, y2):
             # when the termination condition is met,
             # leave the previous point in (t, y) and the next point in
             # (t2, y2) ...
             break
 
-        # otherwise, update the current point and add it to the list.
+        # otherwise, update the current point and add it to the list
+        # (if it is due).
         t = t2
         y = y2
 
-        result.append((t, y.lat, y.lng, y.alt))
+        if t - last_output >= output_interval:
+            result.append((t, y.lat, y.lng, y.alt))
+            last_output = t
 
-    # ... and binary search to find a point (t3, y3) between
-    # (t, y) and (t2, y2) close to where the terminator becomes true
-    cdef double left, right
+    # ... and find the point (t3, y3) where the terminator becomes true
     cdef double t3
     cdef Vector y3
 
-    # binary search for the constant l in [0, 1]
-    # such that (t3, y3) = (1 - l) * (t, y) + l * (t2, y2)
-    # is near where tc(t3, y3) becomes true
+    refine(cfg_term, t, y, t2, y2, termination_tolerance,
+           termination_distance, &t3, &y3)
+
+    # add the final point to the result
+    result.append((t3, y3.lat, y3.lng, y3.alt))
+    # the point (t2, y2) is discarded
+
+    return result
+
+# Dormand-Prince 5(4) coefficients
+# (Hairer, Norsett & Wanner, Solving Ordinary Differential Equations I)
+cdef double[7] dp_c = [0.0, 1/5., 3/10., 4/5., 8/9., 1.0, 1.0]
+cdef double[7][6] dp_a = [
+    [0, 0, 0, 0, 0, 0],
+    [1/5., 0, 0, 0, 0, 0],
+    [3/40., 9/40., 0, 0, 0, 0],
+    [44/45., -56/15., 32/9., 0, 0, 0],
+    [19372/6561., -25360/2187., 64448/6561., -212/729., 0, 0],
+    [9017/3168., -355/33., 46732/5247., 49/176., -5103/18656., 0],
+    [35/384., 0, 500/1113., 125/192., -2187/6784., 11/84.]
+]
+# difference between the 5th and 4th order weights
+cdef double[7] dp_e = [71/57600., 0, -71/16695., 71/1920., -17253/339200.,
+                       22/525., -1/40.]
+
+# radius of the earth (metres), for measuring errors
+DEF EARTH_RADIUS = 6371009.0
+
+cdef Vector veccomb(Vector* k, double* a, int n):
+    """sum(a[i] * k[i] for i in range(n))"""
+    cdef Vector r
+    cdef int i
+    r.lat = r.lng = r.alt = 0.0
+    for i in range(n):
+        r.lat += a[i] * k[i].lat
+        r.lng += a[i] * k[i].lng
+        r.alt += a[i] * k[i].alt
+    return r
+
+def dopri5(double t, double lat, double lng, double alt,
+           object model, object terminator,
+           double dt=60.0, double termination_tolerance=0.6,
+           double atol=1.0, double rtol=1e-6,
+           double dt_min=1.0, double dt_max=300.0,
+           object termination_distance=None, double output_interval=0.0,
+           WorkCounts workcounts=None):
+    """
+    Integrate like :func:`rk4`, but with an adaptive step size
+
+    Uses the Dormand-Prince 5(4) embedded Runge-Kutta pair, reusing the
+    last evaluation of each step as the first of the next. `dt` is the
+    initial step, which is then adjusted (between `dt_min` and `dt_max`
+    seconds) to keep the estimated error in each step under `atol` metres
+    horizontally, and `atol` + `rtol` * altitude metres vertically.
+
+    Note that, since steps vary in length, `termination_tolerance` is in
+    seconds rather than a fraction of the step. `termination_distance`,
+    `output_interval` and `workcounts` are as for :func:`rk4` (rejected
+    steps are counted too).
+
+    The wind is interpolated linearly between pressure levels, and the
+    error estimate cannot see the kinks at each level (it is exact on
+    each linear piece), so `dt_max` rather than `atol` limits the error
+    over long steps: the default gives about the same landing accuracy as
+    :func:`rk4` at 60s.
+    """
+
+    cdef Model cfg_model = as_model(model)
+    cdef Terminator cfg_term = as_terminator(terminator)
+
+    cdef Vector y
+    y.lat, y.lng, y.alt = (lat, lng, alt)
+
+    result = [(t, y.lat, y.lng, y.alt)]
+    cdef double last_output = t
+
+    cdef Vector[7] k
+    cdef Vector y2, err
+    cdef double t2, error, scale_alt, factor
+    cdef int i
+    cdef bint accept
+
+    cfg_model.f(t, y, &k[0])
+
+    while True:
+        if workcounts is not None:
+            workcounts.solver_steps += 1
+        for i in range(1, 7):
+            cfg_model.f(t + dp_c[i] * dt, vecadd(y, dt, veccomb(k, dp_a[i], i)),
+                        &k[i])
+
+        # k[6] was evaluated at the 5th order solution (dp_a[6] are its
+        # weights) ...
+        y2 = vecadd(y, dt, veccomb(k, dp_a[6], 6))
+        t2 = t + dt
+
+        # ... and the difference to the embedded 4th order solution
+        # estimates the error, which we measure in metres
+        err = veccomb(k, dp_e, 7)
+        err.lat *= dt * M_PI / 180.0 * EARTH_RADIUS
+        err.lng *= dt * M_PI / 180.0 * EARTH_RADIUS * cos(y.lat * M_PI / 180.0)
+        err.alt *= dt
+        scale_alt = atol + rtol * max(fabs(y.alt), fabs(y2.alt))
+        error = sqrt(((err.lat / atol) ** 2 + (err.lng / atol) ** 2 +
+                      (err.alt / scale_alt) ** 2) / 3)
+
+        accept = error <= 1.0 or dt <= dt_min
+
+        if error == 0:
+            factor = 5.0
+        elif error != error:
+            # NaN: shrink the step, and let dt_min take care of accepting it
+            factor = 0.2
+        else:
+            factor = min(5.0, max(0.2, 0.9 * pow(error, -0.2)))
+
+        if accept:
+            if cfg_term.tc(t2, y2):
+                break
+
+            t = t2
+            y = y2
+            # first same as last
+            k[0] = k[6]
+
+            if t - last_output >= output_interval:
+                result.append((t, y.lat, y.lng, y.alt))
+                last_output = t
+
+        dt = min(dt_max, max(dt_min, dt * factor))
+
+    # find_first_root or binary search as in refine(...), but interpolating
+    # with the derivatives at each end of the step (k[0] and k[6])
+    cdef double left, right, mid, t3
+    cdef Vector y3
+    cdef Step step
+
+    if termination_distance is not None:
+        step.t, step.y, step.dy = t, y, k[0]
+        step.t2, step.y2, step.dy2 = t2, y2, k[6]
+        step.hermite = True
+        if find_first_root(cfg_term, &step, termination_distance,
+                           &t3, &y3):
+            result.append((t3, y3.lat, y3.lng, y3.alt))
+            return result
+
     left = 0.0
     right = 1.0
-
-    # in case the loop executes zero times
     t3 = t2
     y3 = y2
 
-    while right - left > termination_tolerance:
+    while (right - left) * (t2 - t) > termination_tolerance:
         mid = (left + right) / 2
         t3 = lerp(t, t2, mid)
-        y3 = veclerp(y, y2, mid)
+        y3 = vechermite(y, k[0], y2, k[6], t2 - t, mid)
 
-        if cfg.tc(t3, y3):
+        if cfg_term.tc(t3, y3):
             right = mid
         else:
             left = mid
 
-    # add the final point to the result
     result.append((t3, y3.lat, y3.lng, y3.alt))
-    # the point (t2, y2) is discarded
 
     return result
+
+def solve_ensemble(ts, lats, lngs, alts, chains, double dt=60.0,
+                   double termination_tolerance=0.01,
+                   object termination_distance=None,
+                   double output_interval=0.0, WorkCounts workcounts=None):
+    """
+    Solve for many balloons at once
+
+    Member ``i`` of the ensemble starts from initial conditions ``ts[i]``,
+    ``lats[i]``, ``lngs[i]`` and ``alts[i]``, and flies ``chains[i]``, which
+    is a chain as for :func:`solve`. All chains must have the same number
+    of stages (see :func:`tawhiri.models.standard_ensemble`).
+
+    Returns a list with an entry per member: either that member's stages
+    (as returned by :func:`solve`), or, if integrating that member raised
+    an exception, the exception.
+    """
+
+    cdef Py_ssize_t i, n_members, n_stages
+
+    chains = [tuple(chain) for chain in chains]
+    n_members = len(chains)
+    if not len(ts) == len(lats) == len(lngs) == len(alts) == n_members:
+        raise ValueError("Need initial conditions for every member")
+    if n_members == 0:
+        return []
+
+    n_stages = len(chains[0])
+    if any(len(chain) != n_stages for chain in chains):
+        raise ValueError("All chains must have the same number of stages")
+
+    results = [[] for i in range(n_members)]
+    errors = [None] * n_members
+    starts = [(ts[i], lats[i], lngs[i], alts[i]) for i in range(n_members)]
+
+    for stage in range(n_stages):
+        members = [i for i in range(n_members) if errors[i] is None]
+        stages = rk4_ensemble([starts[i] for i in members],
+                              [chains[i][stage][0] for i in members],
+                              [chains[i][stage][1] for i in members],
+                              dt, termination_tolerance,
+                              termination_distance, output_interval,
+                              workcounts)
+
+        for i, result in zip(members, stages):
+            if isinstance(result, Exception):
+                errors[i] = result
+            else:
+                results[i].append(result)
+                starts[i] = result[-1]
+
+    return [errors[i] if errors[i] is not None else results[i]
+            for i in range(n_members)]
+
+def rk4_ensemble(starts, models, terminators,
+                 double dt=60.0, double termination_tolerance=0.01,
+                 object termination_distance=None,
+                 double output_interval=0.0, WorkCounts workcounts=None):
+    """
+    Integrate one stage for many balloons in lockstep
+
+    `starts` is a list of ``(t, lat, lng, alt)`` initial conditions, and
+    `models` and `terminators` the model and terminator for each member.
+    All live members are advanced by one step at a time; each member drops
+    out when its terminator fires, after the same refinement as :func:`rk4`;
+    `output_interval` and `workcounts` (a step of each member counts) are
+    also as for :func:`rk4`.
+
+    At each of the four evaluations of a step, the winds of all the live
+    members whose models share an interpolator (see :class:`Model`) are
+    looked up in one batch; the result is the same as if each member had
+    been integrated by :func:`rk4`.
+
+    Returns a list with the trajectory for each member (as :func:`rk4`
+    would return), or the exception raised while integrating that member.
+    """
+
+    cdef Py_ssize_t n, n_live, n_sources, i, j, g, first, count
+    cdef int stage
+    cdef list member_models, member_terminators, results, sources
+    cdef dict source_index
+    cdef Model model
+    cdef Terminator terminator
+    cdef Interpolator source
+    cdef double epoch
+
+    n = len(starts)
+    if not len(models) == len(terminators) == n:
+        raise ValueError("Need a model and terminator for every member")
+
+    member_models = [as_model(m) for m in models]
+    member_terminators = [as_terminator(term) for term in terminators]
+    results = [[tuple(start)] for start in starts]
+
+    # structure of arrays: the current time and state of each member, the
+    # time of the last point added to its result, and the indices of the
+    # members that have not yet terminated
+    cdef array.array t_arr = array.array('d', [start[0] for start in starts])
+    cdef array.array last_output_arr = array.array('d', t_arr)
+    cdef array.array live_arr = array.array('l', range(n))
+    cdef double[:] t = t_arr
+    cdef double[:] last_output = last_output_arr
+    cdef long[:] live = live_arr
+
+    # the interpolator that each member gets its wind from, as an index
+    # into sources (or -1, if its model looks up its own wind), and the
+    # epoch of its dataset
+    sources = []
+    source_index = {}
+    cdef array.array source_arr = array.array('l', [-1]) * n
+    cdef array.array epoch_arr = array.array('d', [0.0]) * n
+    cdef long[:] member_source = source_arr
+    cdef double[:] member_epoch = epoch_arr
+    for i in range(n):
+        source = (<Model> member_models[i]).wind_source(&epoch)
+        if source is not None:
+            member_source[i] = source_index.setdefault(id(source),
+                                                       len(sources))
+            if member_source[i] == len(sources):
+                sources.append(source)
+            member_epoch[i] = epoch
+    n_sources = len(sources)
+
+    # the batches: the members of source g are in slots
+    # batch_start[g]:batch_start[g + 1] of the lookup arrays, in the order
+    # that they are in live (see slot)
+    cdef array.array batch_start_arr = array.array('l', [0]) * (n_sources + 1)
+    cdef array.array slot_arr = array.array('l', [0]) * n
+    cdef array.array lookup_arr = array.array('d', [0.0]) * (6 * n)
+    cdef array.array status_arr = array.array('b', [0]) * n
+    cdef long[:] batch_start = batch_start_arr
+    cdef long[:] slot = slot_arr
+    cdef double[::1] lookup = lookup_arr
+    cdef signed char[::1] status = status_arr
+    cdef array.array failed_arr = array.array('b', [0]) * n
+    cdef signed char[:] failed = failed_arr
+
+    # the state of each member, and the point (t_stage, y_stage) and
+    # derivative (k) of each of its evaluations in the current step
+    cdef array.array t_stage_arr = array.array('d', [0.0]) * n
+    cdef double[:] t_stage = t_stage_arr
+    cdef Vector* y = <Vector*> PyMem_Malloc(6 * n * sizeof(Vector))
+    cdef Vector* y_stage = y + n
+    cdef Vector* k = y + 2 * n
+
+    if n and not y:
+        raise MemoryError()
+
+    cdef double* hours = NULL
+    cdef double* lats = NULL
+    cdef double* lngs = NULL
+    cdef double* alts = NULL
+    cdef double* us = NULL
+    cdef double* vs = NULL
+    if n:
+        hours = &lookup[0]
+        lats, lngs, alts = hours + n, hours + 2 * n, hours + 3 * n
+        us, vs = hours + 4 * n, hours + 5 * n
+
+    cdef double t2, t3
+    cdef Vector y2, y3
+    cdef bint terminated
+
+    try:
+        for i in range(n):
+            y[i].lat, y[i].lng, y[i].alt = starts[i][1:]
+
+        n_live = n
+        while n_live > 0:
+            if workcounts is not None:
+                workcounts.solver_steps += n_live
+
+            for stage in range(4):
+                # allot the slots of the live members in each batch (again
+                # at each evaluation, since members that fail in one are
+                # not evaluated again)
+                for g in range(n_sources + 1):
+                    batch_start[g] = 0
+                for j in range(n_live):
+                    i = live[j]
+                    g = member_source[i]
+                    if g >= 0 and not failed[i]:
+                        batch_start[g + 1] += 1
+                for g in range(n_sources):
+                    batch_start[g + 1] += batch_start[g]
+                for j in range(n_live):
+                    i = live[j]
+                    g = member_source[i]
+                    if g >= 0 and not failed[i]:
+                        slot[i] = batch_start[g]
+                        batch_start[g] += 1
+                # (which moved each start up to the next)
+                for g in range(n_sources, 0, -1):
+                    batch_start[g] = batch_start[g - 1]
+                batch_start[0] = 0
+
+                for j in range(n_live):
+                    i = live[j]
+                    if failed[i]:
+                        continue
+                    y_stage[i] = rk4_stage(stage, t[i], y[i], dt, k + 4 * i,
+                                           &t_stage[i])
+                    if member_source[i] >= 0:
+                        hours[slot[i]] = \
+                            (t_stage[i] - member_epoch[i]) / 3600.0
+                        lats[slot[i]] = y_stage[i].lat
+                        lngs[slot[i]] = y_stage[i].lng
+                        alts[slot[i]] = y_stage[i].alt
+
+                for g in range(n_sources):
+                    first = batch_start[g]
+                    count = batch_start[g + 1] - first
+                    if count:
+                        (<Interpolator> sources[g]).lookup_batch(
+                            count, hours + first, lats + first, lngs + first,
+                            alts + first, us + first, vs + first,
+                            &status[first])
+
+                for j in range(n_live):
+                    i = live[j]
+                    if failed[i]:
+                        continue
+                    model = member_models[i]
+                    try:
+                        if member_source[i] >= 0:
+                            raise_status(status[slot[i]], hours[slot[i]],
+                                         lats[slot[i]], lngs[slot[i]],
+                                         alts[slot[i]])
+                            model.f_wind(t_stage[i], y_stage[i], us[slot[i]],
+                                         vs[slot[i]], &k[4 * i + stage])
+                        else:
+                            model.f(t_stage[i], y_stage[i], &k[4 * i + stage])
+                    except Exception as e:
+                        results[i] = e
+                        failed[i] = True
+
+            j = 0
+            while j < n_live:
+                i = live[j]
+                terminator = member_terminators[i]
+
+                if failed[i]:
+                    terminated = True
+                else:
+                    try:
+                        y2 = rk4_combine(y[i], dt, k[4 * i], k[4 * i + 1],
+                                         k[4 * i + 2], k[4 * i + 3])
+                        t2 = t[i] + dt
+
+                        if terminator.tc(t2, y2):
+                            refine(terminator, t[i], y[i], t2, y2,
+                                   termination_tolerance,
+                                   termination_distance, &t3, &y3)
+                            results[i].append((t3, y3.lat, y3.lng, y3.alt))
+                            terminated = True
+                        else:
+                            t[i] = t2
+                            y[i] = y2
+                            if t2 - last_output[i] >= output_interval:
+                                results[i].append((t2, y2.lat, y2.lng,
+                                                   y2.alt))
+                                last_output[i] = t2
+                            terminated = False
+                    except Exception as e:
+                        results[i] = e
+                        terminated = True
+
+                if terminated:
+                    # drop this member; the last live member takes its slot
+                    n_live -= 1
+                    live[j] = live[n_live]
+                else:
+                    j += 1
+    finally:
+        PyMem_Free(y)
+
+    return results
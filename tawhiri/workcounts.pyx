@@ -0,0 +1,43 @@
+# Copyright 2016 Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+# Cython compiler directives:
+#
+# cython: language_level=3
+
+"""
+A WorkCounts object counts the work done for a request, by the parts of
+the prediction that it is given to. Unlike counters in each module, these
+are not mixed up with those of the other requests that the process is
+running at the same time.
+"""
+
+cdef class WorkCounts:
+    """
+    The work done for a request: steps taken by the solver, lookups of the
+    wind (and how many of them moved to a new grid cell, so read the
+    dataset), lookups of the elevation dataset (rather than of the cache of
+    an :class:`tawhiri.elevation.Elevation`), and the time (in seconds) that
+    they took
+    """
+
+    def __init__(self):
+        self.solver_steps = 0
+        self.wind_lookups = 0
+        self.wind_cell_changes = 0
+        self.elevation_lookups = 0
+        self.elevation_seconds = 0.0
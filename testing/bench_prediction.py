@@ -7,7 +7,7 @@ from datetime import timedelta
 import calendar
 
 from tawhiri import solver, models
-from tawhiri.dataset import Dataset as WindDataset
+from tawhiri.dataset import DatasetRegistry
 from tawhiri.warnings import WarningCounts
 from ruaumoko import Dataset as ElevationDataset
 
@@ -20,13 +20,15 @@ alt0 = 0.0
 
 n_repeats = 100
 
+registry = DatasetRegistry()
+
 start_time = time.time()
 for i in range(n_repeats):
-    wind = WindDataset.open_latest(persistent=True)
-    t0 = wind.ds_time + timedelta(hours=12)
-    t0 = calendar.timegm(t0.timetuple())
-    stages = models.standard_profile(5.0, 30000, 5.0, wind, elevation, warningcounts)
-    result = solver.solve(t0, lat0, lng0, alt0, stages)
+    with registry.dataset() as wind:
+        t0 = wind.ds_time + timedelta(hours=12)
+        t0 = calendar.timegm(t0.timetuple())
+        stages = models.standard_profile(5.0, 30000, 5.0, wind, elevation, warningcounts)
+        result = solver.solve(t0, lat0, lng0, alt0, stages)
 end_time = time.time()
 
 print("Averaged {:.1f}ms per prediction".format(
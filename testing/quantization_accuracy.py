@@ -0,0 +1,113 @@
+import sys
+from os.path import abspath, split, join
+sys.path.append(join(split(abspath(__file__))[0], '..'))
+
+import argparse
+import calendar
+import math
+import random
+from datetime import timedelta
+
+from tawhiri import solver, models, interpolate
+from tawhiri.dataset import Dataset as WindDataset
+from tawhiri.warnings import WarningCounts
+
+
+# Compare landing positions predicted with a float32 dataset against those
+# predicted with a quantized copy of it (see tawhiri-convert --quantize),
+# from random launch sites and times.
+
+parser = argparse.ArgumentParser()
+parser.add_argument("float32_directory")
+parser.add_argument("quantized_directory")
+parser.add_argument("-n", "--predictions", type=int, default=100)
+parser.add_argument("--lat", type=float, nargs=2, default=(-60.0, 60.0),
+                    help="range of launch latitudes")
+parser.add_argument("--lng", type=float, nargs=2, default=(0.0, 360.0),
+                    help="range of launch longitudes")
+parser.add_argument("--hours", type=float, nargs=2, default=(0.0, 150.0),
+                    help="range of launch times (hours into the dataset)")
+parser.add_argument("--sea-level", action="store_true",
+                    help="land at sea level rather than on the ground "
+                         "(if no elevation dataset is available)")
+args = parser.parse_args()
+
+wind = WindDataset.open_latest(args.float32_directory)
+quantized = WindDataset(wind.ds_time, directory=args.quantized_directory)
+assert quantized.data_element_type == WindDataset.ELEMENT_INT16
+
+if args.sea_level:
+    elevation = None
+else:
+    from ruaumoko import Dataset as ElevationDataset
+    elevation = ElevationDataset()
+
+
+def chain(dataset, warningcounts):
+    if elevation is not None:
+        return models.standard_profile(5.0, 30000, 5.0, dataset, elevation,
+                                       warningcounts)
+
+    model_up = models.make_linear_model([
+        models.make_constant_ascent(5.0),
+        models.make_wind_velocity(dataset, warningcounts)])
+    model_down = models.make_linear_model([
+        models.make_drag_descent(5.0),
+        models.make_wind_velocity(dataset, warningcounts)])
+    return ((model_up, models.make_burst_termination(30000)),
+            (model_down, models.sea_level_termination))
+
+
+def distance(a, b):
+    _, lat1, lng1, _ = map(math.radians, a)
+    _, lat2, lng2, _ = map(math.radians, b)
+    h = math.sin((lat2 - lat1) / 2) ** 2 + \
+        math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * 6371009 * math.asin(math.sqrt(h))
+
+
+random.seed(0)
+errors = []
+failed = 0
+
+for i in range(args.predictions):
+    lat0 = random.uniform(*args.lat)
+    lng0 = random.uniform(*args.lng)
+    hour = random.uniform(*args.hours)
+    t0 = wind.ds_time + timedelta(hours=hour)
+    t0 = calendar.timegm(t0.timetuple())
+
+    try:
+        rise, fall = solver.solve(t0, lat0, lng0, 0.0,
+                                  chain(wind, WarningCounts()))
+        qrise, qfall = solver.solve(t0, lat0, lng0, 0.0,
+                                    chain(quantized, WarningCounts()))
+    except interpolate.RangeError:
+        failed += 1
+        continue
+
+    flight = distance(rise[0], fall[-1])
+    error = distance(fall[-1], qfall[-1])
+    errors.append((error, distance(fall[0], qfall[0]), flight))
+    print("{:6.2f}h {:8.3f} {:8.3f}  landing error {:7.1f}m, burst error "
+          "{:7.1f}m, flight {:7.1f}km".format(
+              hour, lat0, lng0,
+              error, errors[-1][1], flight / 1000))
+
+if not errors:
+    sys.exit("No predictions were in range")
+
+landing = sorted(e[0] for e in errors)
+burst = sorted(e[1] for e in errors)
+relative = sorted(e[0] / e[2] for e in errors if e[2] > 0)
+
+print()
+print("{} predictions ({} out of range)".format(len(errors), failed))
+for name, values, unit in (("landing error", landing, "m"),
+                           ("burst error", burst, "m"),
+                           ("landing error / flight distance",
+                            [x * 1e6 for x in relative], "ppm")):
+    print("{:32s} mean {:8.2f}{unit}  median {:8.2f}{unit}  "
+          "max {:8.2f}{unit}".format(
+              name, sum(values) / len(values), values[len(values) // 2],
+              values[-1], unit=unit))
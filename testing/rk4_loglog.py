@@ -4,10 +4,19 @@ matplotlib.use('Agg')
 import numpy as np
 import matplotlib.pyplot as plt
 
-from tawhiri.solver import rk4
+from tawhiri.solver import rk4, dopri5
 
 
+# Compare the convergence and cost (in model evaluations) of rk4 and dopri5
+# on a problem with a known solution. Plots error against step size for
+# rk4 (loglog.png), and error against model evaluations for both
+# integrators (cost.png).
+
+evaluations = 0
+
 def f(t, lat, lng, alt):
+    global evaluations
+    evaluations += 1
     return t * lat, t * lng, np.sin(t) ** 2
 
 def tc(t, lat, lng, alt):
@@ -16,17 +25,37 @@ def tc(t, lat, lng, alt):
 expx22 = np.exp(np.pi ** 2 / 8)
 expect = np.array([expx22, expx22, np.pi / 4])
 
-def test(dt):
-    result = rk4(0, 1, 1, 0, f, tc, dt)
+def run(integrator, **kwargs):
+    global evaluations
+    evaluations = 0
+    result = integrator(0, 1, 1, 0, f, tc, **kwargs)
     last = np.array(result[-1][1:])
-    print(dt, len(result), *(expect - last))
-    return expect - last
+    error = expect - last
+    print(integrator.__name__, kwargs, len(result), evaluations, *error)
+    return np.abs(error), evaluations
 
-steps = np.cast[int](10 ** np.linspace(0, 4, 20))
+steps = (10 ** np.linspace(0, 4, 20)).astype(int)
 dts = np.pi / (2 * steps)
-errors = np.array([test(dt) for dt in dts])
-errors = np.abs(errors)
+rk4_runs = [run(rk4, dt=dt) for dt in dts]
+rk4_errors = np.array([error for error, _ in rk4_runs])
+rk4_costs = np.array([cost for _, cost in rk4_runs])
 
-plt.loglog(dts, errors[:,1])
+plt.loglog(dts, rk4_errors[:,1])
 plt.loglog(dts, dts[:,np.newaxis] ** np.array([1, 2, 3, 4]))
 plt.savefig('loglog.png')
+plt.clf()
+
+# dopri5 measures its error in metres, treating lat & lng as degrees.
+atols = 10 ** np.linspace(6, -4, 20)
+dopri5_runs = [run(dopri5, dt=0.01, dt_min=1e-9, dt_max=1.0,
+                   termination_tolerance=1e-9, atol=atol, rtol=0.0)
+               for atol in atols]
+dopri5_errors = np.array([error for error, _ in dopri5_runs])
+dopri5_costs = np.array([cost for _, cost in dopri5_runs])
+
+plt.loglog(rk4_costs, rk4_errors[:,1], label='rk4')
+plt.loglog(dopri5_costs, dopri5_errors[:,1], label='dopri5')
+plt.xlabel('model evaluations')
+plt.ylabel('error')
+plt.legend()
+plt.savefig('cost.png')
@@ -1,8 +1,9 @@
+import glob
 import os
-import numpy as np
 import logging
 from datetime import datetime
-from tawhiri.wind import Dataset, unpack_grib
+from tawhiri.dataset import Dataset
+from tawhiri.ingest import ingest, GribReader
 
 directory = "datasets"
 ds_time = datetime(2013, 7, 9, 12, 0, 0)
@@ -16,16 +17,15 @@ root_logger.setLevel(logging.DEBUG)
 root_logger.addHandler(handler)
 
 logging.info("setup")
-gribmirror = Dataset.filename(ds_time, directory=directory, suffix=Dataset.SUFFIX_GRIBMIRROR)
-temp = Dataset(ds_time, directory=directory, suffix='.temp', new=True)
+gribs = sorted(glob.glob(os.path.join(directory, "gribs", "*.grib2")))
 actual = Dataset(ds_time, directory=directory)
-checklist = Dataset.checklist()
 
-logging.info("unpack")
-unpack_grib(gribmirror, temp, checklist)
+logging.info("ingest")
+ingest(ds_time, GribReader(gribs), directory=directory, suffix='.ingested')
+ingested = Dataset(ds_time, directory=directory, suffix='.ingested')
 
 logging.info("check")
-assert np.array_equal(actual.array, temp.array)
+assert actual.array[:] == ingested.array[:]
 
 logging.info("cleanup")
-os.unlink(Dataset.filename(ds_time, directory=directory, suffix='.temp'))
+os.unlink(ingested.fn)
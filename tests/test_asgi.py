@@ -0,0 +1,239 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+import asyncio
+import json
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from mock import patch
+from nose.tools import assert_equal, assert_raises
+
+from tawhiri import api
+from tawhiri.asgi import Application, Scheduler, \
+                         PRIORITY_STANDARD, PRIORITY_FLOAT, PRIORITY_BATCH
+
+
+query = dict(launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+             launch_datetime='2014-08-19T23:00:00Z',
+             ascent_rate=5, descent_rate=10, burst_altitude=30000)
+
+
+def call(application, method, path, query_string=b"", body=b""):
+    """Make a request of `application`: returns its status, headers and
+    body"""
+    messages = []
+    received = []
+
+    async def receive():
+        if received:
+            # (the client stays until the response is complete)
+            await asyncio.Event().wait()
+        received.append(True)
+        return {"type": "http.request", "body": body, "more_body": False}
+
+    async def send(message):
+        messages.append(message)
+
+    scope = {"type": "http", "method": method, "path": path,
+             "query_string": query_string, "headers": []}
+    asyncio.run(application(scope, receive, send))
+
+    start = messages[0]
+    body = b"".join(message.get("body", b"") for message in messages[1:])
+    return start["status"], dict(start["headers"]), body
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    def test_priority(self):
+        order = []
+        release = threading.Event()
+
+        def job(name):
+            release.wait()
+            order.append(name)
+            return name
+
+        async def run():
+            scheduler = Scheduler(self.executor, 1, (2, 2, 1))
+            futures = [scheduler.submit(PRIORITY_FLOAT, job, "running"),
+                       scheduler.submit(PRIORITY_FLOAT, job, "float"),
+                       scheduler.submit(PRIORITY_BATCH, job, "batch"),
+                       scheduler.submit(PRIORITY_STANDARD, job, "standard")]
+            assert not scheduler.admit(PRIORITY_BATCH)
+            with assert_raises(api.ServiceUnavailableException):
+                scheduler.submit(PRIORITY_BATCH, job, "refused")
+
+            # a cancelled job is not run
+            scheduler.submit(PRIORITY_FLOAT, job, "cancelled").cancel()
+
+            release.set()
+            for future in futures:
+                await future
+
+        asyncio.run(run())
+        assert_equal(order, ["running", "standard", "float", "batch"])
+
+    def test_reserved(self):
+        release = threading.Event()
+
+        def job(name):
+            release.wait()
+            return name
+
+        async def run():
+            scheduler = Scheduler(self.executor, 2, (2, 2, 2), reserved=1)
+            first = scheduler.submit(PRIORITY_FLOAT, job, "float 1")
+            second = scheduler.submit(PRIORITY_FLOAT, job, "float 2")
+            # (the second float waits, although a worker is free, which a
+            # standard prediction may use)
+            standard = scheduler.submit(PRIORITY_STANDARD, lambda: "standard")
+            assert_equal(await standard, "standard")
+            assert not second.done()
+
+            release.set()
+            assert_equal(await first, "float 1")
+            assert_equal(await second, "float 2")
+
+        asyncio.run(run())
+
+
+class TestApplication(unittest.TestCase):
+
+    def setUp(self):
+        self.executor = ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+
+    @patch('tawhiri.api.run_cached_prediction')
+    def test_main(self, run_cached_prediction_mock):
+        run_cached_prediction_mock.configure_mock(
+                return_value=b'{"prediction": []}')
+        application = Application({"ASYNC_PROCESSES": 2}, self.executor)
+
+        status, headers, body = call(application, "GET", "/api/v1/",
+                                     urlencode(query).encode("ascii"))
+        assert_equal(status, 200)
+        assert_equal(headers[b"content-type"], b"application/json")
+        body = json.loads(body.decode("utf-8"))
+        assert_equal(body["prediction"], [])
+        self.assertIn("metadata", body)
+        req, = run_cached_prediction_mock.call_args[0]
+        assert_equal(req["launch_latitude"], 52.1)
+
+        float_query = dict(query, profile="float_profile",
+                           float_altitude=20000,
+                           stop_datetime="2014-08-20T06:00:00Z")
+        status, _, body = call(application, "GET", "/api/v1/",
+                               urlencode(float_query).encode("ascii"))
+        assert_equal(status, 200)
+        req, = run_cached_prediction_mock.call_args[0]
+        assert_equal(req["profile"], "float_profile")
+
+        status, _, body = call(application, "GET", "/api/v1/", b"")
+        assert_equal(status, 400)
+        self.assertIn("error", json.loads(body.decode("utf-8")))
+
+        status, _, _ = call(application, "GET", "/api/v1/cache")
+        assert_equal(status, 404)
+
+        status, _, body = call(application, "GET", "/api/v1/metrics")
+        assert_equal(status, 200)
+        self.assertIn(b"# TYPE tawhiri_phase_seconds histogram", body)
+
+    @patch('tawhiri.api.run_cached_prediction')
+    def test_disconnect(self, run_cached_prediction_mock):
+        release = threading.Event()
+        ran = []
+
+        def run(req):
+            ran.append(req["launch_latitude"])
+            release.wait()
+            return b'{"prediction": []}'
+        run_cached_prediction_mock.configure_mock(side_effect=run)
+        application = Application({"ASYNC_PROCESSES": 1}, self.executor)
+
+        async def request(latitude, gone):
+            messages = []
+
+            async def receive():
+                await gone.wait()
+                return {"type": "http.disconnect"}
+
+            async def send(message):
+                messages.append(message)
+
+            qs = urlencode(dict(query, launch_latitude=latitude))
+            scope = {"type": "http", "method": "GET", "path": "/api/v1/",
+                     "query_string": qs.encode("ascii"), "headers": []}
+            await application(scope, receive, send)
+            return messages
+
+        async def run_both():
+            stays, leaves = asyncio.Event(), asyncio.Event()
+            first = asyncio.ensure_future(request(52.1, stays))
+            # (queued behind the first, which has the only worker)
+            second = asyncio.ensure_future(request(53.1, leaves))
+            await asyncio.sleep(0.1)
+            leaves.set()
+            assert_equal(await second, [])
+
+            release.set()
+            messages = await first
+            assert_equal(messages[0]["status"], 200)
+
+        asyncio.run(run_both())
+        assert_equal(ran, [52.1])
+
+    def test_full(self):
+        application = Application({"ASYNC_PROCESSES": 2,
+                                   "ASYNC_QUEUE_SIZE": 0,
+                                   "ASYNC_RETRY_AFTER": 30}, self.executor)
+        status, headers, body = call(application, "GET", "/api/v1/",
+                                     urlencode(query).encode("ascii"))
+        assert_equal(status, 503)
+        assert_equal(headers[b"retry-after"], b"30")
+        assert_equal(json.loads(body.decode("utf-8"))["error"]["type"],
+                     "ServiceUnavailableException")
+
+    @patch('tawhiri.api._run_batch_prediction')
+    def test_batch(self, run_batch_prediction_mock):
+        def run(item):
+            return json.dumps({"index": item[0]}).encode("utf-8")
+        run_batch_prediction_mock.configure_mock(side_effect=run)
+        application = Application({"ASYNC_PROCESSES": 2}, self.executor)
+
+        batch = [query, {}, dict(query, launch_latitude=53)]
+        status, headers, body = call(application, "POST", "/api/v1/batch",
+                                     body=json.dumps(batch).encode("utf-8"))
+        assert_equal(status, 200)
+        assert_equal(headers[b"content-type"], b"application/x-ndjson")
+        lines = [json.loads(line.decode("utf-8"))
+                 for line in body.splitlines()]
+        assert_equal(sorted(line["index"] for line in lines), [0, 1, 2])
+        assert_equal([line["index"] for line in lines if "error" in line],
+                     [1])
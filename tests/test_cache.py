@@ -0,0 +1,115 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+from nose.tools import assert_equal, assert_not_equal
+
+from tawhiri.cache import ResultCache
+
+
+req = {"launch_latitude": 52.0, "launch_longitude": 0.5,
+       "launch_datetime": 1408489200.0, "dataset": "latest"}
+old = datetime(2014, 8, 19, 0)
+new = datetime(2014, 8, 19, 6)
+
+
+class TestResultCache(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_key(self):
+        key = ResultCache.key(req, old)
+        assert_equal(key[0], "2014081900")
+        # the same request (whichever order its parameters are in, and
+        # whether it asked for the latest dataset or for this one)
+        same = dict(reversed(list(req.items())), dataset=1408406400.0)
+        assert_equal(ResultCache.key(same, old), key)
+        assert_not_equal(ResultCache.key(req, new), key)
+        assert_not_equal(ResultCache.key(dict(req, launch_latitude=52.1), old),
+                         key)
+
+    def test_memory(self):
+        cache = ResultCache(100)
+        keys = [ResultCache.key(dict(req, launch_altitude=i), old)
+                for i in range(4)]
+
+        assert_equal(cache.get(keys[0]), None)
+        for key in keys[:3]:
+            cache.put(key, b"x" * 40)
+        # (the least recently used entry was dropped)
+        assert_equal(cache.get(keys[0]), None)
+        assert_equal(cache.get(keys[1]), b"x" * 40)
+        cache.put(keys[3], b"y" * 40)
+        assert_equal(cache.get(keys[2]), None)
+        assert_equal(cache.get(keys[1]), b"x" * 40)
+
+        # too big to cache
+        cache.put(keys[0], b"z" * 101)
+        assert_equal(cache.get(keys[0]), None)
+
+        assert_equal(cache.stats(), {"hits": 2, "disk_hits": 0, "misses": 4,
+                                     "entries": 2, "bytes": 80})
+
+        # a newer dataset drops the entries for older ones
+        key = ResultCache.key(req, new)
+        cache.put(key, b"{}")
+        assert_equal(cache.stats()["entries"], 1)
+        assert_equal(cache.get(keys[1]), None)
+
+    def test_directory(self):
+        first = ResultCache(1000, self.directory)
+        second = ResultCache(1000, self.directory)
+        key = ResultCache.key(req, old)
+
+        first.put(key, b"{}")
+        assert_equal(second.get(key), b"{}")
+        assert_equal(second.get(key), b"{}")
+        assert_equal(second.stats()["disk_hits"], 1)
+        assert_equal(second.stats()["hits"], 1)
+
+        second.put(ResultCache.key(req, new), b"{}")
+        assert_equal(os.listdir(self.directory), ["2014081906"])
+
+    def test_disk_size(self):
+        cache = ResultCache(1000, self.directory, disk_size=100)
+        keys = [ResultCache.key(dict(req, launch_altitude=i), old)
+                for i in range(4)]
+        files = [cache._filename(key) for key in keys]
+
+        for i, key in enumerate(keys[:2]):
+            cache.put(key, b"x" * 40)
+            os.utime(files[i], (1000 + i, 1000 + i))
+        # (reading the first makes it the most recently used)
+        assert_equal(ResultCache(1000, self.directory, 100).get(keys[0]),
+                     b"x" * 40)
+
+        cache.put(keys[2], b"y" * 40)
+        assert_equal([os.path.exists(fn) for fn in files[:3]],
+                     [True, False, True])
+
+        # (without a limit, nothing is removed)
+        unlimited = ResultCache(1000, self.directory)
+        unlimited.put(keys[3], b"z" * 40)
+        assert_equal(len(os.listdir(os.path.dirname(files[0]))), 3)
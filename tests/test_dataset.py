@@ -0,0 +1,599 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+import warnings
+from datetime import datetime
+from mock import patch
+from nose.tools import assert_equal, assert_almost_equal, assert_raises
+
+from tawhiri.convert import convert
+from tawhiri.dataset import Dataset, DatasetIndex, DatasetRegistry
+from tawhiri.interpolate import make_interpolator, RangeError, \
+                                IncompleteError
+from tawhiri.warnings import WarningCounts
+
+
+ds_time = datetime(2014, 8, 19, 0)
+
+# a small patch of data around 52N 0E, in the first two hours
+hours = range(2)
+lats = range(282, 286)
+lngs = range(0, 4)
+
+
+def value(hour, level, variable, lat, lng):
+    if variable == 0:
+        return 1000.0 * level + 10.0 * hour
+    else:
+        return hour + 0.5 * level + 0.1 * lat + 0.01 * lng + 100.0 * variable
+
+
+def fill(ds):
+    """
+    Write `value(...)` to the patch in `ds`, whatever its format (`ds` must
+    contain the patch)
+    """
+    if ds.data_element_type == Dataset.ELEMENT_INT16:
+        view = ds.data.cast("h", ds.data_shape)
+        quantization = ds.quantization.cast("d", ds.quantization_shape)
+    else:
+        view = ds.data.cast("f", ds.data_shape)
+    n = ds.header.get("tile_size")
+    for hour in hours:
+        for level in range(Dataset.shape[1]):
+            for variable in range(Dataset.shape[2]):
+                if ds.data_element_type == Dataset.ELEMENT_INT16:
+                    offset, scale = (20000.0, 1.0) if variable == 0 \
+                                    else (100.0 * variable, 0.01)
+                    quantization[hour, level, variable, 0] = offset
+                    quantization[hour, level, variable, 1] = scale
+
+                for lat in lats:
+                    for lng in lngs:
+                        x = value(hour, level, variable, lat, lng)
+                        if ds.data_element_type == Dataset.ELEMENT_INT16:
+                            x = int(round((x - offset) / scale))
+                        i, j = local(ds, lat, lng)
+                        if ds.layout == Dataset.LAYOUT_TILED:
+                            view[i // n, j // n, hour, level, variable,
+                                 i % n, j % n] = x
+                        else:
+                            view[hour, level, variable, i, j] = x
+    view.release()
+    if ds.data_element_type == Dataset.ELEMENT_INT16:
+        quantization.release()
+
+
+def local(ds, lat, lng):
+    """The indices of a point in the (possibly regional) grid of `ds`"""
+    assert ds.extent.hour.start == 0
+    return (lat - ds.extent.latitude.start,
+            (lng - ds.extent.longitude.start) % Dataset.shape[4])
+
+
+points = [(0.5, 51.2, 0.3, 1500.0), (2.9, 52.4, 1.4, 20.0),
+          (1.0, 51.0, 0.0, 45000.0)]
+
+
+class TestDataset(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def open(self, **kwargs):
+        return Dataset(ds_time, directory=self.directory, **kwargs)
+
+    def test_standard(self):
+        ds = self.open(new=True)
+        assert_equal(ds.layout, Dataset.LAYOUT_STANDARD)
+        assert_equal(ds.data_offset, 0)
+        assert_equal(len(ds.array), Dataset.size)
+        ds.close()
+
+        ds = self.open()
+        assert_equal(ds.header, Dataset.default_header)
+        assert_equal(ds.data_shape, Dataset.shape)
+
+    def test_tiled_header(self):
+        header = {"layout": Dataset.LAYOUT_TILED, "tile_size": 8}
+        ds = self.open(new=True, header=header)
+        ds.close()
+
+        ds = self.open()
+        assert_equal(ds.header, dict(header, element_type="float32",
+                                     grid=Dataset.default_grid))
+        assert_equal(ds.layout, Dataset.LAYOUT_TILED)
+        assert_equal(ds.data_shape, (46, 90, 65, 47, 3, 8, 8))
+        assert_equal(ds.data_offset % Dataset.HEADER_ALIGN, 0)
+        assert_equal(len(ds.array), ds.data_offset + ds.data_size)
+
+    def test_tiled_interpolation(self):
+        standard = self.open(new=True)
+        tiled = self.open(new=True, suffix=".tiled",
+                          header={"layout": Dataset.LAYOUT_TILED})
+        fill(standard)
+        fill(tiled)
+
+        f = make_interpolator(standard, WarningCounts())
+        g = make_interpolator(tiled, WarningCounts())
+        for point in points:
+            assert_equal(f(*point), g(*point))
+
+    def test_quantized(self):
+        header = {"element_type": Dataset.ELEMENT_INT16}
+        ds = self.open(new=True, header=header)
+        assert_equal(ds.data_size, Dataset.size // 2)
+        assert_equal(len(ds.quantization), 65 * 47 * 3 * 2 * 8)
+        ds.close()
+
+        ds = self.open()
+        assert_equal(ds.data_element_type, Dataset.ELEMENT_INT16)
+        assert_equal(ds.quantization_shape, (65, 47, 3, 2))
+        assert_equal(len(ds.array), ds.data_offset + ds.data_size)
+
+    def test_quantized_interpolation(self):
+        standard = self.open(new=True)
+        fill(standard)
+        f = make_interpolator(standard, WarningCounts())
+
+        for layout in (Dataset.LAYOUT_STANDARD, Dataset.LAYOUT_TILED):
+            quantized = self.open(new=True, suffix="." + layout,
+                                  header={"layout": layout,
+                                          "element_type": "int16"})
+            fill(quantized)
+
+            g = make_interpolator(quantized, WarningCounts())
+            for point in points:
+                for a, b in zip(f(*point), g(*point)):
+                    assert_almost_equal(a, b, places=4)
+
+    def test_region_extent(self):
+        extent = Dataset.region_extent((51.2, 52.4), (359.2, 1.4), (2, 4))
+        assert_equal(extent, {"latitude": [282, 286],
+                              "longitude": [718, 724],
+                              "hour": [0, 3]})
+        extent = Dataset._parse_extent(extent)
+        assert_equal(extent.longitude, range(718, 724))
+        assert_equal(extent.hour, range(0, 3))
+
+        assert_equal(Dataset.region_extent((-90, 90), (0, 360)),
+                     {"latitude": [0, 361], "longitude": [0, 720]})
+
+    def test_regional_interpolation(self):
+        standard = self.open(new=True)
+        fill(standard)
+        f = make_interpolator(standard, WarningCounts())
+
+        for extent in ({"hour": [0, 2], "latitude": [282, 286],
+                        "longitude": [0, 4]},
+                       {"hour": [0, 2], "latitude": [280, 288],
+                        "longitude": [716, 728]}):
+            region = self.open(new=True, suffix=".region",
+                               header={"extent": extent})
+            assert_equal(region.grid_shape[3:],
+                         (extent["latitude"][1] - extent["latitude"][0],
+                          extent["longitude"][1] - extent["longitude"][0]))
+            fill(region)
+
+            g = make_interpolator(region, WarningCounts())
+            for point in points:
+                for a, b in zip(f(*point), g(*point)):
+                    assert_almost_equal(a, b, places=10)
+
+            # each axis, just outside the region
+            south, north = [Dataset.axes.latitude[region.extent.latitude[i]]
+                            for i in (0, -1)]
+            west, east = [Dataset.axes.longitude[
+                              region.extent.longitude[i] % 720]
+                          for i in (0, -1)]
+            for point, variable in (((3.1, 52.0, 0.5, 0.0), "hour"),
+                                    ((-0.1, 52.0, 0.5, 0.0), "hour"),
+                                    ((1.0, south - 0.1, 0.5, 0.0), "lat"),
+                                    ((1.0, north + 0.1, 0.5, 0.0), "lat"),
+                                    ((1.0, 52.0, west - 0.1, 0.0), "lng"),
+                                    ((1.0, 52.0, east + 0.1, 0.0), "lng"),
+                                    ((1.0, 52.0, 180.0, 0.0), "lng")):
+                with assert_raises(RangeError) as cm:
+                    g(*point)
+                assert_equal(cm.exception.variable, variable)
+
+    def test_grid(self):
+        # hourly, 1 degree, 10 levels, and not all the way around the world
+        grid = {"hour": {"start": 0, "step": 1, "count": 7},
+                "pressure": [1000 - 100 * i for i in range(10)],
+                "variable": ["height", "wind_u", "wind_v"],
+                "latitude": {"start": 40.0, "step": 1.0, "count": 21},
+                "longitude": {"start": -10.0, "step": 1.0, "count": 21}}
+        ds = self.open(new=True, header={"grid": grid})
+        assert_equal(ds.shape, (7, 10, 3, 21, 21))
+        assert_equal(ds.axes.longitude[:2], [-10.0, -9.0])
+        assert_equal(ds.data_size, 7 * 10 * 3 * 21 * 21 * 4)
+
+        view = ds.data.cast("f", ds.data_shape)
+        for hour in range(7):
+            for level in range(10):
+                for lat in range(21):
+                    for lng in range(21):
+                        view[hour, level, 0, lat, lng] = 1000.0 * level
+                        view[hour, level, 1, lat, lng] = \
+                            hour + level + 0.1 * lat + 0.01 * lng
+                        view[hour, level, 2, lat, lng] = -hour
+        view.release()
+        ds.close()
+
+        ds = self.open()
+        assert_equal(ds.grid, grid)
+        f = make_interpolator(ds, WarningCounts())
+        for hour, lat, lng, alt in ((0.5, 51.2, 0.3, 1500.0),
+                                    (5.25, 40.0, 355.5, 8999.0)):
+            u, v = f(hour, lat, lng, alt)
+            assert_almost_equal(u, hour + alt / 1000.0 + 0.1 * (lat - 40) +
+                                   0.01 * ((lng + 10) % 360), places=4)
+            assert_almost_equal(v, -hour, places=4)
+
+        for point, variable in (((6.5, 50.0, 0.0, 0.0), "hour"),
+                                ((1.0, 39.5, 0.0, 0.0), "lat"),
+                                ((1.0, 50.0, 10.5, 0.0), "lng"),
+                                ((1.0, 50.0, 349.5, 0.0), "lng")):
+            with assert_raises(RangeError) as cm:
+                f(*point)
+            assert_equal(cm.exception.variable, variable)
+
+        for bad in ({"latitude": {"start": 0, "step": 1, "count": 100}},
+                    {"hour": {"start": 0, "step": 0, "count": 10}},
+                    {"pressure": [1000]},
+                    {"longitude": None}):
+            with assert_raises(ValueError):
+                self.open(new=True, suffix=".bad",
+                          header={"grid": dict(grid, **bad)})
+
+    def test_altitude_levels(self):
+        standard = self.open(new=True)
+        fill(standard)
+        f = make_interpolator(standard, WarningCounts())
+
+        extent = {"hour": [0, 2], "latitude": [282, 286], "longitude": [0, 4]}
+        pressure = dict(Dataset.default_grid)
+        del pressure["pressure"]
+        for altitude in ({"start": 0.0, "step": 250.0, "count": 185},
+                         [0.0, 100.0, 1000.0, 1700.0, 5000.0, 20000.0,
+                          46000.0]):
+            grid = dict(pressure, altitude=altitude,
+                        variable=["wind_u", "wind_v"])
+            for layout in (Dataset.LAYOUT_STANDARD, Dataset.LAYOUT_TILED):
+                regridded = self.open(new=True, suffix=".altitude",
+                                      header={"grid": grid, "layout": layout,
+                                              "extent": extent})
+                assert_equal(regridded.vertical, Dataset.VERTICAL_ALTITUDE)
+                convert(standard, regridded)
+
+                g = make_interpolator(regridded, WarningCounts())
+                for point in points + [(1.2, 51.3, 1.1, 20.0)]:
+                    for a, b in zip(f(*point), g(*point)):
+                        assert_almost_equal(a, b, places=3)
+
+        with assert_raises(ValueError):
+            convert(regridded, standard)
+
+    def test_completeness(self):
+        extent = {"latitude": [282, 286], "longitude": [0, 4]}
+        ds = self.open(new=True, header={"extent": extent,
+                                         "completeness": True})
+        fill(ds)
+        assert_equal(len(ds.completeness), 65)
+        assert not ds.is_complete()
+        assert not ds.is_complete(0, 0)
+        ds.mark_complete(0)
+        ds.mark_complete(1)
+        assert ds.is_complete(0, 3)
+        assert ds.is_complete(3, 3)
+        assert not ds.is_complete(3, 3.5)
+        assert ds.is_complete(1000, 2000)
+
+        f = make_interpolator(ds, WarningCounts())
+        f(2.5, 52.0, 1.0, 1000.0)
+        f(3.0, 52.0, 1.0, 1000.0)
+        with assert_raises(IncompleteError) as cm:
+            f(3.5, 52.0, 1.0, 1000.0)
+        assert_equal(cm.exception.variable, "hour")
+        assert_equal(str(cm.exception), "hour=3.5 is not yet in the dataset")
+
+        # (completed while the interpolator is in use)
+        ds.mark_complete(2)
+        f(3.5, 52.0, 1.0, 1000.0)
+        ds.close()
+
+        ds = self.open()
+        assert ds.is_complete(0, 6)
+        assert not ds.is_complete()
+        assert Dataset.file_is_complete(ds.fn, 0, 6)
+        assert not Dataset.file_is_complete(ds.fn, 0, 7)
+        assert not Dataset.file_is_complete(ds.fn)
+
+        assert self.open(new=True, suffix=".standard").is_complete()
+        assert Dataset.file_is_complete(Dataset.filename(
+                ds_time, self.directory, ".standard"))
+
+    def test_hour_ranges(self):
+        ds = self.open(new=True)
+        hour_size = ds.data_size // 65
+        assert_equal(ds.hour_ranges(), [(0, ds.data_size)])
+        assert_equal(ds.hour_ranges(4, 5), [(hour_size, 2 * hour_size)])
+        assert_equal(ds.hour_ranges(6, 6), [(2 * hour_size, hour_size)])
+        assert_equal(ds.hour_ranges(1000, 2000), [])
+        ds.close()
+
+        extent = {"hour": [1, 5], "latitude": [282, 286], "longitude": [0, 8]}
+        ds = self.open(new=True, header={"layout": Dataset.LAYOUT_TILED,
+                                         "extent": extent})
+        ranges = ds.hour_ranges()
+        assert_equal(len(ranges), 2)
+        assert_equal(sum(length for offset, length in ranges), ds.data_size)
+        hour_size = ds.data_size // 2 // 4
+        assert_equal(ds.hour_ranges(6, 6),
+                     [(offset + hour_size, hour_size)
+                      for offset, length in ranges])
+
+    def test_residency(self):
+        extent = {"latitude": [282, 286], "longitude": [0, 4]}
+        ds = self.open(new=True, header={"extent": extent})
+        assert ds in Dataset.open_datasets()
+
+        ds.advise("random")
+        ds.prewarm(background=False)
+        report = ds.residency_report()
+        assert_equal(report["size"], ds.data_size)
+        assert_equal(report["resident"], ds.data_size)
+        assert_equal(report["hours"], [1.0] * 65)
+
+        ds.close()
+        assert ds not in Dataset.open_datasets()
+
+
+class TestDatasetRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        # (small, regional datasets)
+        header = {"extent": {"latitude": [282, 286], "longitude": [0, 4]}}
+        self.times = [datetime(2014, 8, 19, hour) for hour in (0, 6, 12)]
+        for ds_time in self.times:
+            Dataset(ds_time, directory=self.directory, new=True,
+                    header=header).close()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_latest(self):
+        registry = DatasetRegistry(self.directory)
+        assert_equal(registry.latest(), self.times[-1])
+
+        with registry.dataset() as ds:
+            assert_equal(ds.ds_time, self.times[-1])
+            with registry.dataset(self.times[-1]) as ds2:
+                assert ds2 is ds
+                assert_equal(registry.open_datasets(), [(ds, 2)])
+        assert_equal(registry.open_datasets(), [(ds, 0)])
+
+    def test_eviction(self):
+        registry = DatasetRegistry(self.directory, size=2)
+
+        first = registry.acquire(self.times[0])
+        for ds_time in self.times[1:]:
+            with registry.dataset(ds_time):
+                pass
+        # the first dataset is in use, so the least recently used of the
+        # others is dropped
+        assert_equal([ds.ds_time for ds, users in registry.open_datasets()],
+                     [self.times[0], self.times[2]])
+
+        registry.release(first)
+        with registry.dataset(self.times[1]):
+            pass
+        assert_equal([ds.ds_time for ds, users in registry.open_datasets()],
+                     [self.times[2], self.times[1]])
+
+    def test_threads(self):
+        registry = DatasetRegistry(self.directory, size=1)
+        results = []
+
+        def run():
+            for i in range(50):
+                for ds_time in self.times:
+                    with registry.dataset(ds_time) as ds:
+                        assert_equal(ds.ds_time, ds_time)
+                        results.append(ds)
+
+        threads = [threading.Thread(target=run) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert_equal(len(results), 4 * 50 * 3)
+        assert_equal(len(registry.open_datasets()), 1)
+        assert_equal(registry.open_datasets()[0][1], 0)
+
+    def test_incomplete(self):
+        header = {"extent": {"latitude": [282, 286], "longitude": [0, 4]},
+                  "completeness": True}
+        ds_time = datetime(2014, 8, 19, 18)
+        ds = Dataset(ds_time, directory=self.directory, new=True,
+                     header=header)
+
+        registry = DatasetRegistry(self.directory)
+        assert_equal(registry.latest(), ds_time)
+        needed = (datetime(2014, 8, 19, 19), datetime(2014, 8, 19, 22))
+        with registry.dataset(times=needed) as latest:
+            assert_equal(latest.ds_time, self.times[-1])
+        with registry.dataset() as latest:
+            assert_equal(latest.ds_time, self.times[-1])
+        # (the incomplete dataset was not opened to find that out)
+        assert_equal([ds.ds_time for ds, users in registry.open_datasets()],
+                     [self.times[-1]])
+
+        for i in range(3):
+            ds.mark_complete(i)
+        with registry.dataset(times=needed) as latest:
+            assert_equal(latest.ds_time, ds_time)
+        with registry.dataset() as latest:
+            assert_equal(latest.ds_time, self.times[-1])
+
+    def test_open_latest(self):
+        ds = Dataset.open_latest(self.directory)
+        assert_equal(ds.ds_time, self.times[-1])
+        assert Dataset.open_latest(self.directory) is not ds
+
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter("always")
+            ds = Dataset.open_latest(self.directory, persistent=True)
+        assert_equal(ds.ds_time, self.times[-1])
+        assert_equal([w.category for w in caught], [DeprecationWarning])
+
+    def test_slow_open(self):
+        # (datasets are opened outside the registry's lock, so one that is
+        # slow to open doesn't hold up the others)
+        opening = threading.Event()
+        proceed = threading.Event()
+
+        class SlowDataset(Dataset):
+            def manage_residency(self, **kwargs):
+                if self.ds_time == times[0]:
+                    opening.set()
+                    proceed.wait()
+
+        times = self.times
+        registry = DatasetRegistry(self.directory, residency={})
+        results = []
+
+        def acquire():
+            results.append(registry.acquire(times[0]))
+
+        with patch('tawhiri.dataset.Dataset', SlowDataset):
+            slow = [threading.Thread(target=acquire) for i in range(2)]
+            slow[0].start()
+            opening.wait()
+            slow[1].start()
+            with registry.dataset(times[1]) as ds:
+                assert_equal(ds.ds_time, times[1])
+            assert_equal(results, [])
+
+            proceed.set()
+            for thread in slow:
+                thread.join()
+        assert_equal(len(results), 2)
+        assert results[0] is results[1]
+        assert_equal(dict((ds.ds_time, users)
+                          for ds, users in registry.open_datasets()),
+                     {times[0]: 2, times[1]: 0})
+
+
+class TestDatasetIndex(unittest.TestCase):
+
+    header = {"extent": {"latitude": [282, 286], "longitude": [0, 4]}}
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def create(self, ds_time, suffix=''):
+        Dataset(ds_time, directory=self.directory, new=True, suffix=suffix,
+                header=self.header).close()
+        return Dataset.filename(ds_time, self.directory, suffix)
+
+    def test_index(self):
+        index = DatasetIndex(self.directory, poll_interval=0)
+        assert_equal(index.latest(), None)
+
+        times = [datetime(2014, 8, 19, hour) for hour in (0, 6, 12)]
+        for ds_time in times:
+            self.create(ds_time)
+        self.create(datetime(2014, 8, 19, 18), suffix=".temp")
+        with open(os.path.join(self.directory, "README"), "w") as f:
+            f.write("not a dataset")
+
+        assert_equal(index.latest(), times[-1])
+        assert_equal([row.ds_time for row in index.rows()], times)
+        assert_equal(index.best(datetime(2014, 8, 19, 7)), times[1])
+        assert_equal(index.best(datetime(2014, 8, 19, 6)), times[1])
+        assert_equal(index.best(datetime(2014, 8, 18, 23)), None)
+        assert_equal(index.best(datetime(2014, 8, 25)), times[-1])
+
+        os.unlink(Dataset.filename(times[-1], self.directory))
+        assert_equal(index.latest(), times[1])
+
+    def test_incomplete(self):
+        index = DatasetIndex(self.directory, poll_interval=0)
+        ds_time = datetime(2014, 8, 19, 0)
+        path = self.create(ds_time)
+        size = os.stat(path).st_size
+
+        with open(path, "r+b") as f:
+            f.truncate(size - 1)
+        assert_equal(index.latest(), None)
+        assert_equal(index.rows()[0].valid, False)
+
+        # (extending the file doesn't change the directory's mtime)
+        with open(path, "r+b") as f:
+            f.truncate(size)
+        assert_equal(index.latest(), ds_time)
+
+    def test_poll_interval(self):
+        index = DatasetIndex(self.directory, poll_interval=3600,
+                             inotify=False)
+        assert_equal(index.latest(), None)
+        self.create(datetime(2014, 8, 19, 0))
+        assert_equal(index.latest(), None)
+        index.refresh()
+        assert_equal(index.latest(), datetime(2014, 8, 19, 0))
+
+    def test_inotify(self):
+        index = DatasetIndex(self.directory, poll_interval=3600)
+        assert_equal(index.latest(), None)
+        if index._watch is None:
+            raise unittest.SkipTest("inotify is not available")
+
+        # (changes are seen straight away, however long the poll interval)
+        times = [datetime(2014, 8, 19, hour) for hour in (0, 6)]
+        path = self.create(times[0])
+        assert_equal(index.latest(), times[0])
+
+        size = os.stat(path).st_size
+        with open(path, "r+b") as f:
+            f.truncate(size - 1)
+        assert_equal(index.latest(), None)
+        with open(path, "r+b") as f:
+            f.truncate(size)
+        assert_equal(index.latest(), times[0])
+
+        temp = self.create(times[1], suffix=".temp")
+        assert_equal(index.latest(), times[0])
+        os.rename(temp, Dataset.filename(times[1], self.directory))
+        assert_equal(index.times(), times)
+        os.unlink(path)
+        assert_equal(index.times(), times[1:])
@@ -0,0 +1,143 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import random
+import shutil
+import tempfile
+import unittest
+from array import array
+from nose.tools import assert_equal, assert_raises
+
+from tawhiri import models
+from tawhiri.elevation import Elevation, MaximumElevation
+from tawhiri.workcounts import WorkCounts
+
+
+# blocks of 45 by 60 samples: one per degree
+res = (61, 46)
+cells = 5
+
+
+def value(i, j):
+    """The elevation of the sample i degrees south of the north pole and j
+    degrees east of 180 degrees"""
+    return (i * 7919 + (j % 360) * 104729) % 3000 - 100
+
+
+class ExampleDataset(object):
+    """Like :class:`ruaumoko.Dataset`, at one sample per degree"""
+
+    def __init__(self):
+        self.calls = 0
+
+    def get(self, lat, lng):
+        if not -90 <= lat <= 90 or not 0 <= lng < 360:
+            raise ValueError("Bad position")
+        self.calls += 1
+        return value(int(round(90 - lat)), int(round((lng + 180) % 360)))
+
+
+rng = random.Random(0)
+
+
+def random_point():
+    # (avoiding points half way between samples, which Python and C round
+    # differently)
+    return rng.randrange(-900, 900) / 10.0 + 0.01, \
+           rng.randrange(0, 3600) / 10.0 + 0.01
+
+
+class TestElevation(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = os.path.join(self.directory, "ruaumoko")
+
+        data = array("h")
+        for br in range(4):
+            for bc in range(6):
+                for r in range(res[1]):
+                    for c in range(res[0]):
+                        data.append(value(br * 45 + r, bc * 60 + c))
+        with open(self.filename, "wb") as f:
+            data.tofile(f)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_maximum(self):
+        maximum = MaximumElevation.build(self.filename, res, cells)
+
+        for lat, lng in [random_point() for _ in range(200)] + [(-90, 0)]:
+            i = int(round(90 - lat)) // cells
+            j = int(round((lng + 180) % 360)) % 360 // cells
+            expect = max(value(a, b)
+                         for a in range(i * cells, min(i * cells + cells, 181))
+                         for b in range(j * cells, j * cells + cells))
+            assert_equal(maximum.highest(lat, lng), expect)
+
+        fn = os.path.join(self.directory, "maximum")
+        maximum.save(fn)
+        loaded = MaximumElevation.load(fn)
+        assert_equal(loaded.res, res)
+        assert_equal(loaded.cells, cells)
+        for lat, lng in [random_point() for _ in range(20)]:
+            assert_equal(loaded.highest(lat, lng), maximum.highest(lat, lng))
+
+        with assert_raises(ValueError):
+            MaximumElevation(array("h", [0] * 10), res, cells)
+
+    def test_termination(self):
+        dataset = ExampleDataset()
+        maximum = MaximumElevation.build(self.filename, res, cells)
+        elevation = Elevation(dataset, maximum)
+        workcounts = WorkCounts()
+        f = models.make_elevation_data_termination(elevation, workcounts)
+
+        for lat, lng in [random_point() for _ in range(200)]:
+            ground = dataset.get(lat, lng)
+            for alt in (ground - 1, ground + 1, ground + 500, -200):
+                assert_equal(f(0, lat, lng, alt), ground > alt)
+            assert_equal(elevation.get(lat, lng), ground)
+        # (ExampleDataset.get was also called directly, once per point)
+        assert_equal(workcounts.elevation_lookups, dataset.calls - 200)
+
+        # above the highest ground anywhere, nothing is looked up
+        dataset.calls = 0
+        for lat, lng in [random_point() for _ in range(200)]:
+            assert not f(0, lat, lng, 3000.0)
+        assert_equal(dataset.calls, 0)
+
+        # nearby points use the same sample, which is cached
+        ground = value(38, 180)
+        assert f(0, 52.1, 0.2, ground - 1)
+        calls = dataset.calls
+        assert f(0, 51.9, 0.1, ground - 1)
+        assert_equal(dataset.calls, calls)
+
+        # terminators that share an Elevation count their own lookups
+        other = WorkCounts()
+        g = models.make_elevation_data_termination(elevation, other)
+        lookups = workcounts.elevation_lookups
+        ground = dataset.get(-30.3, 200.7)
+        assert g(0, -30.3, 200.7, ground - 1)
+        assert_equal(other.elevation_lookups, 1)
+        assert_equal(workcounts.elevation_lookups, lookups)
+
+        with assert_raises(ValueError):
+            f(0, 52.0, 360.0, 0.0)
@@ -0,0 +1,110 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+from datetime import datetime
+from nose.tools import assert_equal, assert_raises
+
+from tawhiri.dataset import Dataset
+from tawhiri.ingest import Reader, ingest
+
+
+ds_time = datetime(2014, 8, 19, 0)
+
+grid = {"hour": {"start": 0, "step": 3, "count": 4},
+        "pressure": [1000, 900, 500],
+        "variable": ["height", "wind_u", "wind_v"],
+        "latitude": {"start": -90.0, "step": 45.0, "count": 5},
+        "longitude": {"start": 0.0, "step": 45.0, "count": 8}}
+
+
+def value(hour, level, variable, lat, lng):
+    return 1000.0 * hour + 100.0 * level + 10.0 * variable + lat + lng / 8.0
+
+
+class ExampleReader(Reader):
+    """One piece per hour (optionally missing a slab)"""
+
+    grid = grid
+
+    def __init__(self, skip=None, size=40):
+        self.skip = skip
+        self.size = size
+
+    def pieces(self):
+        return list(range(0, 12, 3))
+
+    def read(self, hour):
+        for i, level in enumerate(grid["pressure"]):
+            for j, variable in enumerate(grid["variable"]):
+                if (hour, level, variable) == self.skip:
+                    continue
+                values = array("f", [value(hour // 3, i, j, k // 8, k % 8)
+                                     for k in range(self.size)])
+                yield hour, level, variable, values
+
+
+class TestIngest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_ingest(self):
+        for processes in (1, 2):
+            fn = ingest(ds_time, ExampleReader(), directory=self.directory,
+                        processes=processes)
+            assert_equal(os.listdir(self.directory), ["2014081900"])
+
+            ds = Dataset(ds_time, directory=self.directory)
+            assert_equal(ds.fn, fn)
+            assert_equal(ds.grid, grid)
+            view = ds.data.cast("f", ds.data_shape)
+            for hour in range(4):
+                for level in range(3):
+                    for variable in range(3):
+                        for lat in range(5):
+                            for lng in range(8):
+                                assert_equal(view[hour, level, variable,
+                                                  lat, lng],
+                                             value(hour, level, variable,
+                                                   lat, lng))
+            view.release()
+            ds.close()
+            os.unlink(fn)
+
+    def test_progressive(self):
+        fn = ingest(ds_time, ExampleReader(), directory=self.directory,
+                    processes=2, progressive=True)
+        ds = Dataset(ds_time, directory=self.directory)
+        assert_equal(ds.fn, fn)
+        assert ds.is_complete()
+        assert_equal(ds.data.cast("f")[-1], value(3, 2, 2, 4, 7))
+
+    def test_incomplete(self):
+        for reader in (ExampleReader(skip=(6, 500, "wind_v")),
+                       ExampleReader(size=39)):
+            with assert_raises(ValueError):
+                ingest(ds_time, reader, directory=self.directory,
+                       processes=2)
+            assert_equal(os.listdir(self.directory), [])
@@ -0,0 +1,316 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import math
+import random
+import shutil
+import tempfile
+import unittest
+from array import array
+from datetime import datetime
+from nose.tools import assert_equal, assert_raises
+
+from tawhiri.dataset import Dataset
+from tawhiri.interpolate import make_interpolator, status_variables, \
+                                RangeError, _levels
+from tawhiri.warnings import WarningCounts
+from tawhiri.workcounts import WorkCounts
+
+
+ds_time = datetime(2014, 8, 19, 0)
+
+# A coarse grid, small enough to fill entirely, whose longitudes go all
+# the way around the world
+grid = {"hour": {"start": 0, "step": 3, "count": 4},
+        "pressure": [1000 - 100 * i for i in range(8)],
+        "variable": ["height", "wind_u", "wind_v"],
+        "latitude": {"start": 40.0, "step": 5.0, "count": 5},
+        "longitude": {"start": 0.0, "step": 10.0, "count": 36}}
+
+
+def fill(ds, seed=0):
+    """
+    Fill `ds` (on `grid`) with noise: heights that increase with level, but
+    vary from point to point, and random winds
+    """
+    rng = random.Random(seed)
+    view = ds.data.cast("f", ds.data_shape)
+    hours, levels, variables, lats, lngs = ds.data_shape
+    for hour in range(hours):
+        for lat in range(lats):
+            for lng in range(lngs):
+                height = rng.uniform(-100.0, 100.0)
+                for level in range(levels):
+                    height += rng.uniform(500.0, 2000.0)
+                    view[hour, level, 0, lat, lng] = height
+                    view[hour, level, 1, lat, lng] = rng.uniform(-20.0, 20.0)
+                    view[hour, level, 2, lat, lng] = rng.uniform(-20.0, 20.0)
+    view.release()
+
+
+class InterpolatorTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.ds = Dataset(ds_time, directory=self.directory, new=True,
+                          header={"grid": grid})
+        fill(self.ds)
+
+    def tearDown(self):
+        self.ds.close()
+        shutil.rmtree(self.directory)
+
+    def interpolator(self):
+        return make_interpolator(self.ds, WarningCounts())
+
+
+def batch(f, points):
+    """Look up `points` with `f`.get_wind_batch: returns the number that
+    failed, the winds and the statuses"""
+    n = len(points)
+    hours, lats, lngs, alts = [array("d", column) for column in zip(*points)]
+    u, v = array("d", [0.0] * n), array("d", [0.0] * n)
+    status = array("b", [0] * n)
+    failed = f.get_wind_batch(hours, lats, lngs, alts, u, v, status)
+    return failed, list(zip(u, v)), list(status)
+
+
+class TestBatch(InterpolatorTestCase):
+
+    def test_matches_single(self):
+        rng = random.Random(1)
+        points = [(rng.uniform(0.0, 9.0), rng.uniform(40.0, 60.0),
+                   rng.uniform(0.0, 360.0), rng.uniform(0.0, 20000.0))
+                  for i in range(200)]
+
+        failed, winds, status = batch(self.interpolator(), points)
+        assert_equal(failed, 0)
+        assert_equal(status, [0] * len(points))
+        f = self.interpolator()
+        assert_equal(winds, [f(*point) for point in points])
+
+    def test_out_of_range(self):
+        points = [(1.0, 50.0, 10.0, 1000.0),
+                  (9.5, 50.0, 10.0, 1000.0),
+                  (-0.5, 50.0, 10.0, 1000.0),
+                  (1.0, 39.0, 10.0, 1000.0),
+                  (1.0, 61.0, 10.0, 1000.0),
+                  (1.0, 50.0, 370.0, 1000.0),
+                  (2.0, 45.0, 355.0, 3000.0)]
+        expect = [None, "hour", "hour", "lat", "lat", "lng", None]
+
+        failed, winds, status = batch(self.interpolator(), points)
+        assert_equal(failed, 5)
+        assert_equal([status_variables[s] for s in status], expect)
+
+        f = self.interpolator()
+        for point, variable, wind in zip(points, expect, winds):
+            if variable is None:
+                assert_equal(wind, f(*point))
+            else:
+                assert all(math.isnan(x) for x in wind)
+                with assert_raises(RangeError) as cm:
+                    f(*point)
+                assert_equal(cm.exception.variable, variable)
+
+    def test_incomplete(self):
+        ds = Dataset(ds_time, directory=self.directory, new=True,
+                     suffix=".partial",
+                     header={"grid": grid, "completeness": True})
+        fill(ds)
+        ds.mark_complete(0)
+        ds.mark_complete(1)
+        points = [(1.0, 50.0, 10.0, 1000.0), (4.0, 50.0, 10.0, 1000.0)]
+
+        failed, winds, status = batch(
+                make_interpolator(ds, WarningCounts()), points)
+        assert_equal(failed, 1)
+        assert_equal(status[0], 0)
+        assert_equal(status_variables[status[1]], "hour")
+        assert all(math.isnan(x) for x in winds[1])
+        ds.close()
+
+    def test_lengths(self):
+        f = self.interpolator()
+        ok = array("d", [1.0, 2.0])
+        short = array("d", [1.0])
+        status = array("b", [0, 0])
+        for i in range(6):
+            args = [ok] * 6
+            args[i] = short
+            with assert_raises(ValueError):
+                f.get_wind_batch(*(args + [status]))
+        with assert_raises(ValueError):
+            f.get_wind_batch(ok, ok, ok, ok, ok, ok, array("b", [0]))
+
+        # (nothing to do)
+        empty = array("d")
+        assert_equal(f.get_wind_batch(empty, empty, empty, empty,
+                                      empty, empty, array("b")), 0)
+
+
+class TestHunt(InterpolatorTestCase):
+
+    def test_random_walk(self):
+        f = self.interpolator()
+        n_levels = len(grid["pressure"])
+        rng = random.Random(2)
+        hour, lat, lng, alt = 1.0, 50.0, 10.0, 0.0
+        level = 0
+
+        for i in range(5000):
+            hour = min(max(hour + rng.uniform(-0.1, 0.1), 0.0), 8.9)
+            lat = min(max(lat + rng.uniform(-1.0, 1.0), 40.0), 59.9)
+            lng = (lng + rng.uniform(-2.0, 2.0)) % 360.0
+            if rng.random() < 0.05:
+                # jump anywhere, including below the bottom level and
+                # above the top
+                alt = rng.uniform(-2000.0, 20000.0)
+            else:
+                alt += rng.uniform(-300.0, 300.0)
+
+            if rng.random() < 0.01:
+                # a hint that is out of range, or at either end
+                hint = rng.choice([-1, 0, n_levels - 2, n_levels - 1,
+                                   n_levels + 5])
+            else:
+                hint = level
+            level, expect = _levels(f, hour, lat, lng, alt, hint)
+            assert_equal(level, expect)
+
+
+class TestCellCache(InterpolatorTestCase):
+
+    def test_reuse(self):
+        # a path that crosses cells, hours and the meridian, at varying
+        # altitudes; each lookup by f may reuse the corners it read for the
+        # previous, whereas a new interpolator must read them again
+        f = self.interpolator()
+        rng = random.Random(3)
+        hour, lat, lng, alt = 0.0, 44.0, 340.0, 500.0
+        for i in range(2000):
+            hour = (hour + 0.01) % 9.0
+            lat = min(max(lat + rng.uniform(-0.5, 0.6), 40.0), 59.9)
+            lng = (lng + rng.uniform(-0.5, 1.5)) % 360.0
+            alt = min(max(alt + rng.uniform(-500.0, 600.0), 0.0), 15000.0)
+            assert_equal(f(hour, lat, lng, alt),
+                         self.interpolator()(hour, lat, lng, alt))
+
+        assert f.cache_hits > 1000
+        assert f.cache_misses > 100
+
+    def test_counts(self):
+        workcounts = WorkCounts()
+        f = make_interpolator(self.ds, WarningCounts(), workcounts)
+        assert_equal((f.cache_hits, f.cache_misses), (0, 0))
+
+        for point, hits, misses in (((1.0, 52.0, 12.0, 1000.0), 0, 1),
+                                    # same cell, other altitude and hour
+                                    ((2.5, 53.0, 19.0, 8000.0), 1, 1),
+                                    # next latitude
+                                    ((2.5, 56.0, 19.0, 8000.0), 1, 2),
+                                    # next hour
+                                    ((3.5, 56.0, 19.0, 8000.0), 1, 3),
+                                    # the last longitude, which wraps around
+                                    ((3.5, 56.0, 355.0, 8000.0), 1, 4),
+                                    ((3.5, 56.0, 351.0, 8000.0), 2, 4),
+                                    ((3.5, 56.0, 0.0, 8000.0), 2, 5)):
+            f(*point)
+            assert_equal((f.cache_hits, f.cache_misses), (hits, misses))
+
+        # (a lookup that is out of range does not change the cell)
+        with assert_raises(RangeError):
+            f(3.5, 39.0, 0.0, 8000.0)
+        f(3.5, 56.0, 1.0, 100.0)
+        assert_equal((f.cache_hits, f.cache_misses), (3, 5))
+
+        # (and in the work counts of its request)
+        assert_equal((workcounts.wind_lookups, workcounts.wind_cell_changes),
+                     (8, 5))
+    def test_edges(self):
+        # values on the first point are in range, and those just before it
+        # are not (nor are they extrapolated from it)
+        points = [(0.0, 40.0, 0.0, 1000.0),
+                  (9.0 - 1e-9, 60.0 - 1e-9, 360.0 - 1e-9, 1000.0),
+                  (-1e-9, 50.0, 10.0, 1000.0),
+                  (1.0, 40.0 - 1e-9, 10.0, 1000.0)]
+        expect = [None, None, "hour", "lat"]
+
+        failed, winds, status = batch(self.interpolator(), points)
+        assert_equal(failed, 2)
+        assert_equal([status_variables[s] for s in status], expect)
+
+        f = self.interpolator()
+        for point, variable in zip(points, expect):
+            if variable is None:
+                f(*point)
+            else:
+                with assert_raises(RangeError) as cm:
+                    f(*point)
+                assert_equal(cm.exception.variable, variable)
+
+        # nor are values just outside a regional dataset
+        extent = {"latitude": [1, 4], "longitude": [1, 4]}
+        ds = Dataset(ds_time, directory=self.directory, new=True,
+                     suffix=".region", header={"grid": grid,
+                                               "extent": extent})
+        g = make_interpolator(ds, WarningCounts())
+        g(1.0, 45.0, 10.0, 1000.0)
+        for point, variable in (((1.0, 45.0 - 1e-9, 20.0, 1000.0), "lat"),
+                                ((1.0, 50.0, 10.0 - 1e-9, 1000.0), "lng")):
+            with assert_raises(RangeError) as cm:
+                g(*point)
+            assert_equal(cm.exception.variable, variable)
+        ds.close()
+
+
+
+class TestNotFinite(InterpolatorTestCase):
+
+    def test_nan(self):
+        nan, inf = float("nan"), float("inf")
+        f = self.interpolator()
+        points = [((nan, 50.0, 10.0, 1000.0), "hour"),
+                  ((inf, 50.0, 10.0, 1000.0), "hour"),
+                  ((1.0, nan, 10.0, 1000.0), "lat"),
+                  ((1.0, -inf, 10.0, 1000.0), "lat"),
+                  ((1.0, 50.0, nan, 1000.0), "lng"),
+                  ((1.0, 50.0, inf, 1000.0), "lng"),
+                  ((1.0, 50.0, 10.0, nan), "alt"),
+                  ((1.0, 50.0, 10.0, inf), "alt")]
+        for point, variable in points:
+            with assert_raises(RangeError) as cm:
+                f(*point)
+            assert_equal(cm.exception.variable, variable)
+
+        failed, winds, status = batch(f, [point for point, _ in points])
+        assert_equal(failed, len(points))
+        assert_equal([status_variables[s] for s in status],
+                     [variable for _, variable in points])
+
+        # and in a regional dataset, whose longitudes don't wrap around
+        extent = {"latitude": [1, 4], "longitude": [1, 4]}
+        ds = Dataset(ds_time, directory=self.directory, new=True,
+                     suffix=".region", header={"grid": grid,
+                                               "extent": extent})
+        g = make_interpolator(ds, WarningCounts())
+        g(1.0, 50.0, 20.0, 1000.0)
+        with assert_raises(RangeError) as cm:
+            g(1.0, 50.0, nan, 1000.0)
+        assert_equal(cm.exception.variable, "lng")
+        ds.close()
@@ -0,0 +1,153 @@
+# Copyright 2014 (C) Daniel Richman
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+from mock import patch
+from nose.tools import assert_equal
+
+from tawhiri.metrics import Metrics, Timings
+
+
+def parse(text):
+    """The samples of metrics in the Prometheus text format"""
+    samples = {}
+    for line in text.splitlines():
+        if not line.startswith("#"):
+            name, value = line.rsplit(" ", 1)
+            samples[name] = float(value)
+    return samples
+
+
+def example_timings(solve=0.2):
+    timings = Timings()
+    timings.add("parse", 0.0001)
+    with timings.phase("dataset"):
+        pass
+    timings.add("ascent", solve)
+    timings.add("ascent", solve)
+    timings.count("predictions")
+    timings.count("solver_steps", 100)
+    return timings
+
+
+class TestMetrics(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_timings(self):
+        timings = example_timings()
+        assert_equal(list(timings.phases), ["parse", "dataset", "ascent"])
+        assert_equal(timings.phases["ascent"], 0.4)
+        assert timings.phases["dataset"] < 0.1
+        assert_equal(timings.to_dict()["counts"],
+                     {"predictions": 1, "solver_steps": 100})
+
+    def test_format(self):
+        metrics = Metrics()
+        metrics.record(example_timings(0.2))
+        metrics.record(example_timings(20.0))
+        samples = parse(metrics.format())
+
+        bucket = 'tawhiri_phase_seconds_bucket{phase="ascent",le="%s"}'
+        assert_equal(samples[bucket % "0.25"], 0)
+        assert_equal(samples[bucket % "0.5"], 1)
+        assert_equal(samples[bucket % "30.0"], 1)
+        assert_equal(samples[bucket % "60.0"], 2)
+        assert_equal(samples[bucket % "+Inf"], 2)
+        assert_equal(samples['tawhiri_phase_seconds_count{phase="ascent"}'], 2)
+        self.assertAlmostEqual(
+                samples['tawhiri_phase_seconds_sum{phase="ascent"}'], 40.4)
+        assert_equal(samples["tawhiri_predictions_total"], 2)
+        assert_equal(samples["tawhiri_solver_steps_total"], 200)
+
+    def test_directory(self):
+        metrics = Metrics(self.directory)
+        metrics.record(example_timings())
+        # (as if another process had recorded the same)
+        fn, = os.listdir(self.directory)
+        shutil.copy(os.path.join(self.directory, fn),
+                    os.path.join(self.directory, "1.json"))
+        metrics.record(example_timings())
+
+        samples = parse(metrics.format())
+        assert_equal(samples["tawhiri_predictions_total"], 3)
+        assert_equal(samples['tawhiri_phase_seconds_count{phase="parse"}'], 3)
+        assert_equal(parse(Metrics(self.directory).format()), samples)
+
+    def test_write_interval(self):
+        metrics = Metrics(self.directory)
+        fn = os.path.join(self.directory, "{0}.json".format(os.getpid()))
+
+        def written():
+            with open(fn) as f:
+                return json.load(f)["counters"]["predictions"]
+
+        with patch("tawhiri.metrics.WRITE_INTERVAL", 0.2):
+            metrics.record(example_timings())
+            assert_equal(written(), 1)
+            # (written again by a timer, once)
+            metrics.record(example_timings())
+            metrics.record(example_timings())
+            assert_equal(written(), 1)
+            time.sleep(0.5)
+            assert_equal(written(), 3)
+
+            # they are written before they are added up
+            metrics.record(example_timings())
+            metrics.record(example_timings())
+            assert_equal(written(), 4)
+            samples = parse(metrics.format())
+            assert_equal(samples["tawhiri_predictions_total"], 5)
+            assert_equal(written(), 5)
+
+    def test_dead_processes(self):
+        metrics = Metrics(self.directory)
+        metrics.record(example_timings())
+        fn = os.path.join(self.directory, "{0}.json".format(os.getpid()))
+        shutil.copy(fn, os.path.join(self.directory, "1.json"))
+
+        # (a process that has exited)
+        process = subprocess.Popen([sys.executable, "-c", ""])
+        process.wait()
+        dead = os.path.join(self.directory, "{0}.json".format(process.pid))
+        shutil.copy(fn, dead)
+
+        # its metrics are archived, rather than dropped, so the totals
+        # stay the same
+        samples = parse(metrics.format())
+        assert_equal(samples["tawhiri_predictions_total"], 3)
+        assert not os.path.exists(dead)
+        assert os.path.exists(os.path.join(self.directory, "dead.json"))
+        assert_equal(parse(metrics.format()), samples)
+
+        # and so is the file of an earlier process with this process's
+        # pid, when the metrics are first created
+        with patch("tawhiri.metrics._started_pid", None):
+            Metrics(self.directory)
+        assert not os.path.exists(fn)
+        assert_equal(parse(Metrics(self.directory).format()), samples)
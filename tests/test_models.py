@@ -166,12 +166,12 @@ class TestModels:
         elev.return_value = 'elev'
         model = models.standard_profile(5.0, 30000.0, 6.0, wind_ds, elev_ds, warns)
         const.assert_called_with(5.0)
-        wind.assert_called_with(wind_ds, warns)
+        wind.assert_called_with(wind_ds, warns, None)
         linear.assert_any_call(['const', 'wind'])
         burst.assert_called_with(30000.0)
         drag.assert_called_with(6.0)
         linear.assert_called_with(['drag', 'wind'])
-        elev.assert_called_with(elev_ds)
+        elev.assert_called_with(elev_ds, None)
         assert_equal(model, (('linear', 'burst'), ('linear', 'elev')))
         assert not warns.any
 
@@ -190,7 +190,7 @@ class TestModels:
         linear.return_value = 'linear'
         model = models.float_profile(5.0, 12000.0, 7200.0, wind_ds, warns)
         const.assert_called_with(5.0)
-        wind.assert_called_with(wind_ds, warns)
+        wind.assert_called_with(wind_ds, warns, None)
         linear.assert_called_with(['const', 'wind'])
         burst.assert_called_with(12000.0)
         time.assert_called_with(7200.0)
@@ -0,0 +1,292 @@
+# Copyright 2014 (C) Adam Greig
+#
+# This file is part of Tawhiri.
+#
+# Tawhiri is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Tawhiri is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Tawhiri.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function
+import calendar
+import functools
+import shutil
+import tempfile
+from nose.tools import assert_equal, assert_almost_equal
+
+from tawhiri import models, native, solver
+from tawhiri.dataset import Dataset
+from tawhiri.interpolate import make_interpolator, RangeError
+from tawhiri.warnings import WarningCounts
+from tawhiri.workcounts import WorkCounts
+
+from .test_interpolate import ds_time, grid, fill
+
+
+def python_ascent(t, lat, lng, alt):
+    return 0.0, 0.001, 5.0
+
+
+def python_burst(t, lat, lng, alt):
+    return alt >= 1000.0
+
+
+class TestSolver:
+
+    def test_python_model(self):
+        result = solver.rk4(0.0, 52.0, 0.0, 0.0, python_ascent, python_burst)
+        t, lat, lng, alt = result[-1]
+        assert_almost_equal(t, 200.0, places=0)
+        assert_almost_equal(alt, 1000.0, places=-1)
+        assert_almost_equal(lng, 0.2, places=2)
+        assert_equal(lat, 52.0)
+
+    def test_step_count(self):
+        workcounts = WorkCounts()
+        result = solver.rk4(0.0, 52.0, 0.0, 0.0, python_ascent, python_burst,
+                            workcounts=workcounts)
+        # (every step but the one that terminated added a point)
+        assert_equal(workcounts.solver_steps, len(result) - 1)
+
+        # each member of an ensemble counts its steps
+        ensemble = WorkCounts()
+        chain = ((python_ascent, python_burst),)
+        solver.solve_ensemble((0.0, 0.0), (52.0, 52.0), (0.0, 0.0),
+                              (0.0, 0.0), [chain, chain],
+                              workcounts=ensemble)
+        assert_equal(ensemble.solver_steps, 2 * workcounts.solver_steps)
+
+    def test_native_matches_python(self):
+        native_up = models.make_linear_model(
+            [models.make_constant_ascent(5.0),
+             models.make_linear_model([python_ascent]),
+             models.make_constant_ascent(-5.0)])
+        native_burst = models.make_any_terminator(
+            [models.make_burst_termination(1000.0), models.sea_level_termination])
+
+        expect = solver.rk4(0.0, 52.0, 0.0, 0.0, python_ascent, python_burst)
+        result = solver.rk4(0.0, 52.0, 0.0, 0.0, native_up, native_burst)
+        assert_equal(result, expect)
+
+    def test_solve(self):
+        chain = ((python_ascent, python_burst),
+                 (models.make_drag_descent(5.0), models.sea_level_termination))
+        up, down = solver.solve(0.0, 52.0, 0.0, 0.0, chain)
+        assert_equal(up[-1], down[0])
+        assert_almost_equal(down[-1][3], 0.0, places=-1)
+
+    def test_ensemble(self):
+        chains = [((models.make_constant_ascent(rate),
+                    models.make_burst_termination(burst)),
+                   (models.make_drag_descent(5.0), models.sea_level_termination))
+                  for rate, burst in ((5.0, 1000.0), (3.0, 2000.0))]
+        ts, lats, lngs, alts = (0.0, 10.0), (52.0, 53.0), (0.0, 1.0), (0.0, 0.0)
+
+        results = solver.solve_ensemble(ts, lats, lngs, alts, chains)
+        assert_equal(len(results), 2)
+        for i, chain in enumerate(chains):
+            expect = solver.solve(ts[i], lats[i], lngs[i], alts[i], chain)
+            assert_equal(results[i], expect)
+
+    def test_ensemble_wind(self):
+        directory = tempfile.mkdtemp()
+        try:
+            ds = Dataset(ds_time, directory=directory, new=True,
+                         header={"grid": grid})
+            fill(ds)
+            epoch = calendar.timegm(ds_time.timetuple())
+
+            def chain(rate, burst, wind):
+                return ((models.make_linear_model(
+                             [models.make_constant_ascent(rate), wind]),
+                         models.make_burst_termination(burst)),
+                        (models.make_linear_model(
+                             [models.make_drag_descent(5.0), wind]),
+                         models.sea_level_termination))
+
+            # the members share an interpolator, so their winds are looked
+            # up in batches, which should change nothing
+            f = make_interpolator(ds, WarningCounts())
+            wind = native.WindVelocity(f, epoch)
+            params = ((5.0, 8000.0), (3.0, 2000.0), (4.0, 12000.0),
+                      (5.0, 8000.0))
+            ts = [epoch + 3600.0] * 3 + [epoch + 8.8 * 3600.0]
+            lats, lngs, alts = (52.0, 45.0, 59.0, 52.0), \
+                               (0.3, 359.9, 180.0, 0.3), (0.0,) * 4
+
+            results = solver.solve_ensemble(
+                    ts, lats, lngs, alts,
+                    [chain(rate, burst, wind) for rate, burst in params])
+            assert f.cache_hits + f.cache_misses > 0
+            for i in range(3):
+                wind = native.WindVelocity(
+                        make_interpolator(ds, WarningCounts()), epoch)
+                expect = solver.solve(ts[i], lats[i], lngs[i], alts[i],
+                                      chain(params[i][0], params[i][1], wind))
+                assert_equal(results[i], expect)
+
+            # (runs out of the dataset's hours)
+            assert isinstance(results[3], RangeError)
+            assert_equal(results[3].variable, "hour")
+            ds.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_ensemble_error(self):
+        def broken(t, lat, lng, alt):
+            if t > 100:
+                raise ValueError("broken")
+            return 0.0, 0.0, 1.0
+
+        chains = [((broken, python_burst),),
+                  ((python_ascent, python_burst),)]
+        results = solver.solve_ensemble((0.0, 0.0), (52.0, 52.0), (0.0, 0.0),
+                                        (0.0, 0.0), chains)
+        assert isinstance(results[0], ValueError)
+        assert_equal(results[1], solver.solve(0.0, 52.0, 0.0, 0.0, chains[1]))
+
+    def test_ensemble_error_lookups(self):
+        directory = tempfile.mkdtemp()
+        try:
+            ds = Dataset(ds_time, directory=directory, new=True,
+                         header={"grid": grid})
+            fill(ds)
+            epoch = calendar.timegm(ds_time.timetuple())
+
+            def broken(t, lat, lng, alt):
+                if t > epoch + 3670:
+                    raise ValueError("broken")
+                return 0.0, 0.0, 1.0
+
+            def lookups(members):
+                workcounts = WorkCounts()
+                f = make_interpolator(ds, WarningCounts(), workcounts)
+                wind = native.WindVelocity(f, epoch)
+                chains = [((models.make_linear_model([model, wind]),
+                            python_burst),) for model in members]
+                n = len(chains)
+                results = solver.solve_ensemble(
+                        (epoch + 3600.0,) * n, (52.0,) * n, (0.3,) * n,
+                        (0.0,) * n, chains)
+                return results, workcounts.wind_lookups
+
+            results, both = lookups([broken, python_ascent])
+            assert isinstance(results[0], ValueError)
+            expect, alone = lookups([python_ascent])
+            assert_equal(results[1], expect[0])
+            # the broken member fails at the second evaluation of its second
+            # step, and is not looked up again
+            assert_equal(both - alone, 4 + 2)
+            ds.close()
+        finally:
+            shutil.rmtree(directory)
+
+    def test_dopri5(self):
+        # alt = 1000 * (1 - exp(-t / 1000))
+        def model(t, lat, lng, alt):
+            return 0.0, 0.01, 1.0 - alt / 1000.0
+
+        def terminator(t, lat, lng, alt):
+            return t >= 3000.0
+
+        result = solver.dopri5(0.0, 52.0, 359.0, 0.0, model, terminator,
+                               dt_max=3600.0, termination_tolerance=0.001)
+        t, lat, lng, alt = result[-1]
+        assert_almost_equal(t, 3000.0, places=2)
+        assert_almost_equal(lng, (359.0 + 30.0) % 360.0, places=4)
+        assert_almost_equal(alt, 950.21293, places=0)
+        # it should take far fewer (adaptive) steps than rk4
+        assert len(result) < 30
+
+    def test_solve_integrator(self):
+        chain = ((python_ascent, python_burst),)
+        expect = solver.solve(0.0, 52.0, 0.0, 0.0, chain)
+        result = solver.solve(0.0, 52.0, 0.0, 0.0, chain, solver.dopri5)
+        assert_equal(len(result), 1)
+        assert_almost_equal(result[0][-1][3], expect[0][-1][3], places=-1)
+        assert_almost_equal(result[0][-1][2], expect[0][-1][2], places=3)
+
+    def test_termination_distance(self):
+        up = models.make_linear_model([models.make_constant_ascent(5.0),
+                                       models.make_linear_model([python_ascent])])
+        burst = models.make_burst_termination(1234.0)
+
+        for integrator in (solver.rk4, solver.dopri5):
+            result = integrator(0.0, 52.0, 0.0, 0.0, up, burst,
+                                termination_distance=0.001)
+            t, lat, lng, alt = result[-1]
+            assert abs(alt - 1234.0) <= 0.001
+            assert_almost_equal(t, 123.4, places=3)
+
+            # Python terminators cannot measure their distance, so are
+            # bisected as before
+            expect = integrator(0.0, 52.0, 0.0, 0.0, up, python_burst)
+            result = integrator(0.0, 52.0, 0.0, 0.0, up, python_burst,
+                                termination_distance=0.001)
+            assert_equal(result, expect)
+
+        chain = ((models.make_drag_descent(5.0),
+                  models.make_any_terminator([models.sea_level_termination,
+                                              models.make_time_termination(1e9)])),)
+        down, = solver.solve_ensemble((0.0,), (52.0,), (0.0,), (3000.0,),
+                                      [chain], termination_distance=0.001)[0]
+        assert abs(down[-1][3]) <= 0.001
+
+        # when both fire in the last step, the point is that of whichever
+        # fired first, found by its own distance (seconds or metres)
+        landing = down[-1][0]
+        step = 60.0 * (landing // 60.0)
+        for max_time, fires_first in ((step + (landing - step) / 2, "time"),
+                                      (landing + (step + 60.0 - landing) / 2,
+                                       "sea level")):
+            stop = models.make_any_terminator(
+                    [models.sea_level_termination,
+                     models.make_time_termination(max_time)])
+            chain = ((models.make_drag_descent(5.0), stop),)
+            for result in (solver.rk4(0.0, 52.0, 0.0, 3000.0, chain[0][0],
+                                      stop, termination_distance=0.001),
+                           solver.solve_ensemble(
+                                (0.0,), (52.0,), (0.0,), (3000.0,), [chain],
+                                termination_distance=0.001)[0][0]):
+                t, lat, lng, alt = result[-1]
+                if fires_first == "time":
+                    assert abs(t - max_time) <= 0.001
+                    assert alt > 1.0
+                else:
+                    assert abs(alt) <= 0.001
+                    assert_almost_equal(t, landing, places=2)
+
+    def test_output_interval(self):
+        chain = ((models.make_constant_ascent(5.0),
+                  models.make_burst_termination(10000.0)),
+                 (models.make_drag_descent(5.0), models.sea_level_termination))
+
+        for integrator in (solver.rk4, solver.dopri5):
+            expect = solver.solve(0.0, 52.0, 0.0, 0.0, chain, integrator)
+            result = solver.solve(0.0, 52.0, 0.0, 0.0, chain,
+                                  functools.partial(integrator,
+                                                    output_interval=300.0))
+            for stage, full in zip(result, expect):
+                # the same flight (burst and landing unchanged), but only
+                # the points at least 300s apart
+                assert_equal(stage[0], full[0])
+                assert_equal(stage[-1], full[-1])
+                assert set(stage) <= set(full)
+                assert len(stage) < len(full)
+                for a, b in zip(stage[:-2], stage[1:-1]):
+                    assert b[0] - a[0] >= 300.0
+
+        expect = solver.solve(0.0, 52.0, 0.0, 0.0, chain,
+                              functools.partial(solver.rk4,
+                                                output_interval=300.0))
+        result, = solver.solve_ensemble((0.0,), (52.0,), (0.0,), (0.0,),
+                                        [chain], output_interval=300.0)
+        assert_equal(result, expect)
@@ -1,11 +1,16 @@
 from __future__ import print_function
 
 import json
+import shutil
+import struct
+import tempfile
+from array import array
 
 from flask_testing import TestCase
 from mock import patch, MagicMock
 from urllib.parse import urlencode
 
+from tawhiri import api
 from tawhiri.api import app
 
 # Root path for v1 API
@@ -34,9 +39,9 @@ class BasicApiTest(TestCase):
 
     @patch('tawhiri.models.standard_profile')
     @patch('tawhiri.solver.solve')
-    @patch('tawhiri.api.WindDataset')
+    @patch('tawhiri.api.wind_registry')
     @patch('tawhiri.api.ruaumoko_ds')
-    def test_simple_run(self, ruaumoko_ds_mock, wind_ds_mock, solve_mock, profile_mock):
+    def test_simple_run(self, ruaumoko_ds_mock, wind_registry_mock, solve_mock, profile_mock):
         """Make a simple request for a landing prediction."""
 
         # The minimum number of parameters for a prediction is lat, long and
@@ -54,7 +59,7 @@ class BasicApiTest(TestCase):
         ruaumoko_ds_mock().get = MagicMock(return_value=5)
 
         # Mock latest dataset's strftime
-        wind_ds_mock.open_latest().ds_time.strftime = MagicMock(return_value='strftime_mock')
+        wind_registry_mock().acquire().ds_time.strftime = MagicMock(return_value='strftime_mock')
 
         # Predictions always return the same value
         mock_prediction = [
@@ -66,6 +71,11 @@ class BasicApiTest(TestCase):
         # Make request
         response = self.client.get(API_ROOT + '?' + urlencode(qs))
 
+        # Check that the dataset was given back to the registry
+        wind_registry_mock().release.assert_called_with(
+            wind_registry_mock().acquire()
+        )
+
         # Check that ruaumoko was asked about launch altitude.
         ruaumoko_ds_mock().get.assert_called_with(
             qs['launch_latitude'], qs['launch_longitude']
@@ -93,3 +103,276 @@ class BasicApiTest(TestCase):
             self.assertEqual(len(expected), len(leg['trajectory']))
 
             # TODO: Compare results for equality
+
+    def _batch(self, reqs):
+        response = self.client.post(API_ROOT + 'batch', data=json.dumps(reqs),
+                                    content_type='application/json')
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in
+                 response.get_data(as_text=True).splitlines()]
+        return sorted(lines, key=lambda line: line['index'])
+
+    @patch('tawhiri.api.run_cached_prediction')
+    def test_batch(self, run_prediction_mock):
+        """Make a batch of requests, some of which fail."""
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=30000,
+        )
+
+        def run_prediction(req):
+            if req['ascent_rate'] == 6:
+                raise api.InvalidDatasetException("No matching dataset found.")
+            return json.dumps({"request": req, "prediction": []}).encode()
+        run_prediction_mock.side_effect = run_prediction
+
+        reqs = [qs, dict(qs, ascent_rate=6), dict(qs, ascent_rate=-1), 5, qs]
+        app.config['BATCH_PROCESSES'] = 1
+        try:
+            lines = self._batch(reqs)
+        finally:
+            del app.config['BATCH_PROCESSES']
+            del api.batch_pool.once
+
+        self.assertEqual([line['index'] for line in lines], list(range(5)))
+        for i in (0, 4):
+            self.assertEqual(lines[i]['request']['ascent_rate'], 5)
+            self.assertNotIn('error', lines[i])
+            self.assertIn('metadata', lines[i])
+        self.assertEqual(lines[1]['error']['type'], 'InvalidDatasetException')
+        self.assertEqual(lines[2]['error']['type'], 'RequestException')
+        self.assertEqual(lines[3]['error']['type'], 'RequestException')
+
+        # The whole batch is rejected if it is not a list
+        response = self.client.post(API_ROOT + 'batch', data='{}',
+                                    content_type='application/json')
+        self.assert400(response)
+
+    def test_batch_pool(self):
+        """Run a batch in worker processes (without any wind datasets)."""
+        directory = tempfile.mkdtemp()
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=30000,
+        )
+        app.config['BATCH_PROCESSES'] = 2
+        app.config['WIND_DATASET_DIR'] = directory
+        try:
+            lines = self._batch([qs] * 3)
+        finally:
+            api.batch_pool.once.terminate()
+            del api.batch_pool.once
+            del app.config['BATCH_PROCESSES']
+            del app.config['WIND_DATASET_DIR']
+            shutil.rmtree(directory)
+
+        self.assertEqual([line['index'] for line in lines], [0, 1, 2])
+        for line in lines:
+            self.assertEqual(line['error']['type'], 'InvalidDatasetException')
+
+        # 0 means one worker per CPU, as for the batch endpoint's window
+        app.config['BATCH_PROCESSES'] = 0
+        try:
+            with patch('multiprocessing.context.SpawnContext.Pool') as pool:
+                self.assertIs(api.batch_pool(), pool.return_value)
+        finally:
+            del api.batch_pool.once
+            del app.config['BATCH_PROCESSES']
+        self.assertIsNone(pool.call_args[0][0])
+
+    @patch('tawhiri.api._run_batch_prediction')
+    def test_batch_closed(self, run_batch_prediction_mock):
+        """Stop giving a batch to the pool once its response is closed."""
+        run_batch_prediction_mock.side_effect = \
+                lambda item: str(item[0]).encode()
+        submitted = []
+
+        class Pool(object):
+            def apply_async(self, fn, args, callback, error_callback):
+                submitted.append(args[0][0])
+                callback(fn(*args))
+
+        reqs = [(i, {}) for i in range(10)]
+        self.assertEqual(sorted(api._run_batch(Pool(), 3, reqs), key=int),
+                         [str(i).encode() for i in range(10)])
+
+        del submitted[:]
+        results = api._run_batch(Pool(), 3, reqs)
+        self.assertEqual(next(results), b'0')
+        results.close()
+        self.assertEqual(submitted, [0, 1, 2])
+
+    @patch('tawhiri.models.standard_profile')
+    @patch('tawhiri.solver.solve')
+    @patch('tawhiri.api.wind_registry')
+    @patch('tawhiri.api.elevation_ds')
+    def test_result_cache(self, elevation_ds_mock, wind_registry_mock,
+                          solve_mock, profile_mock):
+        """Identical requests are only predicted once."""
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=30000,
+        )
+        wind_registry_mock().acquire().ds_time.strftime = \
+                MagicMock(return_value='2014081912')
+        solve_mock.configure_mock(return_value=[[[1, 52, 0, 0]],
+                                                [[3, 54, 1, 0]]])
+
+        if hasattr(api.result_cache, 'once'):
+            del api.result_cache.once
+        try:
+            first = self.client.get(API_ROOT + '?' + urlencode(qs))
+            second = self.client.get(API_ROOT + '?' + urlencode(qs))
+            stats = self.client.get(API_ROOT + 'cache').json
+        finally:
+            del api.result_cache.once
+
+        self.assert200(second)
+        self.assertEqual(solve_mock.call_count, 1)
+        first, second = first.json, second.json
+        del first['metadata'], second['metadata']
+        self.assertEqual(first, second)
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    @patch('tawhiri.models.standard_profile')
+    @patch('tawhiri.solver.solve')
+    @patch('tawhiri.api.wind_registry')
+    @patch('tawhiri.api.elevation_ds')
+    def test_formats(self, elevation_ds_mock, wind_registry_mock,
+                     solve_mock, profile_mock):
+        """Request the columnar and binary formats."""
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=30000,
+        )
+        wind_registry_mock().acquire().ds_time.strftime = \
+                MagicMock(return_value='2014081912')
+        prediction = [[[1, 52, 0, 0], [2, 53, 0, 100]], [[3, 54, 1, 0]]]
+        solve_mock.configure_mock(return_value=prediction)
+
+        response = self.client.get(API_ROOT + '?' +
+                                   urlencode(dict(qs, format='columnar')))
+        self.assert200(response)
+        stages = response.json['prediction']
+        self.assertEqual([stage['stage'] for stage in stages],
+                         ['ascent', 'descent'])
+        self.assertEqual(stages[0]['timestamp'], [1, 2])
+        self.assertEqual(stages[0]['latitude'], [52, 53])
+        self.assertEqual(stages[0]['longitude'], [0, 0])
+        self.assertEqual(stages[0]['altitude'], [0, 100])
+        self.assertEqual(stages[1]['timestamp'], [3])
+
+        response = self.client.get(API_ROOT + '?' +
+                                   urlencode(dict(qs, format='binary')))
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/octet-stream')
+        body = response.get_data()
+        self.assertEqual(body[:4], b'TWHR')
+        length, = struct.unpack('<I', body[4:8])
+        self.assertEqual((8 + length) % 8, 0)
+        header = json.loads(body[8:8 + length].decode())
+        self.assertIn('metadata', header)
+        self.assertEqual(header['request']['format'], 'binary')
+        self.assertEqual([(stage['stage'], stage['points'])
+                          for stage in header['prediction']],
+                         [('ascent', 2), ('descent', 1)])
+        data = array('d')
+        data.frombytes(body[8 + length:])
+        self.assertEqual(list(data), [1, 2, 52, 53, 0, 0, 0, 100, 3, 54, 1, 0])
+
+    @patch('tawhiri.models.standard_profile')
+    @patch('tawhiri.solver.solve_iter')
+    @patch('tawhiri.api.wind_registry')
+    @patch('tawhiri.api.elevation_ds')
+    def test_stream(self, elevation_ds_mock, wind_registry_mock,
+                    solve_iter_mock, profile_mock):
+        """Stream a prediction, stage by stage."""
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=30000,
+        )
+        wind_registry_mock().acquire().ds_time.strftime = \
+                MagicMock(return_value='2014081912')
+
+        def broken_descent():
+            yield [[1, 52, 0, 0], [2, 53, 0, 100]]
+            raise ValueError("broken")
+
+        solve_iter_mock.configure_mock(return_value=iter(
+                [[[1, 52, 0, 0], [2, 53, 0, 100]], [[3, 54, 1, 0]]]))
+        response = self.client.get(API_ROOT + 'stream?' + urlencode(qs))
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(lines[0]['request']['launch_datetime'],
+                         '2014-08-19T23:00:00Z')
+        self.assertEqual([line['stage'] for line in lines[1:3]],
+                         ['ascent', 'descent'])
+        self.assertEqual(lines[2]['trajectory'][0]['latitude'], 54)
+        self.assertIn('warnings', lines[3])
+        self.assertIn('metadata', lines[4])
+
+        # (a different request, which is not in the result cache)
+        solve_iter_mock.configure_mock(return_value=broken_descent())
+        response = self.client.get(API_ROOT + 'stream?' +
+                                   urlencode(dict(qs, burst_altitude=20000)))
+        lines = [json.loads(line) for line in response.get_data().splitlines()]
+        self.assertEqual(lines[1]['stage'], 'ascent')
+        self.assertEqual(lines[2]['error']['type'], 'PredictionException')
+        self.assertIn('metadata', lines[3])
+
+        response = self.client.get(API_ROOT + 'stream?' +
+                                   urlencode(dict(qs, format='binary')))
+        self.assert400(response)
+
+    @patch('tawhiri.models.standard_profile')
+    @patch('tawhiri.solver.solve')
+    @patch('tawhiri.api.wind_registry')
+    @patch('tawhiri.api.elevation_ds')
+    def test_metrics(self, elevation_ds_mock, wind_registry_mock,
+                     solve_mock, profile_mock):
+        """Include timings in the metadata, and fetch the metrics."""
+        qs = dict(
+            launch_latitude=52.1, launch_longitude=0.3, launch_altitude=0,
+            launch_datetime='2014-08-19T23:00:00Z',
+            ascent_rate=5, descent_rate=10, burst_altitude=25000,
+        )
+        wind_registry_mock().acquire().ds_time.strftime = \
+                MagicMock(return_value='2014081912')
+        solve_mock.configure_mock(
+                return_value=[[[1, 52, 0, 0]], [[3, 54, 1, 0]]])
+        before = self.client.get(API_ROOT + 'metrics').get_data().decode()
+
+        response = self.client.get(API_ROOT + '?' + urlencode(qs))
+        self.assert200(response)
+        self.assertNotIn('timings', response.json['metadata'])
+
+        response = self.client.get(API_ROOT + '?' +
+                                   urlencode(dict(qs, timings='true')))
+        self.assert200(response)
+        timings = response.json['metadata']['timings']
+        self.assertIn('parse', timings['phases'])
+        self.assertIn('dataset', timings['phases'])
+        self.assertEqual(timings['counts']['predictions'], 1)
+        self.assertEqual(timings['counts'].get('cached_predictions'), 1)
+
+        def predictions(text):
+            for line in text.splitlines():
+                if line.startswith('tawhiri_predictions_total '):
+                    return int(line.split()[1])
+            return 0
+
+        response = self.client.get(API_ROOT + 'metrics')
+        self.assert200(response)
+        self.assertEqual(response.mimetype, 'text/plain')
+        after = response.get_data().decode()
+        self.assertEqual(predictions(after), predictions(before) + 2)
+        self.assertIn('tawhiri_phase_seconds_count{phase="serialize"}', after)